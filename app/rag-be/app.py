@@ -1,14 +1,33 @@
+import logging
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 import uvicorn
+from common.metrics import MetricsMiddleware, render_metrics
+from common.storage import get_storage_profile
+from config import get_settings
 from fastapi import FastAPI, File, Form, HTTPException, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from fastapi_mcp import FastApiMCP
-from schema import RetrieverRequest
+from schema import BatchRetrieverRequest, RetrieverRequest
 from services import RAGService
+from sse_starlette.sse import EventSourceResponse
+from starlette.concurrency import run_in_threadpool
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Shared clients and the collection registry live for the whole process
+    await RAGService.astartup()
+    yield
+    await RAGService.shutdown()
+
+
+logging.basicConfig(level=get_settings().log_level.upper(), format="%(asctime)s %(levelname)s %(name)s %(message)s")
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -16,7 +35,10 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
+# Request durations and Server-Timing headers with the stages of the request
+app.add_middleware(MetricsMiddleware)
 
 @app.post("/vector_database/qdrant/get_collections", operation_id="get_collections")
 async def get_collections() -> List[Dict]:
@@ -29,14 +51,18 @@ async def get_collections() -> List[Dict]:
             - collection_name (str): Name of the collection.
             - description (str): Description of the collection.
     """
-    return RAGService.get_collections()
+    return await RAGService.get_collections()
 
 
 @app.post("/rag/indexer", operation_id="rag_indexer")
 async def indexer(
     collection_name: str = Form(..., description="Collection name to store documents in vector DB"),
     description: str = Form(..., description="Description of the collection"),
-    files: List[UploadFile] = File(..., description="Upload one or more Markdown (.md) files only")):
+    files: List[UploadFile] = File(..., description="Upload one or more Markdown (.md) files only"),
+    storage_profile: Optional[str] = Form(None, description="default, scalar, binary or on_disk"),
+    hnsw_m: Optional[int] = Form(None, description="HNSW edges per node"),
+    hnsw_ef_construct: Optional[int] = Form(None, description="HNSW neighbours considered while building"),
+    hnsw_ef: Optional[int] = Form(None, description="HNSW neighbours considered while searching")):
     """
     Role: Indexer
     Team: RAG
@@ -46,9 +72,17 @@ async def indexer(
         - collection_name (str): Collection name to save in vector database.
         - description (str): Description of the collection.
         - files (list): Paths to the source document.
+        - storage_profile (str): How vectors and payloads are stored (STORAGE_PROFILE when not given):
+            - default: float32 vectors and payloads in RAM.
+            - scalar: int8 quantized vectors in RAM, rescored with the originals.
+            - binary: 1-bit quantized vectors in RAM, rescored with the originals.
+            - on_disk: int8 quantized vectors in RAM, original vectors and payloads on disk.
+        - hnsw_m, hnsw_ef_construct, hnsw_ef (int): Override the HNSW options of the profile.
     Return:
         - message (str): Success message.
-        - collection_name (str): Collection name to save in vector database.
+        - collection (dict): Collection to save in vector database (id, collection_name, description,
+            storage_profile).
+        - job (dict): Background indexing job, poll /rag/indexer/jobs/{job_id} for progress.
     """
     # Validate file types
     for file in files:
@@ -58,6 +92,16 @@ async def indexer(
                 detail=f"File '{file.filename}' is not a Markdown (.md) file.",
             )
 
+    try:
+        profile = get_storage_profile(
+            storage_profile or get_settings().storage_profile,
+            hnsw_m=hnsw_m,
+            hnsw_ef_construct=hnsw_ef_construct,
+            hnsw_ef=hnsw_ef,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
     # Collection name with timestamp
     now = datetime.now()
     timestamp = now.strftime("%Y%m%d%H%M%S") + f"{now.microsecond:06d}"
@@ -66,17 +110,102 @@ async def indexer(
         "id": f"{collection_name}_{timestamp}",
         "collection_name": collection_name,
         "description": description,
+        "storage_profile": profile.to_dict(),
+    }
+
+    # Indexer: save files, then chunk, embed and upsert on the indexer worker pool
+    job = await run_in_threadpool(RAGService.submit_index, collection, files)
+
+    return {
+        "message": "Index job submitted",
+        "collection": collection,
+        "job": job.to_dict(),
     }
 
-    # Indexer
-    RAGService.index(collection, files)
+
+@app.post("/rag/indexer/update", operation_id="rag_indexer_update")
+async def update_indexer(
+    collection_id: str = Form(..., description="ID of the existing collection to update"),
+    files: List[UploadFile] = File(..., description="Upload one or more Markdown (.md) files only")):
+    """
+    Role: Indexer
+    Team: RAG
+    Description: Re-index documents into an existing collection incrementally.
+        Only new or changed chunks of the uploaded files are embedded, removed chunks are deleted,
+        other files of the collection are not touched.
+
+    Parameters:
+        - collection_id (str): ID of the existing collection.
+        - files (list): Paths to the source document.
+    Return:
+        - message (str): Success message.
+        - collection (dict): Collection updated.
+        - job (dict): Background indexing job, poll /rag/indexer/jobs/{job_id} for progress.
+    """
+    # Validate file types
+    for file in files:
+        if not file.filename.lower().endswith(".md"):
+            raise HTTPException(
+                status_code=400,
+                detail=f"File '{file.filename}' is not a Markdown (.md) file.",
+            )
+
+    collection = await RAGService.get_collection(collection_id)
+    if collection is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Collection(s) not found: {[collection_id]}",
+        )
+
+    job = await run_in_threadpool(RAGService.submit_index, collection, files, True)
 
     return {
-        "message": "Index successful",
+        "message": "Index job submitted",
         "collection": collection,
+        "job": job.to_dict(),
     }
 
 
+@app.get("/rag/indexer/jobs", operation_id="rag_indexer_jobs")
+async def indexer_jobs() -> List[Dict]:
+    """
+    List the recent indexing jobs with their status and progress.
+    """
+    return [job.to_dict() for job in RAGService.list_index_jobs()]
+
+
+@app.get("/rag/indexer/jobs/{job_id}", operation_id="rag_indexer_job")
+async def indexer_job(job_id: str) -> Dict:
+    """
+    Status and progress of an indexing job.
+
+    Return:
+        - status (str): queued, running, succeeded, failed, cancelled.
+        - stage (str): queued, chunking, embedding, done.
+        - progress (dict): chunks_produced (contexts_generated + contexts_cached with contextual retrieval),
+            chunks_unchanged, chunks_embedded (embeddings_cached from the embedding store + embeddings_computed),
+            points_upserted, points_deleted, eta_seconds.
+    """
+    job = RAGService.get_index_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
+    return job.to_dict()
+
+
+@app.post("/rag/indexer/jobs/{job_id}/cancel", operation_id="rag_indexer_job_cancel")
+async def cancel_indexer_job(job_id: str) -> Dict:
+    """
+    Cancel an indexing job. It stops at its next progress report:
+        - new index (/rag/indexer): the partially indexed collection is dropped.
+        - update (/rag/indexer/update): the chunks and paragraphs added so far are deleted, the collection is left
+            as it was. Once the removed chunks are being deleted the update can no longer be cancelled and completes.
+    """
+    job = RAGService.cancel_index_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
+    return job.to_dict()
+
+
 @app.post("/rag/retriever", operation_id="rag_retriever")
 async def retrieve(request: RetrieverRequest):
     """
@@ -93,10 +222,43 @@ async def retrieve(request: RetrieverRequest):
             - value: documents related to the collection.
     """
     # Check if requested collection exists
-    collections = await get_collections()
-    collection_ids = [c["id"] for c in collections]
+    invalid_ids = [id_ for id_ in request.collection_ids if await RAGService.get_collection(id_) is None]
+
+    if invalid_ids:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Collection(s) not found: {invalid_ids}",
+        )
+
+    return await RAGService.retrieve(request.question, request.collection_ids)
+
 
-    invalid_ids = [id_ for id_ in request.collection_ids if id_ not in collection_ids]
+@app.post("/rag/retriever/batch", operation_id="rag_retriever_batch")
+async def retrieve_batch(request: BatchRetrieverRequest):
+    """
+    Role: Retriever
+    Team: RAG
+    Description: Retriever document related with many questions in vector database, in one call.
+
+    Parameters: BatchRetrieverRequest
+        - questions (list[str]): User questions.
+        - collection_ids (list[str]): List collection id to save in vector database.
+    Return:
+        - results (list): One per question, in order.
+            - question (str): The question.
+            - document_related (dict):
+                - key: collection name
+                - value: documents related to the collection.
+    """
+    max_questions = get_settings().retriever_batch_max_questions
+    if len(request.questions) > max_questions:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many questions: {len(request.questions)}, at most {max_questions} per request",
+        )
+
+    # Check if requested collection exists
+    invalid_ids = [id_ for id_ in request.collection_ids if await RAGService.get_collection(id_) is None]
 
     if invalid_ids:
         raise HTTPException(
@@ -104,7 +266,7 @@ async def retrieve(request: RetrieverRequest):
             detail=f"Collection(s) not found: {invalid_ids}",
         )
 
-    return RAGService.retrieve(request.question, request.collection_ids)
+    return await RAGService.retrieve_batch(request.questions, request.collection_ids)
 
 
 @app.post("/rag/chat", operation_id="rag_chat")
@@ -124,11 +286,55 @@ async def chat(request: RetrieverRequest):
         - answer: The answer to the question.
     """
 
-    return RAGService.chat(request.question, request.collection_ids)
+    return await RAGService.chat(request.question, request.collection_ids)
+
+
+@app.post("/rag/chat/stream", operation_id="rag_chat_stream")
+async def chat_stream(request: RetrieverRequest):
+    """
+    Role: Chat
+    Team: RAG
+    Description: Same as /rag/chat, streamed as Server-Sent Events.
+
+    Parameters: RetrieverRequest
+        - question (str): User question.
+        - collection_ids (list[str]): List collection id to save in vector database.
+    Events:
+        - documents: JSON of documents related (key: collection name, value: documents related).
+        - token: JSON string, next tokens of the answer.
+        - done: end of the answer.
+        - error: JSON string, retrieval or the LLM failed midway; ends the stream instead of done.
+    """
+    return EventSourceResponse(RAGService.chat_stream(request.question, request.collection_ids))
+
+@app.get("/rag/cache/stats", operation_id="cache_stats")
+async def cache_stats() -> Dict:
+    """
+    Hit/miss counters of the query-embedding cache.
+    """
+    return RAGService.cache_stats()
+
+
+@app.get("/metrics", operation_id="metrics", response_class=PlainTextResponse)
+async def metrics() -> str:
+    """
+    Prometheus metrics: durations of the HTTP requests and of the stages of retrieval, chat and indexing.
+    """
+    return render_metrics()
+
 
 mcp = FastApiMCP(
     app,
-    exclude_operations=["rag_indexer"],
+    exclude_operations=[
+        "rag_indexer",
+        "rag_indexer_update",
+        "rag_indexer_jobs",
+        "rag_indexer_job",
+        "rag_indexer_job_cancel",
+        "rag_chat_stream",
+        "cache_stats",
+        "metrics",
+    ],
 )
 mcp.mount()
 
@@ -0,0 +1,79 @@
+import re
+import unicodedata
+from typing import List, Optional, Sequence, Tuple
+
+from llama_index.core.schema import BaseNode
+
+# "### Điều 34. Các trường hợp chấm dứt hợp đồng lao động" (header line of an article)
+_ARTICLE_HEADER = re.compile(r"^#+\s*Điều\s+(\d+)", re.MULTILINE | re.IGNORECASE)
+# "Điều 34. ..." (segment of a header_path)
+_ARTICLE_SEGMENT = re.compile(r"^Điều\s+(\d+)", re.IGNORECASE)
+# "Chương V: ..." (segment of a header_path)
+_CHAPTER_SEGMENT = re.compile(r"^Chương\s+([IVXLCDM]+|\d+)\b", re.IGNORECASE)
+
+# "Điều 137", "điều 34, 48 và 125" in a question
+_ARTICLE_REFERENCE = re.compile(r"\bđiều\s+(\d+(?:\s*(?:,|và|&)\s*\d+)*)", re.IGNORECASE)
+_CHAPTER_REFERENCE = re.compile(r"\bchương\s+([ivxlcdm]+|\d+)\b", re.IGNORECASE)
+
+# Metadata of the chunks, kept out of the embedding and the LLM context
+ARTICLE_METADATA_KEYS = ["articles", "chapter"]
+
+
+def annotate_articles(nodes: Sequence[BaseNode]) -> Sequence[BaseNode]:
+    """
+    Add the article numbers ("Điều N") and the chapter of their paragraph to the metadata of the chunks,
+    for the exact article lookup of the retriever.
+
+    Must run after CustomSentenceSplitter: the articles are read from paragraph_full_content, which holds
+    every article header of a paragraph made of merged small articles.
+    """
+    for node in nodes:
+        paragraph = node.metadata.get("paragraph_full_content") or node.get_content()
+        articles = paragraph_articles(node.metadata.get("header_path", ""), paragraph)
+
+        segments = [s.strip() for s in node.metadata.get("header_path", "").split("/") if s.strip()]
+        chapter = None
+        for segment in segments:
+            match = _CHAPTER_SEGMENT.match(segment)
+            if match:
+                chapter = match.group(1).upper()
+                break
+
+        node.metadata["articles"] = sorted(set(articles))
+        node.metadata["chapter"] = chapter
+        node.excluded_embed_metadata_keys.extend(ARTICLE_METADATA_KEYS)
+        node.excluded_llm_metadata_keys.extend(ARTICLE_METADATA_KEYS)
+
+    return nodes
+
+
+def paragraph_articles(header_path: str, content: str) -> List[int]:
+    """
+    Article numbers of a paragraph, in order of appearance: from its header_path, then from the article headers
+    ("### Điều N") of its content.
+    """
+    articles = []
+    for segment in header_path.split("/"):
+        match = _ARTICLE_SEGMENT.match(segment.strip())
+        if match:
+            articles.append(int(match.group(1)))
+    articles.extend(int(number) for number in _ARTICLE_HEADER.findall(content))
+
+    return list(dict.fromkeys(articles))
+
+
+def find_article_references(question: str) -> Tuple[List[int], Optional[str]]:
+    """
+    Article numbers (in order of appearance) and chapter named by the question, e.g.
+    "Điều 137 quy định gì" -> ([137], None), "Điều 5, 7 Chương II" -> ([5, 7], "II").
+    """
+    question = unicodedata.normalize("NFC", question)
+
+    articles = []
+    for match in _ARTICLE_REFERENCE.finditer(question):
+        for number in re.findall(r"\d+", match.group(1)):
+            if int(number) not in articles:
+                articles.append(int(number))
+
+    chapter = _CHAPTER_REFERENCE.search(question)
+    return articles, chapter.group(1).upper() if chapter else None
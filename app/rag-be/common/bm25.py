@@ -0,0 +1,78 @@
+import re
+import unicodedata
+import zlib
+from collections import Counter
+from typing import List, Tuple
+
+# Runs of letters/digits (syllables), a punctuation mark ends a phrase
+_PHRASE_SPLIT = re.compile(r"[^\w\s]+|_+", re.UNICODE)
+
+SparseVectors = Tuple[List[List[int]], List[List[float]]]
+
+# Defaults of BM25Encoder and of the BM25_* settings. Chunks of 256-1024 tokens (the chunker defaults) average
+# ~520 terms on dataset/preprocessed/PLVN
+DEFAULT_K1 = 1.2
+DEFAULT_B = 0.75
+DEFAULT_AVG_LEN = 512
+
+
+class BM25Encoder:
+    """
+    Local, CPU-only BM25 sparse vectors for Vietnamese text.
+
+    Vietnamese words are mostly compounds of space-separated syllables ("lao động", "thỏa ước"), so the terms are
+    the NFC-lowercased syllables plus the bigrams of adjacent syllables within a phrase. Terms are hashed to
+    stable sparse indices (crc32).
+
+    Documents get the BM25 term-frequency part, queries a weight of 1 per term; the IDF part is computed by Qdrant
+    over the whole collection (sparse vector with Modifier.IDF), so no corpus statistics are kept here.
+    """
+
+    def __init__(self, k1: float = DEFAULT_K1, b: float = DEFAULT_B, avg_len: float = DEFAULT_AVG_LEN):
+        """
+        Parameters:
+            - k1 (float): Term-frequency saturation.
+            - b (float): Document length normalization.
+            - avg_len (float): Average number of terms per document (chunk), for the length normalization.
+        """
+        self.k1 = k1
+        self.b = b
+        self.avg_len = avg_len
+
+    @staticmethod
+    def tokenize(text: str) -> List[str]:
+        text = unicodedata.normalize("NFC", text).lower()
+
+        terms = []
+        for phrase in _PHRASE_SPLIT.split(text):
+            syllables = phrase.split()
+            terms.extend(syllables)
+            terms.extend(f"{first} {second}" for first, second in zip(syllables, syllables[1:]))
+        return terms
+
+    @staticmethod
+    def term_index(term: str) -> int:
+        return zlib.crc32(term.encode())
+
+    def encode_documents(self, texts: List[str]) -> SparseVectors:
+        indices, values = [], []
+        for text in texts:
+            terms = self.tokenize(text)
+            norm = self.k1 * (1 - self.b + self.b * len(terms) / self.avg_len)
+
+            weights = {}
+            for term, tf in Counter(terms).items():
+                index = self.term_index(term)
+                weights[index] = weights.get(index, 0.0) + tf * (self.k1 + 1) / (tf + norm)
+
+            indices.append(list(weights.keys()))
+            values.append(list(weights.values()))
+        return indices, values
+
+    def encode_queries(self, texts: List[str]) -> SparseVectors:
+        indices, values = [], []
+        for text in texts:
+            terms = {self.term_index(term) for term in self.tokenize(text)}
+            indices.append(list(terms))
+            values.append([1.0] * len(terms))
+        return indices, values
@@ -0,0 +1,526 @@
+import fcntl
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from common.articles import find_article_references
+
+# Collection ids and article references (articles, chapter) an answer is valid for
+AnswerScope = Tuple[FrozenSet[str], Tuple[Tuple[int, ...], Optional[str]]]
+
+
+class EmbeddingCache:
+    """
+    Bounded LRU cache of question embeddings with TTL eviction.
+
+    Keys are the embedding model name plus the NFC-normalized question, so the same question typed with
+    composed or decomposed Vietnamese diacritics hits the same entry.
+    With redis_url, entries are also shared between workers through Redis (optional `redis` package).
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 86400, redis_url: Optional[str] = None):
+        """
+        Parameters:
+            - max_size (int): Maximum number of entries kept in process.
+            - ttl (float): Seconds an entry stays valid, <= 0 to never expire.
+            - redis_url (str): Optional shared backend, e.g. redis://redis:6379/0.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._items: OrderedDict[str, Tuple[float, List[float]]] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+        self._redis = None
+        if redis_url:
+            import redis.asyncio as redis
+
+            self._redis = redis.Redis.from_url(redis_url)
+
+    @staticmethod
+    def make_key(model_name: str, text: str) -> str:
+        normalized = unicodedata.normalize("NFC", text.strip())
+        return hashlib.sha256(f"{model_name}\x00{normalized}".encode()).hexdigest()
+
+    def _get_local(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+
+            expires_at, embedding = item
+            if expires_at and expires_at < time.monotonic():
+                del self._items[key]
+                return None
+
+            self._items.move_to_end(key)
+            return embedding
+
+    def _set_local(self, key: str, embedding: List[float]) -> None:
+        expires_at = time.monotonic() + self.ttl if self.ttl > 0 else 0.0
+        with self._lock:
+            self._items[key] = (expires_at, embedding)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    async def get(self, model_name: str, text: str) -> Optional[List[float]]:
+        key = self.make_key(model_name, text)
+
+        embedding = self._get_local(key)
+        if embedding is not None:
+            self.hits += 1
+            return embedding
+
+        if self._redis is not None:
+            raw = await self._redis.get(f"embedding:{key}")
+            if raw is not None:
+                embedding = array("f", raw).tolist()
+                self._set_local(key, embedding)
+                self.shared_hits += 1
+                return embedding
+
+        self.misses += 1
+        return None
+
+    async def set(self, model_name: str, text: str, embedding: List[float]) -> None:
+        key = self.make_key(model_name, text)
+        self._set_local(key, embedding)
+
+        if self._redis is not None:
+            await self._redis.set(
+                f"embedding:{key}",
+                array("f", embedding).tobytes(),
+                ex=int(self.ttl) if self.ttl > 0 else None,
+            )
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.shared_hits + self.misses
+        return {
+            "size": len(self._items),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.shared_hits) / lookups if lookups else 0.0,
+        }
+
+    async def close(self) -> None:
+        if self._redis is not None:
+            await self._redis.aclose()
+
+
+class AnswerCache:
+    """
+    Semantic cache of chat answers.
+
+    An entry is scoped to the exact set of collection ids it was answered from and to the articles ("Điều N")
+    and chapter named by the question, and is returned for a new question of the same scope whose embedding has
+    cosine similarity >= similarity_threshold with the cached question. Questions differing only by the article
+    number ("Điều 137 quy định gì?", "Điều 138 quy định gì?") embed nearly the same, the scope keeps them apart.
+    Entries are dropped when any of their collections is (re-)indexed.
+    """
+
+    def __init__(self, similarity_threshold: float = 0.95, max_size: int = 1000, ttl: float = 3600):
+        """
+        Parameters:
+            - similarity_threshold (float): Minimum cosine similarity between questions to reuse an answer.
+            - max_size (int): Maximum number of answers kept, least recently used are evicted first.
+            - ttl (float): Seconds an answer stays valid, <= 0 to never expire.
+        """
+        self.similarity_threshold = similarity_threshold
+        self.max_size = max_size
+        self.ttl = ttl
+
+        # entry id -> (scope, normalized question vector, answer, expires_at)
+        self._entries: OrderedDict[int, Tuple[AnswerScope, np.ndarray, Dict, float]] = OrderedDict()
+        self._scopes: Dict[AnswerScope, Set[int]] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    @staticmethod
+    def _scope(collection_ids: Iterable[str], question: str) -> AnswerScope:
+        articles, chapter = find_article_references(question)
+        return frozenset(collection_ids), (tuple(sorted(articles)), chapter)
+
+    def _remove(self, entry_id: int) -> None:
+        scope = self._entries.pop(entry_id)[0]
+        ids = self._scopes[scope]
+        ids.discard(entry_id)
+        if not ids:
+            del self._scopes[scope]
+
+    def get(self, collection_ids: Iterable[str], question: str, embedding: List[float]) -> Optional[Dict]:
+        scope = self._scope(collection_ids, question)
+        vector = self._normalize(embedding)
+        now = time.monotonic()
+
+        with self._lock:
+            best_id, best_score = None, self.similarity_threshold
+            for entry_id in list(self._scopes.get(scope, ())):
+                _, cached_vector, _, expires_at = self._entries[entry_id]
+                if expires_at and expires_at < now:
+                    self._remove(entry_id)
+                    continue
+
+                score = float(np.dot(vector, cached_vector))
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+
+            if best_id is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(best_id)
+            self.hits += 1
+            return self._entries[best_id][2]
+
+    def set(self, collection_ids: Iterable[str], question: str, embedding: List[float], answer: Dict) -> None:
+        if self.max_size <= 0:
+            return
+
+        scope = self._scope(collection_ids, question)
+        expires_at = time.monotonic() + self.ttl if self.ttl > 0 else 0.0
+
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+
+            self._entries[entry_id] = (scope, self._normalize(embedding), answer, expires_at)
+            self._scopes.setdefault(scope, set()).add(entry_id)
+
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, collection_id: str) -> None:
+        """
+        Drop every answer built from the collection.
+        """
+        with self._lock:
+            for scope in [scope for scope in self._scopes if collection_id in scope[0]]:
+                for entry_id in list(self._scopes[scope]):
+                    self._remove(entry_id)
+                    self.invalidations += 1
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class EmbeddingStore:
+    """
+    Persistent, content-addressed store of document embeddings on local disk, shared by every collection.
+
+    Keys are the SHA-256 of the embedded text, one directory per embedding model:
+        - vectors.f32: float32 rows, append-only, read through a memory map.
+        - keys.bin: 32-byte digest of row i at offset 32 * i, the compact index (loaded into a dict).
+        - meta.json: vector dimension.
+    Rows are appended under a file lock, vectors before keys, so several processes can share the directory and
+    a crash never leaves a key without its vector.
+    """
+
+    DIGEST_SIZE = 32
+
+    def __init__(self, path: str, model_name: str):
+        """
+        Parameters:
+            - path (str): Root directory of the store.
+            - model_name (str): Embedding model, vectors of different models never mix.
+        """
+        self.model_name = model_name
+        self.directory = os.path.join(path, re.sub(r"[^\w.-]+", "_", model_name))
+        os.makedirs(self.directory, exist_ok=True)
+
+        self._vectors_path = os.path.join(self.directory, "vectors.f32")
+        self._keys_path = os.path.join(self.directory, "keys.bin")
+        self._meta_path = os.path.join(self.directory, "meta.json")
+        self._lock_path = os.path.join(self.directory, ".lock")
+
+        self.dimension: Optional[int] = None
+        self._rows: Dict[bytes, int] = {}
+        self._keys_size = 0
+        self._vectors: Optional[np.memmap] = None
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(text: str) -> bytes:
+        return hashlib.sha256(text.encode()).digest()
+
+    def _refresh(self) -> None:
+        """
+        Load the keys appended since the last call (by this or another process).
+        """
+        if self.dimension is None and os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                self.dimension = json.load(f)["dimension"]
+
+        if not os.path.exists(self._keys_path):
+            return
+
+        size = os.path.getsize(self._keys_path)
+        size -= size % self.DIGEST_SIZE
+        if size <= self._keys_size:
+            return
+
+        with open(self._keys_path, "rb") as f:
+            f.seek(self._keys_size)
+            data = f.read(size - self._keys_size)
+
+        row = self._keys_size // self.DIGEST_SIZE
+        for offset in range(0, len(data), self.DIGEST_SIZE):
+            self._rows[data[offset:offset + self.DIGEST_SIZE]] = row
+            row += 1
+        self._keys_size = size
+
+    def _vector_rows(self, min_rows: int) -> np.memmap:
+        if self._vectors is None or len(self._vectors) < min_rows:
+            # Only rows with a key, the vectors file may end with an interrupted append
+            rows = self._keys_size // self.DIGEST_SIZE
+            self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(rows, self.dimension))
+        return self._vectors
+
+    def get_many(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """
+        Stored embedding of each text, None when it has never been embedded with this model.
+        """
+        keys = [self.make_key(text) for text in texts]
+        with self._lock:
+            self._refresh()
+            rows = [self._rows.get(key) for key in keys]
+
+            found = [row for row in rows if row is not None]
+            vectors = self._vector_rows(max(found) + 1) if found else None
+
+        embeddings = [vectors[row].tolist() if row is not None else None for row in rows]
+        self.hits += len(found)
+        self.misses += len(rows) - len(found)
+        return embeddings
+
+    def put_many(self, texts: List[str], embeddings: List[List[float]]) -> None:
+        if not texts:
+            return
+
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        keys = [self.make_key(text) for text in texts]
+
+        with self._lock, open(self._lock_path, "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self._refresh()
+                if self.dimension is None:
+                    self.dimension = matrix.shape[1]
+                    with open(self._meta_path, "w") as f:
+                        json.dump({"dimension": self.dimension, "model_name": self.model_name}, f)
+                elif matrix.shape[1] != self.dimension:
+                    raise ValueError(f"Embedding dimension {matrix.shape[1]} != store dimension {self.dimension}")
+
+                new = [i for i, key in enumerate(keys) if key not in self._rows]
+                if not new:
+                    return
+
+                # Drop vectors of a previous append interrupted before its keys were written
+                rows = self._keys_size // self.DIGEST_SIZE
+                with open(self._vectors_path, "ab") as f:
+                    f.truncate(rows * self.dimension * 4)
+                    f.write(matrix[new].tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+
+                with open(self._keys_path, "ab") as f:
+                    f.write(b"".join(keys[i] for i in new))
+                    f.flush()
+                    os.fsync(f.fileno())
+
+                self._refresh()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._rows),
+            "dimension": self.dimension,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class ContextCache:
+    """
+    Persistent cache of the contexts written by the LLM for contextual retrieval, on local disk.
+
+    Keys are (SHA-256 of the document, SHA-256 of the chunk), one directory per LLM model and one JSON-lines file
+    per document, appended under a file lock so several processes can share the directory.
+    """
+
+    def __init__(self, path: str, model_name: str):
+        """
+        Parameters:
+            - path (str): Root directory of the cache.
+            - model_name (str): LLM writing the contexts, contexts of different models never mix.
+        """
+        self.model_name = model_name
+        self.directory = os.path.join(path, re.sub(r"[^\w.-]+", "_", model_name))
+        os.makedirs(self.directory, exist_ok=True)
+
+        self._lock_path = os.path.join(self.directory, ".lock")
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(text: str) -> str:
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def _document_path(self, document_key: str) -> str:
+        return os.path.join(self.directory, f"{document_key}.jsonl")
+
+    def load(self, document_key: str) -> Dict[str, str]:
+        """
+        Contexts of the chunks of a document, by chunk key.
+        """
+        contexts = {}
+        path = self._document_path(document_key)
+        if not os.path.exists(path):
+            return contexts
+
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except json.JSONDecodeError:
+                    # Line of an interrupted append
+                    continue
+                contexts[item["chunk"]] = item["context"]
+        return contexts
+
+    def put(self, document_key: str, chunk_key: str, context: str) -> None:
+        line = json.dumps({"chunk": chunk_key, "context": context}, ensure_ascii=False).encode() + b"\n"
+        with self._lock, open(self._lock_path, "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(self._document_path(document_key), "a+b") as f:
+                    # Terminate the line of an interrupted append, so it does not swallow this one
+                    if f.tell():
+                        f.seek(-1, os.SEEK_END)
+                        if f.read(1) != b"\n":
+                            line = b"\n" + line
+                    f.write(line)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class RerankCache:
+    """
+    Bounded LRU cache of rerank scores with TTL eviction.
+
+    Keys are the rerank model name, the NFC-normalized question and the paragraph id (SHA-256 of the paragraph
+    content), so a paragraph is scored once per question whatever the collection it was found in.
+    """
+
+    def __init__(self, max_size: int = 100000, ttl: float = 86400):
+        """
+        Parameters:
+            - max_size (int): Maximum number of scores kept, 0 disables the cache.
+            - ttl (float): Seconds a score stays valid, <= 0 to never expire.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._items: OrderedDict[str, Tuple[float, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model_name: str, question: str, paragraph_id: str) -> str:
+        normalized = unicodedata.normalize("NFC", question.strip())
+        return hashlib.sha256(f"{model_name}\x00{normalized}\x00{paragraph_id}".encode()).hexdigest()
+
+    def get_many(self, model_name: str, question: str, paragraph_ids: List[str]) -> List[Optional[float]]:
+        keys = [self.make_key(model_name, question, paragraph_id) for paragraph_id in paragraph_ids]
+        now = time.monotonic()
+
+        scores = []
+        with self._lock:
+            for key in keys:
+                item = self._items.get(key)
+                if item is not None and item[0] and item[0] < now:
+                    del self._items[key]
+                    item = None
+
+                if item is None:
+                    scores.append(None)
+                    self.misses += 1
+                else:
+                    self._items.move_to_end(key)
+                    scores.append(item[1])
+                    self.hits += 1
+        return scores
+
+    def set_many(self, model_name: str, question: str, paragraph_ids: List[str], scores: List[float]) -> None:
+        if self.max_size <= 0:
+            return
+
+        expires_at = time.monotonic() + self.ttl if self.ttl > 0 else 0.0
+        with self._lock:
+            for paragraph_id, score in zip(paragraph_ids, scores):
+                key = self.make_key(model_name, question, paragraph_id)
+                self._items[key] = (expires_at, score)
+                self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._items),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -1,44 +1,64 @@
-import concurrent.futures
 import glob
+import json
+import logging
 import os
-from concurrent.futures import ThreadPoolExecutor
-from typing import Sequence
+import random
+from functools import lru_cache
+from typing import TYPE_CHECKING, BinaryIO, Iterator, List, Optional, Sequence, Tuple
 
 import tiktoken
-from common.context_retrieval import invoke
+from common.articles import annotate_articles
+from common.context_retrieval import ContextGenerator
+from common.metrics import timed
 from common.sentence_splitter import CustomSentenceSplitter
-from llama_index.core import SimpleDirectoryReader
+from llama_index.core import Document
 from llama_index.core.ingestion import IngestionPipeline
 from llama_index.core.node_parser import MarkdownNodeParser
 from llama_index.core.schema import BaseNode, MetadataMode
 
+if TYPE_CHECKING:
+    from common.jobs import IndexJob
 
-def chunker(folder_path,
+# Same as SimpleDirectoryReader: only file_path goes into the embedding and LLM content
+EXCLUDED_METADATA_KEYS = ["file_name", "file_type", "file_size"]
+
+# Characters of a chunk in its sampled log record
+LOG_PREVIEW_CHARS = 200
+
+logger = logging.getLogger(__name__)
+
+
+def chunker(folder_path: Optional[str] = None,
             min_chunk_size: int = 256,
             max_chunk_size: int = 1024,
             context_retrieval: bool = False,
-            debug: bool = False
+            log_sample_rate: float = 0.0,
+            files: Optional[Sequence[Tuple[str, BinaryIO]]] = None,
+            context_generator: Optional[ContextGenerator] = None,
+            job: Optional["IndexJob"] = None,
             ):
     """
-    Chunk the documents in the folder_path into smaller chunks of size chunk_size.
+    Chunk the documents in the folder_path (or the files given as (file name, binary stream)) into smaller chunks
+    of size chunk_size.
+
+    Documents are loaded and chunked one at a time, so memory does not grow with the number of files.
 
     Steps:
         1. MarkdownNodeParser: Parse the markdown files into nodes.
         2. Merge small chunks: Merge small chunks that are less than min_size tokens.
         3. CustomSentenceSplitter: Split the chunks into sentences, and add full content of paragraph into metadata.
-        4. Context Retrieval
+        4. Annotate articles: article numbers and chapter of the paragraph of each chunk.
+        5. Context Retrieval (with context_retrieval): context_generator prepends the context of each chunk
+            within its document.
+
+    With the DEBUG log level, a log_sample_rate share of the chunks is logged (one JSON record per chunk).
     """
-    files = sorted(glob.glob(os.path.join(folder_path, "**/*.md"), recursive=True))
-    documents = SimpleDirectoryReader(input_files=files).load_data()
+    if context_retrieval and context_generator is None:
+        raise ValueError("context_retrieval requires a context_generator")
 
     # Markdown Splitter
     splitter = MarkdownNodeParser()
-
     pipeline = IngestionPipeline(transformations=[splitter])
-    chunks = pipeline.run(documents=documents)
-
-    # Merge small chunks
-    chunks = merge_small_chunks(chunks, min_size=min_chunk_size)
 
     # Sentence Splitter
     splitter2 = CustomSentenceSplitter(
@@ -48,30 +68,90 @@ def chunker(folder_path,
         paragraph_separator="\n\n\n",
         secondary_chunking_regex="[^,.;。？！]+[,.;。？！]?",
     )
-    chunks = splitter2(chunks)
 
-    # Context Retrieval
-    if context_retrieval:
-        chunks = process_nodes(chunks, max_workers=5)
+    chunks = []
+    documents = load_documents(folder_path=folder_path, files=files)
+    while True:
+        with timed("index", "read"):
+            document = next(documents, None)
+        if document is None:
+            break
+
+        with timed("index", "parse"):
+            document_chunks = pipeline.run(documents=[document])
 
-    # Debugging
-    if debug:
-        print("Length of chunks:", len(chunks))
-        for chunk in chunks:
-            print("=" * 80)
-            print(f"📏 Tokens: {count_tokens(chunk.get_content())}")
-            print(f"📄 Chunk:\n{chunk.get_content()}")
+        # Merge small chunks (only within the same file)
+        with timed("index", "merge"):
+            document_chunks = merge_small_chunks(document_chunks, min_size=min_chunk_size)
 
-            print("\n🗂️ Metadata:")
-            for key, value in chunk.metadata.items():
-                print(f"  • {key}: {value}")
+        # Article numbers ("Điều N") of the chunks, for the exact article lookup
+        with timed("index", "split"):
+            document_chunks = annotate_articles(splitter2(document_chunks))
 
-            print(f"\n🔗 Relationships: {chunk.relationships}")
-            print("=" * 80)
+        # Context Retrieval, while the document is at hand
+        if context_retrieval:
+            with timed("index", "context"):
+                document_chunks = context_generator.contextualize(document, document_chunks, job=job)
+
+        chunks.extend(document_chunks)
+
+    logger.info("Chunked into %d chunks", len(chunks))
+    if log_sample_rate > 0 and logger.isEnabledFor(logging.DEBUG):
+        log_chunk_sample(chunks, log_sample_rate)
 
     return chunks
 
 
+def log_chunk_sample(chunks: Sequence[BaseNode], sample_rate: float) -> None:
+    """
+    Log a random sample_rate share of the chunks, one JSON record each (tokens, position, preview), instead of
+    printing every chunk.
+    """
+    sample = [chunk for chunk in chunks if random.random() < sample_rate]
+    token_counts = count_tokens_batch([chunk.get_content() for chunk in sample])
+    for chunk, tokens in zip(sample, token_counts):
+        record = {
+            "chunk_id": chunk.node_id,
+            "tokens": tokens,
+            "file_path": chunk.metadata.get("file_path"),
+            "header_path": chunk.metadata.get("header_path"),
+            "articles": chunk.metadata.get("articles"),
+            "preview": chunk.get_content(metadata_mode=MetadataMode.NONE)[:LOG_PREVIEW_CHARS],
+        }
+        logger.debug(json.dumps(record, ensure_ascii=False))
+
+
+def load_documents(folder_path: Optional[str] = None,
+                   files: Optional[Sequence[Tuple[str, BinaryIO]]] = None,
+                   ) -> Iterator[Document]:
+    """
+    Yield one Document per Markdown file of the folder_path, or per (file name, binary stream) of files.
+    """
+    if files is not None:
+        for file_name, stream in files:
+            stream.seek(0)
+            yield to_document(file_name, stream.read())
+        return
+
+    for file_path in sorted(glob.glob(os.path.join(folder_path, "**/*.md"), recursive=True)):
+        with open(file_path, "rb") as f:
+            yield to_document(file_path, f.read())
+
+
+def to_document(file_path: str, content: bytes) -> Document:
+    return Document(
+        text=content.decode("utf-8", errors="ignore"),
+        metadata={
+            "file_path": file_path,
+            "file_name": os.path.basename(file_path),
+            "file_type": "text/markdown",
+            "file_size": len(content),
+        },
+        excluded_embed_metadata_keys=list(EXCLUDED_METADATA_KEYS),
+        excluded_llm_metadata_keys=list(EXCLUDED_METADATA_KEYS),
+    )
+
+
 def merge_nodes(node1, node2):
     return type(node1)(
         text=node1.get_content(metadata_mode=MetadataMode.NONE) + "\n\n" + node2.get_content(metadata_mode=MetadataMode.NONE),
@@ -81,16 +161,37 @@ def merge_nodes(node1, node2):
 
 
 def merge_small_chunks(nodes: Sequence[BaseNode], min_size=100):
+    """
+    Merge every node smaller than min_size tokens into its previous or next node of the same file
+    (the smaller one), until it is big enough or has no neighbour left to merge with.
+
+    Single pass: merged nodes are appended to the output, so "previous" is always the last output node.
+    Token counts are computed once per node and recounted only for merged nodes. The stage is tokenizer-bound:
+    counting every header section once is most of its time.
+    """
     nodes = list(nodes)
-    i = 0
+    sizes = count_tokens_batch([node.get_content(metadata_mode=MetadataMode.NONE) for node in nodes])
+
+    merged: List[BaseNode] = []
+    merged_sizes: List[Optional[int]] = []  # None: not counted yet since the last merge into the node
 
-    while i < len(nodes):
-        curr_node = nodes[i]
-        curr_size = count_tokens(curr_node.get_content(metadata_mode=MetadataMode.NONE))
+    def size_of_last() -> int:
+        if merged_sizes[-1] is None:
+            merged_sizes[-1] = count_tokens(merged[-1].get_content(metadata_mode=MetadataMode.NONE))
+        return merged_sizes[-1]
+
+    i = 0
+    curr_node, curr_size = None, 0
+    while True:
+        if curr_node is None:
+            if i == len(nodes):
+                break
+            curr_node, curr_size = nodes[i], sizes[i]
+            i += 1
 
         if curr_size < min_size:
-            prev_node = nodes[i - 1] if i > 0 else None
-            next_node = nodes[i + 1] if i < len(nodes) - 1 else None
+            prev_node = merged[-1] if merged else None
+            next_node = nodes[i] if i < len(nodes) else None
             prev_mergeable = (
                 prev_node
                 and prev_node.metadata["file_name"] == curr_node.metadata["file_name"]
@@ -100,54 +201,22 @@ def merge_small_chunks(nodes: Sequence[BaseNode], min_size=100):
                 and next_node.metadata["file_name"] == curr_node.metadata["file_name"]
             )
 
-            if prev_mergeable and next_mergeable:
-                prev_size = count_tokens(prev_node.get_content(metadata_mode=MetadataMode.NONE))
-                next_size = count_tokens(next_node.get_content(metadata_mode=MetadataMode.NONE))
-                if prev_size <= next_size:
-                    nodes[i - 1] = merge_nodes(prev_node, curr_node)
-                    nodes.pop(i)
-                    continue
-                else:
-                    nodes[i] = merge_nodes(curr_node, next_node)
-                    nodes.pop(i + 1)
-                    continue
-            elif prev_mergeable:
-                nodes[i - 1] = merge_nodes(prev_node, curr_node)
-                nodes.pop(i)
+            if prev_mergeable and (not next_mergeable or size_of_last() <= sizes[i]):
+                merged[-1] = merge_nodes(prev_node, curr_node)
+                merged_sizes[-1] = None
+                curr_node = None
                 continue
             elif next_mergeable:
-                nodes[i] = merge_nodes(curr_node, next_node)
-                nodes.pop(i + 1)
+                curr_node = merge_nodes(curr_node, next_node)
+                curr_size = count_tokens(curr_node.get_content(metadata_mode=MetadataMode.NONE))
+                i += 1
                 continue
 
-        i += 1
-
-    return nodes
-
+        merged.append(curr_node)
+        merged_sizes.append(curr_size)
+        curr_node = None
 
-def process_node(node):
-    node.text = invoke(
-        file_name=node.metadata['file_path'],
-        whole_document=node.metadata,
-        chunk_content=node.get_content().strip(),
-        language="Vietnamese"
-    )
-    return node
-
-
-def process_nodes(nodes, max_workers: int = 4):
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_node = {executor.submit(process_node, node): node for node in nodes}
-
-        processed_nodes = []
-        for future in concurrent.futures.as_completed(future_to_node):
-            try:
-                processed_node = future.result()
-                processed_nodes.append(processed_node)
-            except Exception as e:
-                print(f"Generated an exception: {e}")
-
-    return processed_nodes
+    return merged
 
 
 # Common
@@ -156,10 +225,21 @@ def read_file(file_path):
         with open(file_path, 'r', encoding='utf-8') as file:
             return file.read()
     except Exception as e:
-        print(f"Error reading file {file_path}: {e}")
+        logger.warning("Error reading file %s: %s", file_path, e)
         return None
 
 
+@lru_cache(maxsize=None)
+def get_encoding(encoding_name: str = "cl100k_base") -> tiktoken.Encoding:
+    return tiktoken.get_encoding(encoding_name)
+
+
 def count_tokens(text: str, encoding_name: str = "cl100k_base") -> int:
-    encoding = tiktoken.get_encoding(encoding_name)
-    return len(encoding.encode(text))
+    return len(get_encoding(encoding_name).encode(text))
+
+
+def count_tokens_batch(texts: List[str], encoding_name: str = "cl100k_base") -> List[int]:
+    # One encode per text: Encoding.encode_batch submits every text to a thread pool, which costs more than it
+    # saves on the short texts counted here (slower than this loop on bench_chunking.py)
+    encoding = get_encoding(encoding_name)
+    return [len(encoding.encode(text)) for text in texts]
@@ -1,6 +1,20 @@
-import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Iterator, List, Optional, Sequence
+
+import openai
+import tiktoken
+from common.cache import ContextCache
+from llama_index.core.schema import BaseNode, Document, MetadataMode
 from openai import OpenAI
 
+if TYPE_CHECKING:
+    from common.jobs import IndexJob
+
 ########################################################################################
 # Add Contextual Retrieval
 __DESCRIPTION = """
@@ -11,23 +25,15 @@ Phương pháp: Thêm một ngữ cảnh ngắn gọn để định vị phần
 Độ dài: 50-100 tokens
 """
 
-_PROMPT = """
-<filename>
-{FILE_NAME}
-</filename>
-<document> 
-{WHOLE_DOCUMENT}
-</document> 
-Here is the chunk we want to situate within the whole document:
-<chunk> 
-{CHUNK_CONTENT}
-</chunk> 
+# Same for every chunk of a document (window), so llama-server reuses its KV cache of the document
+_SYSTEM_PROMPT = """
+Here is a document, you will be asked to situate chunks of it within the whole document.
 
 Example response:
 <example_response>
 SUMMARY CONTEXT: Summary context of chunk in the document in {LANGUAGE}
 
-HEADER: 
+HEADER:
 - <policy_full_name>/<file_name>/<header_of_chunk_1>/<subheader_of_chunk_1>/.../<title_of_chunk_1><subtitle_of_chunk_1>
 - <policy_full_name>/<file_name>/<header_of_chunk_2>/<subheader_of_chunk_2>/.../<title_of_chunk_2><subtitle_of_chunk_2>
 ...
@@ -35,39 +41,270 @@ HEADER:
 KEYWORDS: <keyword1>, <keyword2>, <keyword3>, ...
 </example_response>
 
+<filename>
+{FILE_NAME}
+</filename>
+<document>
+{WHOLE_DOCUMENT}
+</document>
+""".strip()
+
+_CHUNK_PROMPT = """
+Here is the chunk we want to situate within the whole document:
+<chunk>
+{CHUNK_CONTENT}
+</chunk>
+
 Please give a short succinct context to situate this chunk within the overall document for the purposes of improving search retrieval of the chunk.
 Add headers/sub-herders of chunk in document.
 Add keywords of the chunk.
-Answer only with the succinct context and nothing else. 
+Answer only with the succinct context and nothing else, skip the greeting or introduction.
 """.strip()
 
+# Markdown header line, where a document can be cut into windows
+_SECTION_SPLIT = re.compile(r"^(?=#)", re.MULTILINE)
+
+# Worth retrying: throttled, server overloaded or unreachable
+_RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+
+
+class AdaptiveLimiter:
+    """
+    Concurrency limit of the LLM calls that adapts to the rate the server accepts (AIMD):
+    halved when a call is throttled, raised by one after a full limit of successful calls, up to max_limit.
+    """
+
+    def __init__(self, max_limit: int):
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self._active = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        with self._condition:
+            while self._active >= self.limit:
+                self._condition.wait()
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._active -= 1
+                self._condition.notify_all()
+
+    def on_success(self) -> None:
+        with self._condition:
+            self._successes += 1
+            if self.limit < self.max_limit and self._successes >= self.limit:
+                self.limit += 1
+                self._successes = 0
+                self._condition.notify_all()
 
-def invoke(file_name: str, whole_document: str, chunk_content: str, language: str) -> str:
-    client = OpenAI(
-        base_url=os.getenv("LLM_GATEWAY_URL"),
-        api_key=os.getenv("LLM_LAB_API_KEY"),
-    )
+    def on_throttled(self) -> None:
+        with self._condition:
+            self.limit = max(1, self.limit // 2)
+            self._successes = 0
 
-    completion = client.chat.completions.create(
-        model=os.getenv("LLM_MODEL"),
-        messages=[
+
+class ContextGenerator:
+    """
+    Contextual retrieval stage of the chunker: prepend to every chunk a short context, written by the LLM,
+    that situates the chunk within its document.
+
+        - The prompt starts with the document, identical for all its chunks, and ends with the chunk, so the LLM
+          server reuses the KV cache of the document prefix. Documents larger than document_max_tokens are cut at
+          Markdown headers into windows, each chunk is situated within its window.
+        - Chunks keep their order; calls run concurrently under an AdaptiveLimiter and are retried with
+          exponential backoff, a chunk that still fails fails the indexing instead of being dropped.
+        - Contexts are cached on disk by (document, chunk, model), so re-indexing only calls the LLM for
+          new chunks.
+    """
+
+    def __init__(
+            self,
+            client: OpenAI,
+            model_name: str,
+            language: str = "Vietnamese",
+            max_concurrency: int = 8,
+            max_retries: int = 5,
+            backoff: float = 1.0,
+            max_backoff: float = 60.0,
+            document_max_tokens: int = 24000,
+            cache: Optional[ContextCache] = None,
+    ):
+        """
+        Parameters:
+            - client (OpenAI): LLM client, its own retries should be disabled (max_retries=0).
+            - model_name (str): LLM writing the contexts.
+            - language (str): Language of the contexts.
+            - max_concurrency (int): Maximum number of LLM calls at the same time.
+            - max_retries (int): Retries of a throttled or failed call.
+            - backoff (float): Seconds before the first retry, doubled at every retry, up to max_backoff.
+            - document_max_tokens (int): Largest document (window) sent with each chunk.
+            - cache (ContextCache): Optional persistent cache of the contexts.
+        """
+        self.client = client
+        self.model_name = model_name
+        self.language = language
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.document_max_tokens = document_max_tokens
+        self.cache = cache
+
+        self.max_concurrency = max_concurrency
+        self.limiter = AdaptiveLimiter(max_concurrency)
+
+    def contextualize(
+            self,
+            document: Document,
+            nodes: Sequence[BaseNode],
+            job: Optional["IndexJob"] = None,
+    ) -> List[BaseNode]:
+        """
+        Prepend its context to the text of every node (chunk) of the document, in place, and return the nodes
+        in the same order.
+        """
+        nodes = list(nodes)
+        if not nodes:
+            return nodes
+
+        file_name = document.metadata.get("file_path", "")
+        windows = split_document(document.get_content(metadata_mode=MetadataMode.NONE), self.document_max_tokens)
+        chunk_contents = [node.get_content(metadata_mode=MetadataMode.NONE).strip() for node in nodes]
+
+        document_key = ContextCache.make_key(document.get_content(metadata_mode=MetadataMode.NONE))
+        chunk_keys = [ContextCache.make_key(content) for content in chunk_contents]
+        cached = self.cache.load(document_key) if self.cache is not None else {}
+
+        def generate(window: str, chunk_content: str, chunk_key: str) -> str:
+            if job is not None and job.cancelled:
+                return ""
+            context = self._invoke(file_name, window, chunk_content)
+            if self.cache is not None:
+                self.cache.put(document_key, chunk_key, context)
+            return context
+
+        executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="context")
+        try:
+            # Submitted in document order, so the chunks of a window run while its prefix is cached
+            futures = []
+            for window, chunk_content, chunk_key in zip(
+                    locate_windows(windows, chunk_contents), chunk_contents, chunk_keys,
+            ):
+                if chunk_key in cached:
+                    futures.append(None)
+                else:
+                    futures.append(executor.submit(generate, window, chunk_content, chunk_key))
+
+            for node, future, chunk_content, chunk_key in zip(nodes, futures, chunk_contents, chunk_keys):
+                if future is None:
+                    context = cached[chunk_key]
+                    if self.cache is not None:
+                        self.cache.hits += 1
+                    if job is not None:
+                        job.advance(contexts_cached=1)
+                else:
+                    context = future.result()
+                    if self.cache is not None:
+                        self.cache.misses += 1
+                    if job is not None:
+                        job.advance(contexts_generated=1)
+
+                node.text = f"{context}\n\nCONTENT:\n\n{chunk_content}".strip()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        return nodes
+
+    def _invoke(self, file_name: str, window: str, chunk_content: str) -> str:
+        messages = [
             {
                 "role": "system",
-                "content": _PROMPT.format(
+                "content": _SYSTEM_PROMPT.format(
                     FILE_NAME=file_name,
-                    WHOLE_DOCUMENT=whole_document,
-                    CHUNK_CONTENT=chunk_content,
-                    LANGUAGE=language,
+                    WHOLE_DOCUMENT=window,
+                    LANGUAGE=self.language,
                 ),
             },
             {
                 "role": "user",
-                "content": "Please give a short succinct context, skip the greeting or introduction, just only the content.",
+                "content": _CHUNK_PROMPT.format(CHUNK_CONTENT=chunk_content),
             },
-        ],
-    )
+        ]
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.limiter.slot():
+                    completion = self.client.chat.completions.create(model=self.model_name, messages=messages)
+                self.limiter.on_success()
+                return completion.choices[0].message.content.strip()
+            except _RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                if isinstance(e, openai.RateLimitError):
+                    self.limiter.on_throttled()
+                time.sleep(self._retry_delay(e, attempt))
+
+    def _retry_delay(self, error: Exception, attempt: int) -> float:
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                pass
+
+        delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+def split_document(text: str, max_tokens: int, encoding_name: str = "cl100k_base") -> List[str]:
+    """
+    The whole document when it has at most max_tokens tokens, otherwise consecutive windows of at most max_tokens
+    tokens cut at Markdown headers (at lines for a single larger section).
+    """
+    encoding = tiktoken.get_encoding(encoding_name)
+    if len(encoding.encode(text)) <= max_tokens:
+        return [text]
+
+    pieces = []
+    sections = [section for section in _SECTION_SPLIT.split(text) if section]
+    for section, tokens in zip(sections, encoding.encode_batch(sections)):
+        if len(tokens) <= max_tokens:
+            pieces.append((section, len(tokens)))
+        else:
+            lines = section.splitlines(keepends=True)
+            pieces.extend(zip(lines, (len(line_tokens) for line_tokens in encoding.encode_batch(lines))))
+
+    windows, window, window_tokens = [], [], 0
+    for piece, tokens in pieces:
+        if window and window_tokens + tokens > max_tokens:
+            windows.append("".join(window))
+            window, window_tokens = [], 0
+        window.append(piece)
+        window_tokens += tokens
+    if window:
+        windows.append("".join(window))
+
+    return windows
+
 
-    answer = completion.choices[0].message.content
+def locate_windows(windows: List[str], chunk_contents: List[str]) -> List[str]:
+    """
+    Window of each chunk (chunks in document order): the first window, from the window of the previous chunk,
+    holding the first line of the chunk.
+    """
+    located = []
+    current = 0
+    for content in chunk_contents:
+        first_line = next((line.strip() for line in content.splitlines() if line.strip()), "")[:200]
+        for i in range(current, len(windows)):
+            if first_line in windows[i]:
+                current = i
+                break
+        located.append(windows[current])
 
-    final_chunk = f"{answer}\n\nCONTENT:\n\n{chunk_content}"
-    return final_chunk.strip()
+    return located
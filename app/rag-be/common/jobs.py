@@ -0,0 +1,204 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    """Raised inside a running job once it has been cancelled."""
+
+
+class IndexJob:
+    """
+    State and progress of one indexing job.
+
+    The indexing code reports progress through `advance`, which is also where a cancelled job stops.
+    """
+
+    def __init__(self, collection: dict):
+        self.id = uuid.uuid4().hex
+        self.collection = collection
+
+        self.status = "queued"  # queued, running, succeeded, failed, cancelled
+        self.stage = "queued"  # queued, chunking, embedding, done
+        self.error: Optional[str] = None
+
+        self.chunks_produced = 0
+        self.contexts_generated = 0
+        self.contexts_cached = 0
+        self.chunks_unchanged = 0
+        self.chunks_embedded = 0
+        self.embeddings_cached = 0
+        self.embeddings_computed = 0
+        self.points_upserted = 0
+        self.points_deleted = 0
+
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._embedding_started_at: Optional[float] = None
+
+        self._cancel_event = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel_event.is_set()
+
+    def set_stage(self, stage: str) -> None:
+        self.check_cancelled()
+        self.stage = stage
+        if stage == "embedding":
+            self._embedding_started_at = time.time()
+
+    def advance(
+            self,
+            chunks_produced: int = 0,
+            contexts_generated: int = 0,
+            contexts_cached: int = 0,
+            chunks_unchanged: int = 0,
+            chunks_embedded: int = 0,
+            embeddings_cached: int = 0,
+            embeddings_computed: int = 0,
+            points_upserted: int = 0,
+            points_deleted: int = 0,
+    ) -> None:
+        self.chunks_produced += chunks_produced
+        self.contexts_generated += contexts_generated
+        self.contexts_cached += contexts_cached
+        self.chunks_unchanged += chunks_unchanged
+        self.chunks_embedded += chunks_embedded
+        self.embeddings_cached += embeddings_cached
+        self.embeddings_computed += embeddings_computed
+        self.points_upserted += points_upserted
+        self.points_deleted += points_deleted
+        self.check_cancelled()
+
+    def check_cancelled(self) -> None:
+        if self.cancelled:
+            raise JobCancelled(self.id)
+
+    def eta(self) -> Optional[float]:
+        """
+        Seconds left, extrapolated from the upsert rate since embedding started.
+        """
+        if self.status != "running" or not self._embedding_started_at or not self.points_upserted:
+            return None
+        elapsed = time.time() - self._embedding_started_at
+        remaining = self.chunks_produced - self.chunks_unchanged - self.points_upserted
+        return round(elapsed / self.points_upserted * remaining, 1)
+
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "collection": self.collection,
+            "status": self.status,
+            "stage": self.stage,
+            "error": self.error,
+            "cancel_requested": self.cancelled,
+            "progress": {
+                "chunks_produced": self.chunks_produced,
+                "contexts_generated": self.contexts_generated,
+                "contexts_cached": self.contexts_cached,
+                "chunks_unchanged": self.chunks_unchanged,
+                "chunks_embedded": self.chunks_embedded,
+                "embeddings_cached": self.embeddings_cached,
+                "embeddings_computed": self.embeddings_computed,
+                "points_upserted": self.points_upserted,
+                "points_deleted": self.points_deleted,
+                "eta_seconds": self.eta(),
+            },
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobManager:
+    """
+    Run indexing jobs on a bounded worker pool and keep the state of the most recent ones.
+
+    Jobs are added from the request threadpool and evicted when a job is submitted or finishes (worker threads),
+    so every access to them takes the lock; list returns a snapshot.
+    """
+
+    def __init__(self, max_workers: int = 2, max_jobs: int = 100):
+        """
+        Parameters:
+            - max_workers (int): Number of jobs indexing at the same time, the others wait in queue.
+            - max_jobs (int): Number of finished jobs kept for status queries.
+        """
+        self.max_jobs = max_jobs
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="indexer")
+        self._jobs: OrderedDict[str, IndexJob] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, collection: dict, run: Callable[[IndexJob], None]) -> IndexJob:
+        """
+        Queue run(job) on the worker pool and return the job right away.
+
+        run always gets called, even for a job cancelled while queued, so it can clean up what it owns;
+        it stops at its first progress report.
+        """
+        job = IndexJob(collection)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._evict()
+
+        self._executor.submit(self._run, job, run)
+        return job
+
+    def _run(self, job: IndexJob, run: Callable[[IndexJob], None]) -> None:
+        job.status = "running"
+        job.started_at = time.time()
+        try:
+            run(job)
+            job.status = "succeeded"
+            job.stage = "done"
+        except JobCancelled:
+            job.status = "cancelled"
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+            logger.exception("Index job %s of collection %s failed", job.id, job.collection.get("id"))
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                self._evict()
+
+    def _evict(self) -> None:
+        """
+        Drop the oldest finished jobs beyond max_jobs. Must be called with the lock held.
+        """
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished_at is not None]
+        for job_id in finished[: max(0, len(self._jobs) - self.max_jobs)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id: str) -> Optional[IndexJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self) -> List[IndexJob]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def cancel(self, job_id: str) -> Optional[IndexJob]:
+        """
+        Cancel a job: it stops at its next progress report (right away if still queued).
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job.finished_at is None:
+                job._cancel_event.set()
+        return job
+
+    def shutdown(self) -> None:
+        with self._lock:
+            jobs = list(self._jobs.values())
+        for job in jobs:
+            job._cancel_event.set()
+        self._executor.shutdown(wait=False)
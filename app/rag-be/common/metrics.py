@@ -0,0 +1,161 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Upper bounds (seconds) of the histogram buckets, from a cache hit to a long LLM completion
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Stage timings of the current request, for its Server-Timing header (None outside of a request)
+_request_timings: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar("request_timings", default=None)
+
+
+class Histogram:
+    """
+    Prometheus histogram with labels: cumulative bucket counts, sum and count per label values.
+    Thread-safe, indexing stages are observed from the indexer worker threads.
+    """
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str], buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+
+        # label values -> [count per bucket (not cumulative, the last one is +Inf), sum]
+        self._series: Dict[Tuple[str, ...], List] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self) -> List[str]:
+        """
+        Lines of the Prometheus text exposition format.
+        """
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((labels, list(counts), total) for labels, (counts, total) in self._series.items())
+
+        for label_values, counts, total in series:
+            labels = [f'{name}="{_escape(value)}"' for name, value in zip(self.label_names, label_values)]
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_labels = ",".join(labels + [f'le="{le}"'])
+                lines.append(f"{self.name}_bucket{{{bucket_labels}}} {cumulative}")
+            suffix = f"{{{','.join(labels)}}}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+
+STAGE_DURATION = Histogram(
+    "rag_stage_duration_seconds",
+    "Duration of the stages of the retrieval, chat and indexing paths.",
+    ("pipeline", "stage"),
+)
+
+REQUEST_DURATION = Histogram(
+    "rag_http_request_duration_seconds",
+    "Duration of the HTTP requests, until the response headers for streamed responses.",
+    ("method", "route", "status"),
+)
+
+EMBEDDING_BATCH_SIZE = Histogram(
+    "rag_query_embedding_batch_size",
+    "Questions per embedding call of the query-embedding micro-batching.",
+    (),
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128),
+)
+
+
+@contextmanager
+def timed(pipeline: str, stage: str) -> Iterator[None]:
+    """
+    Time the block as a stage of a pipeline ("query" or "index"): observed in rag_stage_duration_seconds and,
+    inside a request, added to its Server-Timing header. Works around awaits, the timing is wall-clock.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_DURATION.observe(elapsed, pipeline, stage)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((stage, elapsed))
+
+
+def render_metrics() -> str:
+    return "\n".join(STAGE_DURATION.render() + REQUEST_DURATION.render() + EMBEDDING_BATCH_SIZE.render()) + "\n"
+
+
+def server_timing(timings: List[Tuple[str, float]], total: float) -> str:
+    """
+    Server-Timing header value, durations in milliseconds. Stages run once per collection (search, paragraphs)
+    appear once per run.
+    """
+    entries = [f"{stage};dur={elapsed * 1000:.1f}" for stage, elapsed in timings]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware: duration of every HTTP request by route, and a Server-Timing header with the stages timed
+    (timed) while handling the request, up to the response headers.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings: List[Tuple[str, float]] = []
+        token = _request_timings.set(timings)
+        start = time.perf_counter()
+        started = False
+
+        async def send_with_timing(message):
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+                elapsed = time.perf_counter() - start
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", server_timing(timings, elapsed).encode("latin-1")))
+                message = {**message, "headers": headers}
+                REQUEST_DURATION.observe(elapsed, scope["method"], _route(scope), str(message["status"]))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_timings.reset(token)
+            if not started:
+                # Failed before any response (the server answers 500)
+                REQUEST_DURATION.observe(time.perf_counter() - start, scope["method"], _route(scope), "500")
+
+
+def _route(scope) -> str:
+    """
+    Path template of the route (/rag/indexer/jobs/{job_id}), so that ids do not make a series each.
+    """
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -1,39 +1,312 @@
+import asyncio
 import datetime
+import json
+import logging
+import time
 import uuid
-from typing import Dict, List
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 
-from llama_index.core import StorageContext, VectorStoreIndex
+import httpx
+from common.bm25 import BM25Encoder
+from common.cache import EmbeddingCache, EmbeddingStore, RerankCache
+from common.jobs import IndexJob
+from common.metrics import EMBEDDING_BATCH_SIZE, timed
+from common.storage import StorageProfile
+from llama_index.core.schema import MetadataMode, NodeWithScore, TextNode
 from llama_index.embeddings.cohere import CohereEmbedding
 from llama_index.embeddings.openai import OpenAIEmbedding
 from llama_index.postprocessor.cohere_rerank import CohereRerank
 from llama_index.postprocessor.tei_rerank import TextEmbeddingInference
 from llama_index.vector_stores.qdrant import QdrantVectorStore
-from qdrant_client import QdrantClient
-from qdrant_client.http.models import Distance, PointStruct, VectorParams
+from qdrant_client import AsyncQdrantClient, QdrantClient
+from qdrant_client.http.models import (
+    Distance,
+    FieldCondition,
+    Filter,
+    Fusion,
+    FusionQuery,
+    MatchAny,
+    MatchValue,
+    Modifier,
+    PayloadSchemaType,
+    PointIdsList,
+    PointStruct,
+    Prefetch,
+    QueryRequest,
+    SearchParams,
+    SparseIndexParams,
+    SparseVector,
+    SparseVectorParams,
+    VectorParams,
+)
+
+logger = logging.getLogger(__name__)
+
+METADATA_COLLECTION = "collection_metadata"
+# Page size of the scroll over collection_metadata
+METADATA_SCROLL_LIMIT = 256
+# Minimum seconds between two reloads of the collection registry triggered by unknown collection ids
+COLLECTION_MISS_REFRESH_INTERVAL = 5.0
+
+# Payload fields read by the retriever, the rest of the payload (node blob, relationships) is never fetched
+SEARCH_PAYLOAD_FIELDS = ["paragraph_id", "file_name", "file_path", "header_path", "paragraph_full_content"]
+
+# Vector names of the collections created by QdrantVectorStore with enable_hybrid=True
+DENSE_VECTOR_NAME = "text-dense"
+SPARSE_VECTOR_NAMES = ["text-sparse-new", "text-sparse"]
+
+# Hybrid search: candidates fetched from each of the dense and sparse searches, per result returned
+HYBRID_PREFETCH_FACTOR = 4
+
+
+class SearchHit:
+    """
+    Lightweight search result: point id, score and the requested payload fields as metadata.
+    """
+    __slots__ = ("node_id", "score", "metadata", "text")
+
+    def __init__(self, node_id: str, score: float, metadata: Dict, text: Optional[str] = None):
+        self.node_id = node_id
+        self.score = score
+        self.metadata = metadata
+        self.text = text
+
+    @classmethod
+    def from_point(cls, point) -> "SearchHit":
+        payload = dict(point.payload or {})
+        text = None
+        node_content = payload.pop("_node_content", None)
+        if node_content is not None:
+            text = json.loads(node_content).get("text")
+        # Scroll records have no score
+        return cls(node_id=str(point.id), score=getattr(point, "score", None), metadata=payload, text=text)
+
+
+class EmbeddingBatcher:
+    """
+    Micro-batching of the query embeddings of concurrent requests: texts queued within max_wait seconds of the
+    first one (or until max_batch_size texts) are embedded in one batched call, each caller gets its own vector.
+
+    The embedding server (llama-server with continuous batching) handles a batch of texts in about the time of
+    a single one, so under load this cuts the number of calls, and the queueing behind them, by the batch size.
+    """
+
+    def __init__(
+            self,
+            embed_batch: Callable[[List[str]], Awaitable[List[List[float]]]],
+            max_batch_size: int = 32,
+            max_wait: float = 0.002,
+    ):
+        """
+        Parameters:
+            - embed_batch (callable): Coroutine embedding a list of texts, in order.
+            - max_batch_size (int): Texts sent at most in one call, a full batch is sent right away.
+            - max_wait (float): Seconds the first text of a batch waits for others.
+        """
+        self.embed_batch = embed_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+
+    async def embed(self, text: str) -> List[float]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        pending, self._pending = self._pending, []
+        if pending:
+            task = asyncio.ensure_future(self._send(pending))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, pending: List[Tuple[str, asyncio.Future]]) -> None:
+        # The same question asked by concurrent requests is embedded once
+        texts = list(dict.fromkeys(text for text, _ in pending))
+        EMBEDDING_BATCH_SIZE.observe(len(texts))
+        try:
+            embeddings = dict(zip(texts, await self.embed_batch(texts)))
+            for text, future in pending:
+                # Callers cancelled meanwhile (client gone) have no one to receive their vector
+                if not future.done():
+                    future.set_result(embeddings[text])
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            # Cancelled (shutdown) while embedding: the callers are cancelled too instead of waiting forever
+            for _, future in pending:
+                if not future.done():
+                    future.cancel()
 
 
 class EmbedModel:
-    def __init__(self, api_base: str, model_name: str, api_key: str, provider: str = "openai"):
+    def __init__(
+            self,
+            api_base: str,
+            model_name: str,
+            api_key: str,
+            provider: str = "openai",
+            http_client: Optional[httpx.Client] = None,
+            async_http_client: Optional[httpx.AsyncClient] = None,
+            cache: Optional[EmbeddingCache] = None,
+            store: Optional[EmbeddingStore] = None,
+            batch_max_size: int = 32,
+            batch_wait: float = 0.0,
+    ):
         self.api_base = api_base
         self.api_key = api_key
         self.model_name = model_name
         self.provider = provider
+        self.http_client = http_client
+        self.async_http_client = async_http_client
+        self.cache = cache
+        self.store = store
+
+        self._embed_model = None
+
+        # Micro-batching of concurrent query embeddings, batch_wait seconds (0 embeds every question on its own).
+        # Cohere embeds queries differently from documents (input_type), they cannot go through the batch API
+        self.batcher = None
+        if batch_wait > 0 and provider == "openai":
+            self.batcher = EmbeddingBatcher(
+                lambda texts: self.get_embed_model().aget_text_embedding_batch(texts),
+                max_batch_size=batch_max_size,
+                max_wait=batch_wait,
+            )
 
     def get_embed_model(self):
-        if self.provider == "openai":
-            return OpenAIEmbedding(api_base=self.api_base, model_name=self.model_name, api_key=self.api_key)
-        if self.provider == "cohere":
-            return CohereEmbedding(model_name=self.model_name,api_key=self.api_key)
+        """
+        Build the embedding client once and reuse it (and its connection pool) for every call.
+        """
+        if self._embed_model is None:
+            if self.provider == "openai":
+                self._embed_model = OpenAIEmbedding(
+                    api_base=self.api_base,
+                    model_name=self.model_name,
+                    api_key=self.api_key,
+                    http_client=self.http_client,
+                    async_http_client=self.async_http_client,
+                )
+            elif self.provider == "cohere":
+                self._embed_model = CohereEmbedding(model_name=self.model_name, api_key=self.api_key)
+        return self._embed_model
+
+    async def aget_query_embedding(self, question: str) -> List[float]:
+        """
+        Embed a question, served from the query-embedding cache when possible.
+        """
+        if self.cache is not None:
+            embedding = await self.cache.get(self.model_name, question)
+            if embedding is not None:
+                return embedding
+
+        if self.batcher is not None:
+            embedding = await self.batcher.embed(question)
+        else:
+            embedding = await self.get_embed_model().aget_query_embedding(question)
+
+        if self.cache is not None:
+            await self.cache.set(self.model_name, question, embedding)
+        return embedding
+
+    async def aget_query_embeddings(self, questions: List[str]) -> List[List[float]]:
+        """
+        Embed several questions, in one batched embedding request for the ones missing from the query-embedding
+        cache (duplicates embedded once).
+        """
+        embeddings: List[Optional[List[float]]] = [None] * len(questions)
+        if self.cache is not None:
+            embeddings = list(
+                await asyncio.gather(*(self.cache.get(self.model_name, question) for question in questions))
+            )
+
+        missing = [question for question, embedding in zip(questions, embeddings) if embedding is None]
+        missing = list(dict.fromkeys(missing))
+        if missing:
+            embed_model = self.get_embed_model()
+            if self.provider == "openai":
+                # Same model for queries and documents: the document batch API embeds the questions in one call
+                computed = await embed_model.aget_text_embedding_batch(missing)
+            else:
+                # Cohere embeds queries differently from documents (input_type)
+                computed = await asyncio.gather(*(embed_model.aget_query_embedding(question) for question in missing))
+            computed = dict(zip(missing, computed))
+
+            if self.cache is not None:
+                await asyncio.gather(
+                    *(self.cache.set(self.model_name, question, embedding) for question, embedding in computed.items())
+                )
+            embeddings = [
+                embedding if embedding is not None else computed[question]
+                for question, embedding in zip(questions, embeddings)
+            ]
+
+        return embeddings
+
+    def get_text_embeddings(self, texts: List[str]) -> Tuple[List[List[float]], int]:
+        """
+        Embed document texts, only sending to the embedding server the ones missing from the persistent
+        embedding store (when configured).
+
+        Returns the embeddings and how many of them came from the store.
+        """
+        if self.store is None:
+            return self.get_embed_model().get_text_embedding_batch(texts), 0
+
+        embeddings = self.store.get_many(texts)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            computed = self.get_embed_model().get_text_embedding_batch([texts[i] for i in missing])
+            self.store.put_many([texts[i] for i in missing], computed)
+            for i, embedding in zip(missing, computed):
+                embeddings[i] = embedding
+
+        return embeddings, len(texts) - len(missing)
 
 
 class RerankModel:
-    def __init__(self, api_base: str, model_name: str, api_key: str, provider: str = "openai"):
+    def __init__(
+            self,
+            api_base: str,
+            model_name: str,
+            api_key: str,
+            provider: str = "openai",
+            async_http_client: Optional[httpx.AsyncClient] = None,
+            cache: Optional[RerankCache] = None,
+    ):
         self.api_base = api_base
         self.api_key = api_key
         self.model_name = model_name
         self.provider = provider
+        self.async_http_client = async_http_client
+        self.cache = cache
+
+        self._rerank_models = {}
 
     def get_rerank_model(self, top_n: int = 5):
+        """
+        Rerank postprocessors are cached per top_n, they are stateless between calls.
+        """
+        if top_n not in self._rerank_models:
+            self._rerank_models[top_n] = self._build_rerank_model(top_n)
+        return self._rerank_models[top_n]
+
+    def _build_rerank_model(self, top_n: int):
         if self.provider == "openai":
             return TextEmbeddingInference(
                 base_url=self.api_base,
@@ -54,10 +327,100 @@ class RerankModel:
             )
         return None
 
+    async def ascore(self, question: str, items: List[Tuple[str, str]]) -> List[float]:
+        """
+        Relevance score of each (paragraph id, text) to the question, served from the rerank cache when possible;
+        the others are scored in one batched call to the cross-encoder.
+        """
+        ids = [item_id for item_id, _ in items]
+        scores = self.cache.get_many(self.model_name, question, ids) if self.cache is not None else [None] * len(ids)
+
+        missing = [i for i, score in enumerate(scores) if score is None]
+        if missing:
+            computed = await self._ascore(question, [items[i][1] for i in missing])
+            if self.cache is not None:
+                self.cache.set_many(self.model_name, question, [ids[i] for i in missing], computed)
+            for i, score in zip(missing, computed):
+                scores[i] = score
+
+        return scores
+
+    async def _ascore(self, question: str, texts: List[str]) -> List[float]:
+        if self.provider == "openai" and self.async_http_client is not None:
+            # TEI /rerank on the shared pool: [{"index": i, "score": s}, ...] sorted by score
+            response = await self.async_http_client.post(
+                f"{self.api_base}/rerank",
+                headers={"Authorization": self.api_key} if self.api_key else None,
+                json={"query": question, "texts": texts},
+            )
+            response.raise_for_status()
+            scores = [0.0] * len(texts)
+            for result in response.json():
+                scores[result["index"]] = float(result["score"])
+            return scores
+
+        nodes = [NodeWithScore(node=TextNode(id_=str(i), text=text)) for i, text in enumerate(texts)]
+        reranked = await self.get_rerank_model(top_n=len(texts)).apostprocess_nodes(nodes, query_str=question)
+        scores = [0.0] * len(texts)
+        for node in reranked:
+            scores[int(node.node.node_id)] = float(node.score or 0.0)
+        return scores
+
 
 class QdrantService:
-    def __init__(self, url: str):
-        self.client = QdrantClient(url=url)
+    def __init__(
+            self,
+            url: str,
+            prefer_grpc: bool = False,
+            grpc_port: int = 6334,
+            timeout: Optional[int] = None,
+            limits: Optional[httpx.Limits] = None,
+            hybrid: bool = False,
+            sparse_encoder: Optional[BM25Encoder] = None,
+    ):
+        """
+        Parameters:
+            - url (str): Qdrant REST url.
+            - prefer_grpc (bool): Use the gRPC transport (grpc_port) instead of REST.
+            - timeout (int): Request timeout in seconds.
+            - limits (httpx.Limits): Connection pool limits of the REST transport.
+            - hybrid (bool): Create new collections with a BM25 sparse vector next to the dense one.
+            - sparse_encoder (BM25Encoder): Sparse encoder of hybrid collections.
+        """
+        kwargs = {}
+        if limits is not None:
+            kwargs["limits"] = limits
+
+        # Sync client for indexing, async client for the request path
+        self.client = QdrantClient(
+            url=url,
+            prefer_grpc=prefer_grpc,
+            grpc_port=grpc_port,
+            timeout=timeout,
+            **kwargs,
+        )
+        self.aclient = AsyncQdrantClient(
+            url=url,
+            prefer_grpc=prefer_grpc,
+            grpc_port=grpc_port,
+            timeout=timeout,
+            **kwargs,
+        )
+
+        self.hybrid = hybrid
+        self.sparse_encoder = sparse_encoder or BM25Encoder()
+
+        # collection name -> (dense vector name, sparse vector name), None for the unnamed dense vector
+        # of non-hybrid collections and for no sparse vector
+        self._vector_names: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
+
+        # Collection registry: collection id -> {id, collection_name, description}, loaded from collection_metadata.
+        # Replaced as a whole on change (copy on write), so readers never see it half updated.
+        self._collections: Optional[Dict[str, Dict]] = None
+        self._collections_loaded_at = 0.0
+        self._collections_lock = asyncio.Lock()
+        self._metadata_ready = False
+        self._refresher: Optional[asyncio.Task] = None
 
     ###
     # Management collections with collection_metadata
@@ -67,22 +430,43 @@ class QdrantService:
         """
         Using collection_metadata to store metadata of all collections.
         """
-        collection_name = "collection_metadata"
-        collections = self.client.get_collections().collections
-        existing = [c.name for c in collections]
+        if self._metadata_ready:
+            return
 
-        if collection_name not in existing:
-            print(f"[+] Creating metadata collection: {collection_name}")
+        if not self.client.collection_exists(METADATA_COLLECTION):
+            logger.info("Creating metadata collection: %s", METADATA_COLLECTION)
             self.client.create_collection(
-                collection_name=collection_name,
+                collection_name=METADATA_COLLECTION,
                 vectors_config=VectorParams(size=1, distance=Distance.COSINE),
             )
         else:
-            print(f"[i] Metadata collection '{collection_name}' already exists.")
+            logger.info("Metadata collection '%s' already exists", METADATA_COLLECTION)
+        self._metadata_ready = True
+
+    async def _ainit_metadata_collection(self):
+        if self._metadata_ready:
+            return
+
+        if not await self.aclient.collection_exists(METADATA_COLLECTION):
+            logger.info("Creating metadata collection: %s", METADATA_COLLECTION)
+            await self.aclient.create_collection(
+                collection_name=METADATA_COLLECTION,
+                vectors_config=VectorParams(size=1, distance=Distance.COSINE),
+            )
+        self._metadata_ready = True
+
+    @staticmethod
+    def _collection_entry(payload: Dict) -> Dict:
+        return {
+            "id": payload.get("id"),
+            "collection_name": payload.get("collection_name"),
+            "description": payload.get("description"),
+            "storage_profile": payload.get("storage_profile"),
+        }
 
     def _add_to_metadata(self, collection: dict):
         """
-        Add new collection to collection_metadata.
+        Add new collection to collection_metadata, and to the collection registry of this process.
 
         Parameters:
             - collection (dict):
@@ -93,7 +477,7 @@ class QdrantService:
         self._init_metadata_collection()
 
         self.client.upsert(
-            collection_name="collection_metadata",
+            collection_name=METADATA_COLLECTION,
             points=[
                 PointStruct(
                     id=str(uuid.uuid4()),
@@ -102,37 +486,81 @@ class QdrantService:
                         "id": collection['id'],
                         "collection_name": collection['collection_name'],
                         "description": collection['description'],
+                        "storage_profile": collection.get('storage_profile'),
                         "created_at": datetime.datetime.now().isoformat()
                     },
                 )
             ]
         )
-        print(f"[+] Added metadata for collection: {collection}")
+        if self._collections is not None:
+            self._collections = {**self._collections, collection['id']: self._collection_entry(collection)}
+        logger.info("Added metadata for collection: %s", collection)
 
-    def get_collections(self) -> List[Dict]:
+    async def start(self, refresh_interval: float = 60.0):
         """
-        Get a list of all collections from collection_metadata with their descriptions.
+        Create collection_metadata if needed, load the collection registry, and reload it every refresh_interval
+        seconds in background (collections indexed by other processes), <= 0 to never reload.
         """
-        self._init_metadata_collection()
+        await self.arefresh_collections()
+        if refresh_interval > 0 and self._refresher is None:
+            self._refresher = asyncio.create_task(self._refresh_collections_forever(refresh_interval))
 
-        results = []
-        response = self.client.scroll(
-            collection_name="collection_metadata",
-            limit=1000,
-            with_payload=True,
-        )
+    async def _refresh_collections_forever(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.arefresh_collections()
+            except Exception:
+                logger.warning("Collection registry refresh failed", exc_info=True)
 
-        for point in response[0]:
-            payload = point.payload
-            results.append(
-                {
-                    "id": payload.get("id"),
-                    "collection_name": payload.get("collection_name"),
-                    "description": payload.get("description")
-                }
-            )
+    async def arefresh_collections(self) -> None:
+        """
+        Reload the collection registry from collection_metadata, page by page.
+        """
+        async with self._collections_lock:
+            await self._ainit_metadata_collection()
 
-        return results
+            collections = {}
+            offset = None
+            while True:
+                points, offset = await self.aclient.scroll(
+                    collection_name=METADATA_COLLECTION,
+                    limit=METADATA_SCROLL_LIMIT,
+                    offset=offset,
+                    with_payload=True,
+                )
+                for point in points:
+                    entry = self._collection_entry(point.payload)
+                    collections[entry["id"]] = entry
+                if offset is None:
+                    break
+
+            self._collections = collections
+            self._collections_loaded_at = time.monotonic()
+
+    async def get_collections(self) -> List[Dict]:
+        """
+        Get a list of all collections from collection_metadata with their descriptions (collection registry).
+        """
+        if self._collections is None:
+            await self.arefresh_collections()
+        return list(self._collections.values())
+
+    async def get_collection(self, collection_id: str) -> Optional[Dict]:
+        """
+        Collection of the registry by id, None when it does not exist.
+
+        An unknown id reloads the registry first (at most every COLLECTION_MISS_REFRESH_INTERVAL seconds),
+        in case the collection was just indexed by another process.
+        """
+        if self._collections is None:
+            await self.arefresh_collections()
+
+        collection = self._collections.get(collection_id)
+        if collection is None and time.monotonic() - self._collections_loaded_at > COLLECTION_MISS_REFRESH_INTERVAL:
+            await self.arefresh_collections()
+            collection = self._collections.get(collection_id)
+        return collection
 
     ###
     # Indexing & Retrieving
@@ -143,41 +571,493 @@ class QdrantService:
             embed_model: EmbedModel,
             data_chunked: list,
             collection: dict,
+            batch_size: int = 64,
+            job: Optional[IndexJob] = None,
+    ):
+        """
+        Index the chunks into a new collection, created with the storage profile of the collection
+        (collection['storage_profile'], see StorageProfile.to_dict; the default profile when missing).
+
+        On failure or cancellation the partially written collection is dropped.
+        """
+        profile = StorageProfile.from_dict(collection.get('storage_profile'))
+
+        try:
+            self._upsert_paragraphs(
+                collection['id'], data_chunked, batch_size=batch_size, on_disk_payload=profile.on_disk_payload,
+            )
+            self._embed_upsert(
+                collection['id'],
+                embed_model,
+                data_chunked,
+                batch_size=batch_size,
+                job=job,
+                hybrid=self.hybrid,
+                profile=profile,
+            )
+            self._create_payload_indexes(collection['id'])
+        except Exception:
+            for collection_name in (collection['id'], self.paragraph_collection_name(collection['id'])):
+                if self.client.collection_exists(collection_name):
+                    self.client.delete_collection(collection_name)
+            raise
+
+        self._add_to_metadata(collection)
+
+        logger.info("Indexing complete with collection name: %s", collection)
+
+    def update_index(
+            self,
+            embed_model: EmbedModel,
+            data_chunked: list,
+            collection: dict,
+            batch_size: int = 64,
+            job: Optional[IndexJob] = None,
     ):
-        vector_store = QdrantVectorStore(
+        """
+        Incrementally re-index the uploaded files into an existing collection.
+
+        Chunk ids are hashes of the file name, header path, text and occurrence of the chunk (see
+        CustomSentenceSplitter), so among the points of the uploaded files:
+            - chunks already stored are kept as they are,
+            - new or changed chunks are embedded and upserted,
+            - stored chunks missing from the new files are deleted.
+        Paragraphs of the uploaded files are diffed the same way in the paragraph store.
+        Points of other files in the collection are not touched.
+
+        On failure or cancellation while upserting, the chunks and paragraphs added so far are deleted, so the
+        collection is left as it was. Once the upserts are done the deletion of the removed chunks is not
+        cancellable.
+        """
+        file_names = sorted({node.metadata["file_name"] for node in data_chunked})
+        stored_ids = self._get_point_ids(
             collection['id'],
-            client=self.client,
-            batch_size=20,
-            enable_hybrid=False,
+            Filter(must=[FieldCondition(key="file_name", match=MatchAny(any=file_names))]),
         )
-        storage_context = StorageContext.from_defaults(
-            vector_store=vector_store,
+
+        nodes_by_id = {node.node_id: node for node in data_chunked}
+        new_nodes = [node for node_id, node in nodes_by_id.items() if node_id not in stored_ids]
+        removed_ids = [point_id for point_id in stored_ids if point_id not in nodes_by_id]
+
+        logger.info(
+            "Update %s: %d new/changed, %d unchanged, %d removed chunks",
+            collection['id'], len(new_nodes), len(nodes_by_id) - len(new_nodes), len(removed_ids),
         )
+        if job is not None:
+            job.advance(chunks_unchanged=len(nodes_by_id) - len(new_nodes))
+
+        # Paragraphs first, so that every stored chunk can find its paragraph
+        paragraph_collection = self.paragraph_collection_name(collection['id'])
+        stored_paragraph_ids = set()
+        if self.client.collection_exists(paragraph_collection):
+            stored_paragraph_ids = self._get_point_ids(
+                paragraph_collection,
+                Filter(must=[FieldCondition(key="file_name", match=MatchAny(any=file_names))]),
+            )
+        paragraph_ids = {self.paragraph_point_id(node) for node in nodes_by_id.values()}
+
+        try:
+            self._upsert_paragraphs(
+                collection['id'], new_nodes, batch_size=batch_size, skip_ids=stored_paragraph_ids,
+            )
+
+            # Keep the layout of the existing collection
+            _, sparse_vector_name = self._parse_vector_names(self.client.get_collection(collection['id']))
+            self._embed_upsert(
+                collection['id'],
+                embed_model,
+                new_nodes,
+                batch_size=batch_size,
+                job=job,
+                hybrid=sparse_vector_name is not None,
+            )
+            self._create_payload_indexes(collection['id'])
+            if job is not None:
+                job.check_cancelled()
+        except Exception:
+            # Only new ids were upserted, nothing stored before was overwritten
+            files_filter = Filter(must=[FieldCondition(key="file_name", match=MatchAny(any=file_names))])
+            added_ids = self._get_point_ids(collection['id'], files_filter) - stored_ids
+            self._delete_points(collection['id'], list(added_ids), batch_size)
+            if self.client.collection_exists(paragraph_collection):
+                added_paragraph_ids = self._get_point_ids(paragraph_collection, files_filter) - stored_paragraph_ids
+                self._delete_points(paragraph_collection, list(added_paragraph_ids), batch_size)
+            raise
+
+        for start in range(0, len(removed_ids), batch_size):
+            batch = removed_ids[start:start + batch_size]
+            self.client.delete(collection_name=collection['id'], points_selector=PointIdsList(points=batch))
+            if job is not None:
+                # Progress only, a cancellation here would leave the update half-applied
+                job.points_deleted += len(batch)
+
+        self._delete_points(paragraph_collection, list(stored_paragraph_ids - paragraph_ids), batch_size)
+
+        logger.info("Update complete with collection name: %s", collection)
+
+    def _delete_points(self, collection_name: str, point_ids: list, batch_size: int = 64) -> None:
+        for start in range(0, len(point_ids), batch_size):
+            batch = point_ids[start:start + batch_size]
+            self.client.delete(collection_name=collection_name, points_selector=PointIdsList(points=batch))
+
+    ###
+    # Paragraph store
+    ###
 
-        VectorStoreIndex(
-            data_chunked,
-            storage_context=storage_context,
-            embed_model=embed_model.get_embed_model(),
+    @staticmethod
+    def paragraph_collection_name(collection_name: str) -> str:
+        """
+        Payload-only collection holding the full paragraphs of the chunks of collection_name.
+        """
+        return f"{collection_name}__paragraphs"
+
+    @staticmethod
+    def paragraph_point_id(node) -> str:
+        """
+        Paragraph reference of a chunk (node or payload dict): the same paragraph in two files is stored twice,
+        so that updating one file never deletes a paragraph of the other.
+        """
+        metadata = node if isinstance(node, dict) else node.metadata
+        return str(uuid.uuid5(uuid.NAMESPACE_OID, f"{metadata.get('file_name')}\x00{metadata.get('paragraph_id')}"))
 
-            show_progress=True,
+    def _upsert_paragraphs(
+            self,
+            collection_name: str,
+            nodes: list,
+            batch_size: int = 64,
+            skip_ids: Optional[set] = None,
+            on_disk_payload: bool = False,
+    ):
+        """
+        Store each paragraph of the nodes once (except skip_ids, already stored), and strip
+        paragraph_full_content from the nodes, which keep only their paragraph reference (file_name, paragraph_id).
+        """
+        paragraph_collection = self.paragraph_collection_name(collection_name)
+        if not self.client.collection_exists(paragraph_collection):
+            self.client.create_collection(
+                collection_name=paragraph_collection,
+                vectors_config=VectorParams(size=1, distance=Distance.COSINE),
+                on_disk_payload=on_disk_payload or None,
+            )
+
+        paragraphs = {}
+        for node in nodes:
+            point_id = self.paragraph_point_id(node)
+            content = node.metadata.pop("paragraph_full_content", None)
+
+            # Neighbour (previous/next/source) infos carry a copy of their metadata, with their paragraph too
+            for related in node.relationships.values():
+                for info in related if isinstance(related, list) else [related]:
+                    if info.metadata:
+                        info.metadata.pop("paragraph_full_content", None)
+            if content is not None and point_id not in paragraphs and point_id not in (skip_ids or ()):
+                paragraphs[point_id] = PointStruct(
+                    id=point_id,
+                    vector=[0.0],
+                    payload={
+                        "file_name": node.metadata.get("file_name"),
+                        "paragraph_id": node.metadata.get("paragraph_id"),
+                        "content": content,
+                    },
+                )
+
+        points = list(paragraphs.values())
+        for start in range(0, len(points), batch_size):
+            with timed("index", "upsert_paragraphs"):
+                self.client.upsert(collection_name=paragraph_collection, points=points[start:start + batch_size])
+
+    async def aget_paragraphs(self, collection_name: str, point_ids: List[str]) -> Dict[str, str]:
+        """
+        Full content of the paragraphs, by paragraph reference, in one bulk lookup.
+        """
+        if not point_ids:
+            return {}
+
+        points = await self.aclient.retrieve(
+            collection_name=self.paragraph_collection_name(collection_name),
+            ids=point_ids,
+            with_payload=["content"],
+            with_vectors=False,
         )
-        self._add_to_metadata(collection)
+        return {str(point.id): point.payload.get("content") for point in points}
 
-        print(f"Indexing complete with collection name: {collection}")
+    def _get_vector_store(self, collection_name: str, hybrid: bool = False) -> QdrantVectorStore:
+        if not hybrid:
+            return QdrantVectorStore(
+                collection_name,
+                client=self.client,
+                batch_size=20,
+                enable_hybrid=False,
+            )
 
-    def get_store_index(self, embed_model: EmbedModel, collection_name: str) -> VectorStoreIndex:
-        vector_store = QdrantVectorStore(
+        # Sparse vectors from the local BM25 encoder, IDF computed by Qdrant
+        return QdrantVectorStore(
             collection_name,
             client=self.client,
             batch_size=20,
-            enable_hybrid=False,
+            enable_hybrid=True,
+            sparse_config=SparseVectorParams(index=SparseIndexParams(), modifier=Modifier.IDF),
+            sparse_doc_fn=self.sparse_encoder.encode_documents,
+            sparse_query_fn=self.sparse_encoder.encode_queries,
         )
 
-        store_index = VectorStoreIndex.from_vector_store(
-            vector_store=vector_store,
-            embed_model=embed_model.get_embed_model(),
+    def _create_collection(self, collection_name: str, size: int, hybrid: bool, profile: StorageProfile):
+        """
+        Create the chunk collection with the vectors, HNSW, quantization and payload storage of the profile,
+        in the layout QdrantVectorStore would create (named dense + BM25 sparse vectors when hybrid).
+        """
+        vectors_config = profile.vector_params(size)
+        sparse_vectors_config = None
+        if hybrid:
+            vectors_config = {DENSE_VECTOR_NAME: vectors_config}
+            sparse_vectors_config = {
+                SPARSE_VECTOR_NAMES[0]: SparseVectorParams(
+                    index=SparseIndexParams(on_disk=profile.on_disk_vectors or None),
+                    modifier=Modifier.IDF,
+                ),
+            }
+
+        self.client.create_collection(
+            collection_name=collection_name,
+            vectors_config=vectors_config,
+            sparse_vectors_config=sparse_vectors_config,
+            hnsw_config=profile.hnsw_config(),
+            quantization_config=profile.quantization_config(),
+            on_disk_payload=profile.on_disk_payload or None,
+        )
+        # Same as QdrantVectorStore, for deleting the nodes of a document
+        self.client.create_payload_index(collection_name, field_name="doc_id", field_schema=PayloadSchemaType.KEYWORD)
+        logger.info("Created collection %s with storage profile %s", collection_name, profile.to_dict())
+
+    def _search_params(self, collection_name: str) -> Optional[SearchParams]:
+        """
+        Search-time options (hnsw_ef, rescoring) of the storage profile of the collection.
+        """
+        collection = (self._collections or {}).get(collection_name)
+        if collection is None:
+            return None
+        return StorageProfile.from_dict(collection.get("storage_profile")).search_params()
+
+    def _create_payload_indexes(self, collection_name: str):
+        """
+        Index the article fields of the chunks for the exact article lookup (no-op when they already exist).
+        """
+        self.client.create_payload_index(collection_name, field_name="articles", field_schema=PayloadSchemaType.INTEGER)
+        self.client.create_payload_index(collection_name, field_name="chapter", field_schema=PayloadSchemaType.KEYWORD)
+
+    def _get_point_ids(self, collection_name: str, scroll_filter: Filter) -> set:
+        point_ids = set()
+        offset = None
+        while True:
+            points, offset = self.client.scroll(
+                collection_name=collection_name,
+                scroll_filter=scroll_filter,
+                limit=1000,
+                offset=offset,
+                with_payload=False,
+                with_vectors=False,
+            )
+            point_ids.update(str(point.id) for point in points)
+            if offset is None:
+                return point_ids
+
+    def _embed_upsert(
+            self,
+            collection_name: str,
+            embed_model: EmbedModel,
+            nodes: list,
+            batch_size: int = 64,
+            job: Optional[IndexJob] = None,
+            hybrid: bool = False,
+            profile: Optional[StorageProfile] = None,
+    ):
+        """
+        Embed and upsert the nodes batch by batch, reporting progress to the job.
+
+        Chunks already embedded once with the same model (in any collection) come from the embedding store.
+        A missing collection is created with the storage profile once the vector size is known (first batch).
+        """
+        vector_store = None
+        cached = 0
+        for start in range(0, len(nodes), batch_size):
+            batch = nodes[start:start + batch_size]
+
+            with timed("index", "embed"):
+                embeddings, batch_cached = embed_model.get_text_embeddings(
+                    [node.get_content(metadata_mode=MetadataMode.EMBED) for node in batch]
+                )
+            for node, embedding in zip(batch, embeddings):
+                node.embedding = embedding
+            cached += batch_cached
+            if job is not None:
+                job.advance(
+                    chunks_embedded=len(batch),
+                    embeddings_cached=batch_cached,
+                    embeddings_computed=len(batch) - batch_cached,
+                )
+
+            with timed("index", "upsert"):
+                if vector_store is None:
+                    if profile is not None and not self.client.collection_exists(collection_name):
+                        self._create_collection(
+                            collection_name, len(embeddings[0]), hybrid=hybrid, profile=profile,
+                        )
+                    vector_store = self._get_vector_store(collection_name, hybrid=hybrid)
+
+                vector_store.add(batch)
+            if job is not None:
+                job.advance(points_upserted=len(batch))
+
+        logger.info("Embeddings: %d from store, %d computed", cached, len(nodes) - cached)
+
+    async def asearch(
+            self,
+            collection_name: str,
+            query_embedding: List[float],
+            limit: int = 5,
+            with_text: bool = False,
+            query_text: Optional[str] = None,
+    ) -> List[SearchHit]:
+        """
+        Vector search returning only SEARCH_PAYLOAD_FIELDS (plus the chunk text when with_text),
+        without fetching nor deserializing llama-index nodes.
+
+        On hybrid collections, with query_text, the dense and the BM25 sparse searches are fused with
+        reciprocal rank fusion in Qdrant: scores are then fusion scores, not cosine similarities.
+        """
+        hits = await self.asearch_batch(
+            collection_name, [query_embedding], limit=limit, with_text=with_text, query_texts=[query_text],
         )
-        return store_index
+        return hits[0]
+
+    async def asearch_batch(
+            self,
+            collection_name: str,
+            query_embeddings: List[List[float]],
+            limit: int = 5,
+            with_text: bool = False,
+            query_texts: Optional[List[Optional[str]]] = None,
+    ) -> List[List[SearchHit]]:
+        """
+        asearch for several queries of the same collection, in one request to the Qdrant batch query API.
+        Returns the hits of each query, in order.
+        """
+        with_payload = SEARCH_PAYLOAD_FIELDS + ["_node_content"] if with_text else SEARCH_PAYLOAD_FIELDS
+        dense_vector_name, sparse_vector_name = await self._aget_vector_names(collection_name)
+        search_params = self._search_params(collection_name)
+        query_texts = query_texts or [None] * len(query_embeddings)
+
+        sparse_queries = {}
+        if sparse_vector_name is not None:
+            texts = [text for text in query_texts if text]
+            if texts:
+                indices, values = self.sparse_encoder.encode_queries(texts)
+                sparse_queries = {
+                    text: SparseVector(indices=text_indices, values=text_values)
+                    for text, text_indices, text_values in zip(texts, indices, values)
+                }
+
+        requests = []
+        for query_embedding, query_text in zip(query_embeddings, query_texts):
+            if query_text in sparse_queries:
+                prefetch_limit = limit * HYBRID_PREFETCH_FACTOR
+                requests.append(
+                    QueryRequest(
+                        prefetch=[
+                            Prefetch(
+                                query=query_embedding,
+                                using=dense_vector_name,
+                                limit=prefetch_limit,
+                                params=search_params,
+                            ),
+                            Prefetch(
+                                query=sparse_queries[query_text],
+                                using=sparse_vector_name,
+                                limit=prefetch_limit,
+                            ),
+                        ],
+                        query=FusionQuery(fusion=Fusion.RRF),
+                        limit=limit,
+                        with_payload=with_payload,
+                        with_vector=False,
+                    )
+                )
+            else:
+                requests.append(
+                    QueryRequest(
+                        query=query_embedding,
+                        using=dense_vector_name,
+                        limit=limit,
+                        params=search_params,
+                        with_payload=with_payload,
+                        with_vector=False,
+                    )
+                )
+
+        responses = await self.aclient.query_batch_points(collection_name=collection_name, requests=requests)
+        return [[SearchHit.from_point(point) for point in response.points] for response in responses]
+
+    async def afind_articles(
+            self,
+            collection_name: str,
+            articles: List[int],
+            chapter: Optional[str] = None,
+            page_size: int = 256,
+    ) -> List[SearchHit]:
+        """
+        Chunks of the articles ("Điều N", optionally within a chapter) by exact payload filter, no vector search,
+        scrolled page by page (page_size chunks per page).
+        Hits are ordered like articles and have no score.
+        """
+        conditions = [FieldCondition(key="articles", match=MatchAny(any=articles))]
+        if chapter is not None:
+            conditions.append(FieldCondition(key="chapter", match=MatchValue(value=chapter)))
+
+        hits = []
+        offset = None
+        while True:
+            points, offset = await self.aclient.scroll(
+                collection_name=collection_name,
+                scroll_filter=Filter(must=conditions),
+                limit=page_size,
+                offset=offset,
+                with_payload=SEARCH_PAYLOAD_FIELDS + ["articles"],
+                with_vectors=False,
+            )
+            hits.extend(SearchHit.from_point(point) for point in points)
+            if offset is None:
+                break
+
+        rank = {article: i for i, article in enumerate(articles)}
+        return sorted(hits, key=lambda hit: min(rank.get(a, len(rank)) for a in hit.metadata.get("articles") or [0]))
+
+    async def is_hybrid(self, collection_name: str) -> bool:
+        _, sparse_vector_name = await self._aget_vector_names(collection_name)
+        return sparse_vector_name is not None
+
+    async def _aget_vector_names(self, collection_name: str) -> Tuple[Optional[str], Optional[str]]:
+        if collection_name not in self._vector_names:
+            info = await self.aclient.get_collection(collection_name)
+            self._vector_names[collection_name] = self._parse_vector_names(info)
+        return self._vector_names[collection_name]
+
+    @staticmethod
+    def _parse_vector_names(info) -> Tuple[Optional[str], Optional[str]]:
+        vectors = info.config.params.vectors
+        dense_vector_name = None
+        if isinstance(vectors, dict):
+            dense_vector_name = DENSE_VECTOR_NAME if DENSE_VECTOR_NAME in vectors else next(iter(vectors))
+
+        sparse_vectors = info.config.params.sparse_vectors or {}
+        sparse_vector_name = next((name for name in SPARSE_VECTOR_NAMES if name in sparse_vectors), None)
+        if sparse_vector_name is None and sparse_vectors:
+            sparse_vector_name = next(iter(sparse_vectors))
+
+        return dense_vector_name, sparse_vector_name
 
-    def close(self):
+    async def close(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            self._refresher = None
         self.client.close()
+        await self.aclient.close()
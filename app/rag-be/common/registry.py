@@ -0,0 +1,121 @@
+import httpx
+from common.bm25 import BM25Encoder
+from common.cache import AnswerCache, ContextCache, EmbeddingCache, EmbeddingStore, RerankCache
+from common.context_retrieval import ContextGenerator
+from common.jobs import JobManager
+from common.qdrant import EmbedModel, QdrantService, RerankModel
+from config import Settings
+from openai import AsyncOpenAI, OpenAI
+
+
+class ClientRegistry:
+    """
+    Process-wide clients shared by every request.
+
+    Created once at startup and closed at shutdown, so requests reuse keep-alive connections
+    to Qdrant and the LLM gateway instead of opening new ones.
+    """
+
+    def __init__(self, settings: Settings):
+        self.settings = settings
+
+        limits = httpx.Limits(
+            max_connections=settings.http_pool_max_connections,
+            max_keepalive_connections=settings.http_pool_max_keepalive,
+            keepalive_expiry=settings.http_keepalive_expiry,
+        )
+
+        # Shared connection pools to the LLM gateway: sync for indexing, async for requests
+        self.http_client = httpx.Client(limits=limits, timeout=settings.http_timeout)
+        self.async_http_client = httpx.AsyncClient(limits=limits, timeout=settings.http_timeout)
+
+        self.qdrant = QdrantService(
+            url=settings.qdrant_db_url,
+            prefer_grpc=settings.qdrant_prefer_grpc,
+            grpc_port=settings.qdrant_grpc_port,
+            timeout=settings.qdrant_timeout,
+            limits=limits,
+            hybrid=settings.hybrid_search,
+            sparse_encoder=BM25Encoder(k1=settings.bm25_k1, b=settings.bm25_b, avg_len=settings.bm25_avg_len),
+        )
+
+        self.embedding_cache = EmbeddingCache(
+            max_size=settings.embedding_cache_size,
+            ttl=settings.embedding_cache_ttl,
+            redis_url=settings.embedding_cache_redis_url,
+        )
+
+        # Persistent document embeddings, shared by every collection indexed with the same model
+        self.embedding_store = None
+        if settings.embedding_store_path and settings.em_model:
+            self.embedding_store = EmbeddingStore(settings.embedding_store_path, model_name=settings.em_model)
+
+        self.answer_cache = AnswerCache(
+            similarity_threshold=settings.answer_cache_similarity_threshold,
+            max_size=settings.answer_cache_size,
+            ttl=settings.answer_cache_ttl,
+        )
+
+        self.embed_model = EmbedModel(
+            api_base=settings.llm_gateway_url,
+            api_key=settings.llm_lab_api_key,
+            model_name=settings.em_model,
+            provider="openai",
+            http_client=self.http_client,
+            async_http_client=self.async_http_client,
+            cache=self.embedding_cache,
+            store=self.embedding_store,
+            batch_max_size=settings.embedding_batch_max_size,
+            batch_wait=settings.embedding_batch_wait_ms / 1000,
+        )
+
+        self.rerank_cache = RerankCache(max_size=settings.rerank_cache_size, ttl=settings.rerank_cache_ttl)
+
+        self.rerank_model = RerankModel(
+            api_base=settings.llm_gateway_url,
+            api_key=settings.llm_lab_api_key,
+            model_name=settings.rm_model,
+            async_http_client=self.async_http_client,
+            cache=self.rerank_cache,
+        )
+
+        self.llm_client = AsyncOpenAI(
+            base_url=settings.llm_gateway_url,
+            api_key=settings.llm_lab_api_key,
+            http_client=self.async_http_client,
+        )
+
+        # Contextual retrieval of the indexer, on the sync pool; retries are done by the generator
+        context_model = settings.context_model or settings.llm_model
+        self.context_cache = None
+        if settings.context_cache_path and context_model:
+            self.context_cache = ContextCache(settings.context_cache_path, model_name=context_model)
+
+        self.context_generator = ContextGenerator(
+            client=OpenAI(
+                base_url=settings.llm_gateway_url,
+                api_key=settings.llm_lab_api_key,
+                http_client=self.http_client,
+                max_retries=0,
+            ),
+            model_name=context_model,
+            max_concurrency=settings.context_max_concurrency,
+            max_retries=settings.context_max_retries,
+            document_max_tokens=settings.context_document_max_tokens,
+            cache=self.context_cache,
+        )
+
+        self.index_jobs = JobManager(max_workers=settings.index_workers)
+
+    async def start(self):
+        """
+        Async part of the startup: load the collection registry and start its background refresh.
+        """
+        await self.qdrant.start(refresh_interval=self.settings.collection_refresh_interval)
+
+    async def close(self):
+        self.index_jobs.shutdown()
+        await self.qdrant.close()
+        self.http_client.close()
+        await self.async_http_client.aclose()
+        await self.embedding_cache.close()
@@ -1,73 +1,229 @@
-import copy
+import asyncio
+import logging
 import re
+from itertools import zip_longest
+from typing import Dict, List, Optional
 
-from common.qdrant import RerankModel
-from llama_index.core import VectorStoreIndex
-from llama_index.core.postprocessor import SimilarityPostprocessor
+from common.chunk import count_tokens_batch, get_encoding
+from common.metrics import timed
+from common.qdrant import QdrantService, RerankModel, SearchHit
 
+logger = logging.getLogger(__name__)
 
-def retriever(
-    store_index: VectorStoreIndex,
+# Characters of a paragraph sent to the cross-encoder
+RERANK_MAX_CHARS = 8000
+
+
+class Paragraph:
+    """
+    Unique paragraph of the search results of a collection, with its rank score.
+    """
+    __slots__ = ("paragraph_id", "file_path", "header_path", "content", "score")
+
+    def __init__(self, paragraph_id: str, file_path: str, header_path: str, content: str, score: Optional[float]):
+        self.paragraph_id = paragraph_id
+        self.file_path = file_path
+        self.header_path = header_path
+        self.content = content
+        self.score = score
+
+
+async def retriever(
+    qdrant_service: QdrantService,
+    collection_name: str,
     question: str,
+    query_embedding: List[float],
     similarity_top_k: int = 20,
     enable_similarity_cutoff: bool = True,
     similarity_cutoff: float = 0.5,
-    enable_rerank: bool = True,
-    rerank_client: RerankModel = None,
-    top_n: int = 5,
-    debug: bool = False,
-) -> str:
+) -> List[Paragraph]:
     """
-    Retrieve the documents related to the question.
+    Retrieve the paragraphs related to the question, in rank order.
+
+    The question is embedded once by the caller (query_embedding, shared across collections), and reranking is
+    done by the caller across every collection searched (rerank_paragraphs).
 
     Steps:
-        1. Retrieve the nodes from the store index.
-        2. Post-process the nodes (Similarity cutoff, Rerank).
-        3. Get the full content of the paragraphs in the metadata of the chunks.
+        1. Search the collection, fetching only the payload fields used below;
+            dense + BM25 with rank fusion on hybrid collections.
+        2. Similarity cutoff. The cutoff is a cosine similarity, so it is not applied to the fused scores of
+            hybrid collections.
+        3. Get the full content of the paragraphs: from the paragraph store of collection_name (one bulk lookup
+            of the unique paragraphs), or from the metadata of the chunks for collections indexed before it.
     """
     # Retrieve
-    retrieve = store_index.as_retriever(
-        similarity_top_k=similarity_top_k,
-    )
-    nodes = retrieve.retrieve(question)
-    if debug:
-        print(f"Retrieved {len(nodes)} nodes")
+    with timed("query", "search"):
+        nodes = await qdrant_service.asearch(
+            collection_name,
+            query_embedding,
+            limit=similarity_top_k,
+            query_text=question,
+        )
+    logger.debug("Retrieved %d nodes", len(nodes))
+    if logger.isEnabledFor(logging.DEBUG):
         for node in nodes:
-            print(f"Node: {node}")
+            logger.debug("Node: %s (score: %s) %s", node.node_id, node.score, node.metadata)
+
+    return await select_paragraphs(qdrant_service, collection_name, nodes, enable_similarity_cutoff, similarity_cutoff)
+
 
-    # Post-processors
-    if enable_similarity_cutoff:
+async def batch_retriever(
+    qdrant_service: QdrantService,
+    collection_name: str,
+    questions: List[str],
+    query_embeddings: List[List[float]],
+    similarity_top_k: int = 20,
+    enable_similarity_cutoff: bool = True,
+    similarity_cutoff: float = 0.5,
+) -> List[List[Paragraph]]:
+    """
+    retriever for several questions of the same collection: one Qdrant batch query for all of them.
+    Returns the paragraphs of each question, in order.
+    """
+    with timed("query", "search"):
+        hits = await qdrant_service.asearch_batch(
+            collection_name,
+            query_embeddings,
+            limit=similarity_top_k,
+            query_texts=questions,
+        )
+
+    paragraphs = await asyncio.gather(
+        *(
+            select_paragraphs(qdrant_service, collection_name, nodes, enable_similarity_cutoff, similarity_cutoff)
+            for nodes in hits
+        )
+    )
+    return list(paragraphs)
+
+
+async def select_paragraphs(
+    qdrant_service: QdrantService,
+    collection_name: str,
+    nodes: List[SearchHit],
+    enable_similarity_cutoff: bool = True,
+    similarity_cutoff: float = 0.5,
+) -> List[Paragraph]:
+    """
+    Post-processors of the search results: similarity cutoff (dense collections only), then their paragraphs.
+    """
+    if enable_similarity_cutoff and not await qdrant_service.is_hybrid(collection_name):
         # Similarity cutoff
-        processor = SimilarityPostprocessor(similarity_cutoff=similarity_cutoff)
-        nodes = processor.postprocess_nodes(nodes)
-    if enable_rerank:
-        # Shorten text
-        short_nodes = copy.deepcopy(nodes)
-        for node in short_nodes:
-            text = re.sub(r"-+", "-", node.text)
-            text = re.sub(r"\s+", " ", text)
-            node.node.text = text[:30000]
-            node.node.metadata = {}
-
-        # Rerank
-        processor = rerank_client.get_rerank_model(top_n=top_n)
-        reranked_short_nodes = processor.postprocess_nodes(short_nodes, query_str=question)
-
-        # Filter nodes by node_id
-        reranked_ids = [node.node_id for node in reranked_short_nodes]
-        nodes = [node for node in nodes if node.node_id in reranked_ids]
-
-    # Get full content of paragraphs in metadata of chunks
-    chunks = []
-    seen_ids = set()
+        with timed("query", "cutoff"):
+            nodes = [node for node in nodes if node.score is not None and node.score >= similarity_cutoff]
+
+    with timed("query", "paragraphs"):
+        return await get_paragraphs(qdrant_service, collection_name, nodes)
+
+
+async def rerank_paragraphs(
+    rerank_client: RerankModel,
+    question: str,
+    paragraphs: Dict[str, List[Paragraph]],
+    top_n: int = 5,
+) -> Dict[str, List[Paragraph]]:
+    """
+    Rerank the paragraphs of every collection together, in one batched cross-encoder call over (paragraph id,
+    shortened text) pairs, and keep the global top_n: paragraphs of different collections compete for the same
+    places. Returns the kept paragraphs of each collection, by rerank score.
+    """
+    candidates = [
+        (collection_name, paragraph)
+        for collection_name, collection_paragraphs in paragraphs.items()
+        for paragraph in collection_paragraphs
+    ]
+    if not candidates:
+        return paragraphs
+
+    # Shorten text
+    items = []
+    for _, paragraph in candidates:
+        text = re.sub(r"-+", "-", paragraph.content)
+        text = re.sub(r"\s+", " ", text)
+        items.append((paragraph.paragraph_id, text[:RERANK_MAX_CHARS]))
+
+    # Rerank
+    scores = await rerank_client.ascore(question, items)
+    ranked = sorted(zip(scores, range(len(candidates))), key=lambda item: -item[0])[:top_n]
+
+    reranked = {collection_name: [] for collection_name in paragraphs}
+    for score, i in ranked:
+        collection_name, paragraph = candidates[i]
+        paragraph.score = score
+        reranked[collection_name].append(paragraph)
+    return reranked
+
+
+async def article_retriever(
+    qdrant_service: QdrantService,
+    collection_name: str,
+    articles: List[int],
+    chapter: Optional[str] = None,
+) -> Optional[List[Paragraph]]:
+    """
+    Retrieve the paragraphs of the articles named by the question ("Điều N") with an exact payload filter,
+    without embedding the question nor searching vectors. Exact matches have no score.
 
+    Returns None when the collection has no chunk of these articles, so the caller falls back to the search.
+    """
+    with timed("query", "article_lookup"):
+        nodes = await qdrant_service.afind_articles(collection_name, articles, chapter=chapter)
+    if not nodes:
+        return None
+
+    with timed("query", "paragraphs"):
+        return await get_paragraphs(qdrant_service, collection_name, nodes)
+
+
+async def get_paragraphs(qdrant_service: QdrantService, collection_name: str, nodes: List[SearchHit]) -> List[Paragraph]:
+    """
+    Unique paragraphs of the nodes, in order, with their full content: from the paragraph store of collection_name
+    (one bulk lookup), or from the metadata of the chunks for collections indexed before it.
+    """
+    # Unique paragraphs, in rank order
+    paragraph_nodes = {}
     for node in nodes:
         paragraph_id = node.metadata.get("paragraph_id")
-        full_content = f"Position: {node.metadata.get('file_path')}{node.metadata.get('header_path')}\n\nContent:\n {node.metadata.get('paragraph_full_content')}"
+        if paragraph_id and paragraph_id not in paragraph_nodes:
+            paragraph_nodes[paragraph_id] = node
+
+    # Get full content of paragraphs from the paragraph store, or in metadata of chunks
+    point_ids = [
+        QdrantService.paragraph_point_id(node.metadata)
+        for node in paragraph_nodes.values()
+        if "paragraph_full_content" not in node.metadata
+    ]
+    stored_contents = await qdrant_service.aget_paragraphs(collection_name, point_ids)
+
+    paragraphs = []
+    for paragraph_id, node in paragraph_nodes.items():
+        paragraph_content = node.metadata.get("paragraph_full_content")
+        if paragraph_content is None:
+            paragraph_content = stored_contents.get(QdrantService.paragraph_point_id(node.metadata))
+        if paragraph_content is None:
+            continue
 
-        if paragraph_id and full_content and paragraph_id not in seen_ids:
-            seen_ids.add(paragraph_id)
-            chunks.append(full_content)
+        paragraphs.append(
+            Paragraph(
+                paragraph_id=paragraph_id,
+                file_path=node.metadata.get("file_path"),
+                header_path=node.metadata.get("header_path"),
+                content=paragraph_content,
+                score=node.score,
+            )
+        )
+
+    return paragraphs
+
+
+def format_paragraphs(paragraphs: List[Paragraph]) -> str:
+    """
+    Documents related of a collection, as given to the LLM.
+    """
+    chunks = []
+    for paragraph in paragraphs:
+        full_content = f"Position: {paragraph.file_path}{paragraph.header_path}\n\nContent:\n {paragraph.content}"
+        chunks.append(full_content)
 
     if not chunks:
         return """Information Not Found"""
@@ -84,3 +240,59 @@ def retriever(
 """
 
     return documents
+
+
+def build_context(paragraphs: Dict[str, List[Paragraph]], max_tokens: int, reranked: bool = False) -> str:
+    """
+    Documents related of every collection, as one context for the LLM prompt, of at most max_tokens tokens:
+        1. Order the paragraphs, exact article matches (no score) first:
+            - reranked: by rerank score, comparable across collections.
+            - otherwise: round-robin over the collections by rank (first of each collection, then second...),
+                since the scores of a hybrid collection (RRF, ~0.01-0.03) and of a dense one (cosine, ~0.5-0.9)
+                are not comparable.
+        2. Deduplicate paragraphs found in several collections (same paragraph_id, the first one is kept).
+        3. Pack the paragraphs in this order while they fit in max_tokens, skipping the ones that do not.
+            The first paragraph is truncated to fit when no paragraph fits whole.
+
+    Parameters:
+        - paragraphs (Dict[str, List[Paragraph]]): Paragraphs of each collection, by rank.
+        - max_tokens (int): Token budget of the context.
+        - reranked (bool): Whether the scores are rerank scores.
+    """
+    if reranked:
+        ranked = sorted(
+            (paragraph for collection_paragraphs in paragraphs.values() for paragraph in collection_paragraphs),
+            key=lambda paragraph: (paragraph.score is not None, -(paragraph.score or 0.0)),
+        )
+    else:
+        interleaved = [
+            paragraph
+            for same_rank in zip_longest(*paragraphs.values())
+            for paragraph in same_rank
+            if paragraph is not None
+        ]
+        ranked = sorted(interleaved, key=lambda paragraph: paragraph.score is not None)
+    unique = {}
+    for paragraph in ranked:
+        unique.setdefault(paragraph.paragraph_id, paragraph)
+    if not unique:
+        return """Information Not Found"""
+
+    blocks = [
+        f"Position: {paragraph.file_path}{paragraph.header_path}\n\nContent:\n {paragraph.content}"
+        for paragraph in unique.values()
+    ]
+    # Counted with their tags and separator, numbered as if every block were kept (never fewer digits once packed)
+    tagged = [f"<paragraph_{i + 1}>\n{block}\n</paragraph_{i + 1}>\n\n" for i, block in enumerate(blocks)]
+
+    packed = []
+    remaining = max_tokens
+    for block, tokens in zip(blocks, count_tokens_batch(tagged)):
+        if tokens <= remaining:
+            packed.append(block)
+            remaining -= tokens
+    if not packed:
+        encoding = get_encoding()
+        packed.append(encoding.decode(encoding.encode(blocks[0])[:max(max_tokens - 16, 0)]))
+
+    return "\n\n".join(f"<paragraph_{i + 1}>\n{block}\n</paragraph_{i + 1}>" for i, block in enumerate(packed))
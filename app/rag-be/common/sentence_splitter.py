@@ -1,9 +1,10 @@
 import hashlib
-from typing import Any, List, Sequence
+import uuid
+from typing import Any, Dict, List, Sequence, Tuple
 
 from llama_index.core.node_parser.node_utils import build_nodes_from_splits
 from llama_index.core.node_parser.text.sentence import SentenceSplitter
-from llama_index.core.schema import BaseNode, MetadataMode
+from llama_index.core.schema import BaseNode, MetadataMode, NodeRelationship, RelatedNodeInfo
 from llama_index.core.utils import get_tqdm_iterable
 
 
@@ -14,12 +15,32 @@ class CustomSentenceSplitter(SentenceSplitter):
         """Generate a unique id for the text using SHA-256."""
         return hashlib.sha256(text.encode()).hexdigest()
 
+    def _generate_chunk_id(self, parent: BaseNode, text: str, occurrence: int) -> str:
+        """
+        Deterministic node id from file name, header path and text, so re-indexing can diff chunks by content.
+        occurrence numbers the identical chunks (same file, header path and text) in order, so they do not collide.
+        The file name and header path are read from the parent node: split nodes get its metadata only later,
+        in NodeParser._postprocess_parsed_nodes.
+        """
+        content = "\x00".join([
+            parent.metadata.get("file_name", ""),
+            parent.metadata.get("header_path", ""),
+            text,
+            str(occurrence),
+        ])
+        return str(uuid.uuid5(uuid.NAMESPACE_OID, self._generate_source_id(content)))
+
     def _parse_nodes(
             self, nodes: Sequence[BaseNode], show_progress: bool = False, **kwargs: Any
     ) -> List[BaseNode]:
         all_nodes: List[BaseNode] = []
         nodes_with_progress = get_tqdm_iterable(nodes, show_progress, "Parsing nodes")
 
+        # Occurrences of each (file name, header path, text) so far
+        occurrences: Dict[Tuple[str, str, str], int] = {}
+        # Split node id -> content id
+        new_ids: Dict[str, str] = {}
+
         for node in nodes_with_progress:
             original_content = node.get_content(metadata_mode=MetadataMode.NONE)
             metadata_str = self._get_metadata_str(node)
@@ -40,6 +61,21 @@ class CustomSentenceSplitter(SentenceSplitter):
                 # Don't add paragraph_full_content to embedding
                 new_node.excluded_embed_metadata_keys.extend(['paragraph_id', 'paragraph_full_content'])
 
+                text = new_node.get_content(metadata_mode=MetadataMode.NONE)
+                key = (node.metadata.get("file_name", ""), node.metadata.get("header_path", ""), text)
+                occurrence = occurrences.get(key, 0)
+                occurrences[key] = occurrence + 1
+
+                new_ids[new_node.id_] = self._generate_chunk_id(node, text, occurrence)
+                new_node.id_ = new_ids[new_node.id_]
+
             all_nodes.extend(new_nodes)
 
+        # Relationships between the split nodes still name their previous ids
+        for new_node in all_nodes:
+            for relationship in (NodeRelationship.PREVIOUS, NodeRelationship.NEXT):
+                related = new_node.relationships.get(relationship)
+                if isinstance(related, RelatedNodeInfo) and related.node_id in new_ids:
+                    related.node_id = new_ids[related.node_id]
+
         return all_nodes
@@ -0,0 +1,142 @@
+from typing import Dict, Optional, Union
+
+from qdrant_client.http.models import (
+    BinaryQuantization,
+    BinaryQuantizationConfig,
+    Distance,
+    HnswConfigDiff,
+    QuantizationSearchParams,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+    SearchParams,
+    VectorParams,
+)
+
+QUANTIZATIONS = ("scalar", "binary")
+
+
+class StorageProfile:
+    """
+    How the vectors and payloads of a collection are stored in Qdrant, and searched.
+
+    Saved with the collection in collection_metadata (to_dict), since the search-time options (hnsw_ef, rescoring)
+    are not part of the Qdrant collection config.
+    """
+
+    def __init__(
+            self,
+            name: str = "default",
+            quantization: Optional[str] = None,
+            oversampling: float = 2.0,
+            rescore: bool = True,
+            hnsw_m: Optional[int] = None,
+            hnsw_ef_construct: Optional[int] = None,
+            hnsw_ef: Optional[int] = None,
+            on_disk_vectors: bool = False,
+            on_disk_payload: bool = False,
+    ):
+        """
+        Parameters:
+            - name (str): Profile name.
+            - quantization (str): None, "scalar" (int8, 4x smaller) or "binary" (1 bit, 32x smaller), quantized
+                vectors are kept in RAM.
+            - oversampling (float): Candidates fetched with the quantized vectors, per result, before rescoring.
+            - rescore (bool): Rescore the candidates with the original vectors.
+            - hnsw_m (int): Edges per node of the HNSW graph, None for the Qdrant default (16).
+            - hnsw_ef_construct (int): Neighbours considered while building the graph, None for the default (100).
+            - hnsw_ef (int): Neighbours considered while searching, None for the default (ef_construct).
+            - on_disk_vectors (bool): Keep the original vectors on disk (memory-mapped) instead of RAM.
+            - on_disk_payload (bool): Keep the payloads on disk instead of RAM.
+        """
+        if quantization is not None and quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization: {quantization}, expected one of {QUANTIZATIONS}")
+
+        self.name = name
+        self.quantization = quantization
+        self.oversampling = oversampling
+        self.rescore = rescore
+        self.hnsw_m = hnsw_m
+        self.hnsw_ef_construct = hnsw_ef_construct
+        self.hnsw_ef = hnsw_ef
+        self.on_disk_vectors = on_disk_vectors
+        self.on_disk_payload = on_disk_payload
+
+    def vector_params(self, size: int) -> VectorParams:
+        return VectorParams(size=size, distance=Distance.COSINE, on_disk=self.on_disk_vectors or None)
+
+    def hnsw_config(self) -> Optional[HnswConfigDiff]:
+        if self.hnsw_m is None and self.hnsw_ef_construct is None:
+            return None
+        return HnswConfigDiff(m=self.hnsw_m, ef_construct=self.hnsw_ef_construct)
+
+    def quantization_config(self) -> Optional[Union[ScalarQuantization, BinaryQuantization]]:
+        if self.quantization == "scalar":
+            return ScalarQuantization(
+                scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.99, always_ram=True),
+            )
+        if self.quantization == "binary":
+            return BinaryQuantization(binary=BinaryQuantizationConfig(always_ram=True))
+        return None
+
+    def search_params(self) -> Optional[SearchParams]:
+        quantization = None
+        if self.quantization is not None:
+            quantization = QuantizationSearchParams(rescore=self.rescore, oversampling=self.oversampling)
+
+        if self.hnsw_ef is None and quantization is None:
+            return None
+        return SearchParams(hnsw_ef=self.hnsw_ef, quantization=quantization)
+
+    def to_dict(self) -> Dict:
+        return {
+            "name": self.name,
+            "quantization": self.quantization,
+            "oversampling": self.oversampling,
+            "rescore": self.rescore,
+            "hnsw_m": self.hnsw_m,
+            "hnsw_ef_construct": self.hnsw_ef_construct,
+            "hnsw_ef": self.hnsw_ef,
+            "on_disk_vectors": self.on_disk_vectors,
+            "on_disk_payload": self.on_disk_payload,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Optional[Dict]) -> "StorageProfile":
+        """
+        Profile saved with a collection, the default one for collections created before storage profiles.
+        """
+        return cls(**data) if data else cls()
+
+
+STORAGE_PROFILES: Dict[str, StorageProfile] = {
+    # Float32 vectors and payloads in RAM, Qdrant defaults (collections created before storage profiles)
+    "default": StorageProfile(),
+    # int8 vectors in RAM (4x less), originals in RAM for rescoring
+    "scalar": StorageProfile("scalar", quantization="scalar", oversampling=2.0),
+    # 1-bit vectors in RAM (32x less), needs more oversampling to keep recall
+    "binary": StorageProfile("binary", quantization="binary", oversampling=3.0),
+    # int8 vectors in RAM, originals and payloads on disk: the smallest memory use, rescoring reads the disk
+    "on_disk": StorageProfile(
+        "on_disk", quantization="scalar", oversampling=2.0, on_disk_vectors=True, on_disk_payload=True,
+    ),
+}
+
+
+def get_storage_profile(
+        name: str,
+        hnsw_m: Optional[int] = None,
+        hnsw_ef_construct: Optional[int] = None,
+        hnsw_ef: Optional[int] = None,
+) -> StorageProfile:
+    """
+    Storage profile by name, with its HNSW options overridden when given.
+    """
+    if name not in STORAGE_PROFILES:
+        raise ValueError(f"Unknown storage profile: {name}, expected one of {list(STORAGE_PROFILES)}")
+
+    options = STORAGE_PROFILES[name].to_dict()
+    for key, value in (("hnsw_m", hnsw_m), ("hnsw_ef_construct", hnsw_ef_construct), ("hnsw_ef", hnsw_ef)):
+        if value is not None:
+            options[key] = value
+    return StorageProfile(**options)
@@ -0,0 +1,91 @@
+from functools import lru_cache
+from typing import Optional
+
+from common.bm25 import DEFAULT_AVG_LEN, DEFAULT_B, DEFAULT_K1
+from pydantic_settings import BaseSettings
+
+
+class Settings(BaseSettings):
+    """
+    Runtime settings of rag-be, read from environment variables (case-insensitive).
+    """
+    # Services
+    qdrant_db_url: str = "http://localhost:6333"
+    llm_gateway_url: Optional[str] = None
+    llm_lab_api_key: Optional[str] = None
+    em_model: Optional[str] = None
+    rm_model: Optional[str] = None
+    llm_model: Optional[str] = None
+
+    # Qdrant transport
+    qdrant_prefer_grpc: bool = False
+    qdrant_grpc_port: int = 6334
+    qdrant_timeout: int = 60
+
+    # HTTP connection pools (shared by embedding, rerank and LLM clients)
+    http_pool_max_connections: int = 100
+    http_pool_max_keepalive: int = 20
+    http_keepalive_expiry: float = 30.0
+    http_timeout: float = 300.0
+
+    # Collection registry, reloaded from Qdrant in background every interval (seconds, 0 disables it)
+    collection_refresh_interval: float = 60.0
+
+    # Most questions in one /rag/retriever/batch request
+    retriever_batch_max_questions: int = 100
+
+    # Storage profile of new collections when the indexer request names none (see common/storage.py)
+    storage_profile: str = "default"
+
+    # Background indexing
+    index_workers: int = 2
+    index_batch_size: int = 64
+
+    # Logging: with LOG_LEVEL=DEBUG, this share of the chunks of every indexing is logged
+    log_level: str = "INFO"
+    chunk_log_sample_rate: float = 0.01
+
+    # Contextual retrieval: LLM-written context prepended to every chunk at indexing (slow, off by default)
+    context_retrieval: bool = False
+    context_model: Optional[str] = None  # defaults to llm_model
+    context_max_concurrency: int = 8
+    context_max_retries: int = 5
+    context_document_max_tokens: int = 24000
+    context_cache_path: Optional[str] = None
+
+    # Hybrid dense + BM25 retrieval (applies to collections created while enabled)
+    hybrid_search: bool = False
+    bm25_k1: float = DEFAULT_K1
+    bm25_b: float = DEFAULT_B
+    bm25_avg_len: float = DEFAULT_AVG_LEN
+
+    # Rerank of the paragraphs found in all the collections searched, with a cache of the scores
+    rerank: bool = False
+    rerank_top_n: int = 5
+    rerank_cache_size: int = 100000
+    rerank_cache_ttl: float = 86400
+
+    # Micro-batching of the query embeddings of concurrent requests (wait 0 disables it)
+    embedding_batch_wait_ms: float = 2.0
+    embedding_batch_max_size: int = 32
+
+    # Token budget of the documents in the /rag/chat prompt (deduplicated paragraphs, best scored first)
+    chat_context_max_tokens: int = 6000
+
+    # Query-embedding cache
+    embedding_cache_size: int = 10000
+    embedding_cache_ttl: float = 86400
+    embedding_cache_redis_url: Optional[str] = None
+
+    # Persistent document-embedding store used by indexing (unset disables it)
+    embedding_store_path: Optional[str] = None
+
+    # Semantic answer cache of /rag/chat (size 0 disables it)
+    answer_cache_size: int = 1000
+    answer_cache_ttl: float = 3600
+    answer_cache_similarity_threshold: float = 0.95
+
+
+@lru_cache
+def get_settings() -> Settings:
+    return Settings()
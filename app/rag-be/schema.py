@@ -6,3 +6,8 @@ from pydantic import BaseModel, Field
 class RetrieverRequest(BaseModel):
     question: str = Field(..., description="Question to retrieve related documents")
     collection_ids: List[str] = Field(..., description="Collections id to store documents in vector DB")
+
+
+class BatchRetrieverRequest(BaseModel):
+    questions: List[str] = Field(..., description="Questions to retrieve related documents for")
+    collection_ids: List[str] = Field(..., description="Collections id to store documents in vector DB")
@@ -1,26 +1,166 @@
-import os
+import asyncio
+import json
+import logging
 import shutil
-from typing import Dict, List
+import tempfile
+from textwrap import dedent
+from typing import AsyncIterator, BinaryIO, Dict, List, Optional, Tuple
 
+from common.articles import find_article_references
 from common.chunk import chunker
-from common.qdrant import EmbedModel, QdrantService, RerankModel
-from common.retrieve import retriever
+from common.jobs import IndexJob
+from common.metrics import timed
+from common.registry import ClientRegistry
+from common.retrieve import (
+    Paragraph,
+    article_retriever,
+    batch_retriever,
+    build_context,
+    format_paragraphs,
+    rerank_paragraphs,
+    retriever,
+)
+from config import get_settings
 from fastapi import UploadFile
 
 
+# Uploads are copied block by block, and kept in memory only up to SPOOL_MAX_MEMORY bytes per file
+SPOOL_BLOCK_SIZE = 1024 * 1024
+SPOOL_MAX_MEMORY = 1024 * 1024
+
+# Chunks searched per collection, and their minimum cosine similarity
+SIMILARITY_TOP_K = 5
+SIMILARITY_CUTOFF = 0.1
+
+# System prompt of /rag/chat, followed by the context (build_context)
+CHAT_SYSTEM_PROMPT = dedent("""\
+    You are a Retrieval-Augmented Generation (RAG) chatbot.
+    Your role is to find the right answer from the document for the user question.
+
+    - Rules:
+    <rules>
+    - Always response with Markdown format.
+    - When you don't know the answer, say "I don't know".
+    </rules>
+
+    - Documents:
+""")
+
+# Data of the error event of /rag/chat/stream, the details are logged
+CHAT_STREAM_ERROR = "The answer could not be generated, please retry."
+
+logger = logging.getLogger(__name__)
+
+
 class RAGService:
     __instance = None
+
+    @staticmethod
+    def startup() -> None:
+        """
+        Create the process-wide clients (Qdrant, embedding, rerank, LLM).
+        """
+        if RAGService.__instance is None:
+            RAGService.__instance = ClientRegistry(get_settings())
+
+    @staticmethod
+    async def astartup() -> None:
+        """
+        Create the process-wide clients, then load the collection registry (collection_metadata is initialized once
+        here instead of on every request).
+        """
+        RAGService.startup()
+        await RAGService.__instance.start()
+
+    @staticmethod
+    async def shutdown() -> None:
+        """
+        Close the process-wide clients and their connection pools.
+        """
+        if RAGService.__instance is not None:
+            await RAGService.__instance.close()
+            RAGService.__instance = None
+
+    @staticmethod
+    def clients() -> ClientRegistry:
+        RAGService.startup()
+        return RAGService.__instance
+
+    @staticmethod
+    def cache_stats() -> Dict:
+        """
+        Hit/miss counters of the request-path caches and of the indexing stores (embeddings, contexts).
+        """
+        clients = RAGService.clients()
+        return {
+            "embedding": clients.embedding_cache.stats(),
+            "answer": clients.answer_cache.stats(),
+            "rerank": clients.rerank_cache.stats(),
+            "embedding_store": clients.embedding_store.stats() if clients.embedding_store is not None else None,
+            "context_cache": clients.context_cache.stats() if clients.context_cache is not None else None,
+        }
+
     @staticmethod
-    def get_collections() -> List[Dict]:
+    async def get_collections() -> List[Dict]:
         """
         Get list collections/tables/indexes existed in vector database.
         """
-        qdrant_service = QdrantService(url=os.getenv("QDRANT_DB_URL"))
-        return qdrant_service.get_collections()
+        return await RAGService.clients().qdrant.get_collections()
+
+    @staticmethod
+    async def get_collection(collection_id: str) -> Optional[Dict]:
+        """
+        Get a collection by id from the collection registry, None when it does not exist.
+        """
+        return await RAGService.clients().qdrant.get_collection(collection_id)
+
+    @staticmethod
+    def submit_index(collection: dict, files: List[UploadFile], update: bool = False) -> IndexJob:
+        """
+        Spool the uploaded files, then queue their indexing on the indexer worker pool.
+
+        With update=True the files are re-indexed incrementally into the existing collection.
+        Returns the job right away, its progress is polled with get_index_job.
+        """
+        spooled_files = RAGService._spool_files(files)
+        return RAGService.clients().index_jobs.submit(
+            collection,
+            lambda job: RAGService.index(collection, spooled_files, job, update=update),
+        )
+
+    @staticmethod
+    def get_index_job(job_id: str) -> Optional[IndexJob]:
+        return RAGService.clients().index_jobs.get(job_id)
+
+    @staticmethod
+    def list_index_jobs() -> List[IndexJob]:
+        return RAGService.clients().index_jobs.list()
+
+    @staticmethod
+    def cancel_index_job(job_id: str) -> Optional[IndexJob]:
+        return RAGService.clients().index_jobs.cancel(job_id)
+
+    @staticmethod
+    def _spool_files(files: List[UploadFile]) -> List[Tuple[str, BinaryIO]]:
+        """
+        Copy uploaded files, in fixed-size blocks, to anonymous temp files owned by the indexing job
+        (uploads are closed once the request ends). Small files stay in memory.
+        """
+        spooled_files = []
+        for file in files:
+            spooled = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+            shutil.copyfileobj(file.file, spooled, SPOOL_BLOCK_SIZE)
+            spooled_files.append((file.filename, spooled))
 
+        return spooled_files
 
     @staticmethod
-    def index(collection: dict, files: List[UploadFile]) -> None:
+    def index(
+            collection: dict,
+            files: List[Tuple[str, BinaryIO]],
+            job: Optional[IndexJob] = None,
+            update: bool = False,
+    ) -> None:
         """
 
         Parameters:
@@ -31,159 +171,367 @@ class RAGService:
                 description: (str)
 
             :param files:
-            - files (list)
+            - files (list): (file name, binary stream) of the Markdown files, closed at the end.
+
+            :param job:
+            - job (IndexJob): Progress report and cancellation.
+
+            :param update:
+            - update (bool): Only embed new/changed chunks of the files into the existing collection,
+                and delete their removed chunks.
 
         Index document paths to vector database.
-            1. Save files to folder local
-            2. Index:
-                - Chunk
-                - Embed
-                - Store to vector database
+            1. Chunk
+            2. Embed
+            3. Store to vector database
 
         """
-        # Step 1: Create temp folder to store files
-        folder_path = f"/tmp/{collection['id']}"
-        os.makedirs(folder_path, exist_ok=True)
+        settings = get_settings()
 
         try:
-            for file in files:
-                file_path = os.path.join(folder_path, file.filename)
-                with open(file_path, "wb") as f:
-                    content = file.file.read()
-                    f.write(content)
+            # Step 1: Chunk the files
+            if job is not None:
+                job.set_stage("chunking")
 
-            # Step 2: Chunk the files
+            clients = RAGService.clients()
             data_chunked = chunker(
-                folder_path=folder_path,
+                files=files,
                 min_chunk_size=256,
                 max_chunk_size=1024,
-                context_retrieval=False,
-                debug=True,
-            )
-
-            # Step 3: Index into vector DB
-            embed_model = EmbedModel(
-                api_base=os.getenv("LLM_GATEWAY_URL"),
-                api_key=os.getenv("LLM_LAB_API_KEY"),
-                model_name=os.getenv("EM_MODEL"),
-                provider="openai",
+                context_retrieval=settings.context_retrieval,
+                log_sample_rate=settings.chunk_log_sample_rate,
+                context_generator=clients.context_generator,
+                job=job,
             )
 
-            qdrant_service = QdrantService(url=os.getenv("QDRANT_DB_URL"))
+            # Step 2: Index into vector DB
+            if job is not None:
+                job.advance(chunks_produced=len(data_chunked))
+                job.set_stage("embedding")
 
-            qdrant_service.embed_index(
-                embed_model=embed_model,
+            index_fn = clients.qdrant.update_index if update else clients.qdrant.embed_index
+            index_fn(
+                embed_model=clients.embed_model,
                 data_chunked=data_chunked,
                 collection=collection,
+                batch_size=settings.index_batch_size,
+                job=job,
             )
 
+            # Answers built from the previous content of the collection are stale
+            clients.answer_cache.invalidate(collection['id'])
+
         finally:
-            # Step 4: Cleanup folder
-            shutil.rmtree(folder_path, ignore_errors=True)
+            # Step 3: Cleanup files
+            for _, stream in files:
+                stream.close()
 
         return
 
 
     @staticmethod
-    def retrieve(question: str, collections_name: List[str]) -> Dict:
+    async def retrieve(question: str, collections_name: List[str]) -> Dict:
         """
         Retrieve documents related to the question.
 
         Steps:
-            1. Get store indexes from collections.
-            2. Retrieve the nodes from the store index.
-        """
-        # Get store indexes from collections
-        embed_model = EmbedModel(
-            api_base=os.getenv("LLM_GATEWAY_URL"),
-            api_key=os.getenv("LLM_LAB_API_KEY"),
-            model_name=os.getenv("EM_MODEL"),
-            provider="openai",
-        )
-
-        rerank_model = RerankModel(
-            api_base=os.getenv("LLM_GATEWAY_URL"),
-            api_key=os.getenv("LLM_LAB_API_KEY"),
-            model_name=os.getenv("RM_MODEL"),
-        )
+            1. Questions naming articles ("Điều N") are answered by exact article lookup, without embedding.
+            2. Otherwise embed the question once.
+            3. Search every collection concurrently.
+            4. Rerank the paragraphs found in all collections together (RERANK=true), keeping the global top n.
+        """
+        return await RAGService._retrieve(question, collections_name)
 
-        qdrant_service = QdrantService(url=os.getenv("QDRANT_DB_URL"))
+    @staticmethod
+    async def _retrieve(
+            question: str,
+            collections_name: List[str],
+            query_embedding: Optional[List[float]] = None,
+    ) -> Dict:
+        paragraphs = await RAGService._search(question, collections_name, query_embedding)
+
+        with timed("query", "format"):
+            return {
+                "document_related": {name: format_paragraphs(paragraphs[name]) for name in collections_name}
+            }
 
-        store_indexes = {}
+    @staticmethod
+    async def _search(
+            question: str,
+            collections_name: List[str],
+            query_embedding: Optional[List[float]] = None,
+    ) -> Dict[str, List[Paragraph]]:
+        """
+        Paragraphs related to the question in each collection, see retrieve.
+        """
+        settings = get_settings()
+        clients = RAGService.clients()
+        qdrant_service = clients.qdrant
+
+        # Article fast path, collections without these articles fall back to the search
+        documents = {}
+        articles, chapter = find_article_references(question)
+        if articles:
+            found = await asyncio.gather(
+                *(article_retriever(qdrant_service, name, articles, chapter=chapter) for name in collections_name)
+            )
+            documents = {name: document for name, document in zip(collections_name, found) if document is not None}
 
-        for collection_name in collections_name:
-            # Get store index
-            store_index = qdrant_service.get_store_index(embed_model=embed_model, collection_name=collection_name)
+        remaining = [name for name in collections_name if name not in documents]
+        if remaining and query_embedding is None:
+            # Embed the question once, shared by every collection
+            with timed("query", "embed"):
+                query_embedding = await clients.embed_model.aget_query_embedding(question)
 
+        async def retrieve_collection(collection_name: str) -> List[Paragraph]:
             # Retrieve
-            document_related = retriever(
-                store_index=store_index,
+            return await retriever(
+                qdrant_service=qdrant_service,
+                collection_name=collection_name,
                 question=question,
+                query_embedding=query_embedding,
 
                 # Cosine Similarity
-                similarity_top_k=5,
-                similarity_cutoff=0.1,
+                similarity_top_k=SIMILARITY_TOP_K,
+                similarity_cutoff=SIMILARITY_CUTOFF,
+            )
 
-                # Rerank
-                enable_rerank=False,
-                rerank_client=rerank_model,
-                top_n=5,
+        # Latency follows the slowest collection instead of the sum of all of them
+        searched = await asyncio.gather(*(retrieve_collection(name) for name in remaining))
+        paragraphs = dict(zip(remaining, searched))
 
-                debug=False,
-            )
+        # Rerank: one cross-encoder call over the paragraphs of every collection, global top_n
+        if settings.rerank and paragraphs:
+            with timed("query", "rerank"):
+                paragraphs = await rerank_paragraphs(
+                    rerank_client=clients.rerank_model,
+                    question=question,
+                    paragraphs=paragraphs,
+                    top_n=settings.rerank_top_n,
+                )
+        documents.update(paragraphs)
 
-            store_indexes[collection_name] = document_related
+        return {name: documents[name] for name in collections_name}
 
-        return {
-            "document_related": store_indexes
+    @staticmethod
+    async def retrieve_batch(questions: List[str], collections_name: List[str]) -> Dict:
+        """
+        Retrieve documents related to each question, as retrieve does for one, in a single call.
+
+        Steps:
+            1. Questions naming articles ("Điều N") are answered by exact article lookup.
+            2. The other questions are embedded together, in one batched embedding request.
+            3. Every collection is searched for all its questions in one Qdrant batch query, collections concurrently.
+            4. Rerank (RERANK=true) of the paragraphs of each question across collections, questions concurrently.
+        """
+        settings = get_settings()
+        clients = RAGService.clients()
+        qdrant_service = clients.qdrant
+
+        # Article fast path, per question and collection
+        documents = [{} for _ in questions]
+        lookups = []
+        for i, question in enumerate(questions):
+            articles, chapter = find_article_references(question)
+            if articles:
+                lookups.extend((i, name, articles, chapter) for name in collections_name)
+        found = await asyncio.gather(
+            *(
+                article_retriever(qdrant_service, name, articles, chapter=chapter)
+                for _, name, articles, chapter in lookups
+            )
+        )
+        for (i, name, _, _), document in zip(lookups, found):
+            if document is not None:
+                documents[i][name] = document
+
+        # Questions left to search in each collection, embedded once for all collections
+        remaining = {
+            name: [i for i in range(len(questions)) if name not in documents[i]]
+            for name in collections_name
         }
+        to_embed = sorted({i for indices in remaining.values() for i in indices})
+        query_embeddings = {}
+        if to_embed:
+            with timed("query", "embed"):
+                embeddings = await clients.embed_model.aget_query_embeddings([questions[i] for i in to_embed])
+            query_embeddings = dict(zip(to_embed, embeddings))
+
+        searched_names = [name for name in collections_name if remaining[name]]
+        searched = await asyncio.gather(
+            *(
+                batch_retriever(
+                    qdrant_service=qdrant_service,
+                    collection_name=name,
+                    questions=[questions[i] for i in remaining[name]],
+                    query_embeddings=[query_embeddings[i] for i in remaining[name]],
+                    similarity_top_k=SIMILARITY_TOP_K,
+                    similarity_cutoff=SIMILARITY_CUTOFF,
+                )
+                for name in searched_names
+            )
+        )
+        paragraphs: List[Dict[str, List[Paragraph]]] = [{} for _ in questions]
+        for name, results in zip(searched_names, searched):
+            for i, found_paragraphs in zip(remaining[name], results):
+                paragraphs[i][name] = found_paragraphs
+
+        # Rerank: one cross-encoder call per question, over the paragraphs of every collection
+        if settings.rerank:
+            async def rerank(i: int) -> Dict[str, List[Paragraph]]:
+                if not paragraphs[i]:
+                    return paragraphs[i]
+                return await rerank_paragraphs(
+                    rerank_client=clients.rerank_model,
+                    question=questions[i],
+                    paragraphs=paragraphs[i],
+                    top_n=settings.rerank_top_n,
+                )
+
+            with timed("query", "rerank"):
+                paragraphs = list(await asyncio.gather(*(rerank(i) for i in range(len(questions)))))
+
+        with timed("query", "format"):
+            for i in range(len(questions)):
+                documents[i].update(paragraphs[i])
+
+            return {
+                "results": [
+                    {
+                        "question": question,
+                        "document_related": {name: format_paragraphs(documents[i][name]) for name in collections_name},
+                    }
+                    for i, question in enumerate(questions)
+                ]
+            }
 
     @staticmethod
-    def chat(question: str, collections_name: List[str]) -> Dict:
-        # Get list document related
-        document_related = RAGService.retrieve(question=question, collections_name=collections_name)['document_related']
+    def _build_messages(question: str, context: str) -> List[Dict]:
+        return [
+            {
+                "role": "system",
+                "content": CHAT_SYSTEM_PROMPT + context,
+            },
+            {
+                "role": "user",
+                "content": question,
+            },
+        ]
 
-        # Chat
-        from textwrap import dedent
+    @staticmethod
+    async def _chat_context(
+            question: str,
+            collections_name: List[str],
+            query_embedding: List[float],
+    ) -> Tuple[Dict, str]:
+        """
+        Documents related of each collection (returned to the client), and the context of the prompt: the paragraphs
+        of every collection deduplicated, by rank (by score after rerank), within CHAT_CONTEXT_MAX_TOKENS.
+        """
+        paragraphs = await RAGService._search(question, collections_name, query_embedding)
+
+        with timed("query", "format"):
+            document_related = {name: format_paragraphs(paragraphs[name]) for name in collections_name}
+        with timed("query", "context"):
+            context = build_context(
+                paragraphs,
+                max_tokens=get_settings().chat_context_max_tokens,
+                reranked=get_settings().rerank,
+            )
 
-        from openai import OpenAI
+        return document_related, context
 
-        client = OpenAI(
-            base_url=os.getenv("LLM_GATEWAY_URL"),
-            api_key=os.getenv("LLM_LAB_API_KEY"),
-        )
+    @staticmethod
+    async def chat(question: str, collections_name: List[str]) -> Dict:
+        """
+        Answer the question from the documents related, reusing the answer of a near-identical question
+        asked against the same collections.
+        """
+        clients = RAGService.clients()
+        with timed("query", "embed"):
+            query_embedding = await clients.embed_model.aget_query_embedding(question)
 
-        completion = client.chat.completions.create(
-            model=os.getenv("LLM_MODEL"),
-            messages=[
-                {
-                    "role": "system",
-                    "content": dedent(f"""\
-                        You are a Retrieval-Augmented Generation (RAG) chatbot.
-                        Your role is to find the right answer from the document for the user question.
-
-                        - Rules:
-                        <rules>
-                        - Always response with Markdown format.
-                        - When you don't know the answer, say "I don't know".
-                        </rules>
-s
-                        - Documents:
-                        {document_related}
-                    """)
-                },
-                {
-                    "role": "user",
-                    "content": question,
-                },
-            ],
-        )
+        cached = clients.answer_cache.get(collections_name, question, query_embedding)
+        if cached is not None:
+            return cached
 
-        answer = completion.choices[0].message.content
+        # Get list document related
+        document_related, context = await RAGService._chat_context(question, collections_name, query_embedding)
 
-        print(answer)
+        # Chat
+        with timed("query", "llm"):
+            completion = await clients.llm_client.chat.completions.create(
+                model=get_settings().llm_model,
+                messages=RAGService._build_messages(question, context),
+            )
 
-        return {
+        answer = completion.choices[0].message.content
+        logger.debug("Answer: %s", answer)
+
+        result = {
             "document_related": document_related,
             "answer": answer
         }
+        clients.answer_cache.set(collections_name, question, query_embedding, result)
+
+        return result
+
+    @staticmethod
+    async def chat_stream(question: str, collections_name: List[str]) -> AsyncIterator[Dict]:
+        """
+        Same as chat, as Server-Sent Events:
+            1. documents: the documents related (JSON), sent as soon as retrieval is done.
+            2. token: answer tokens (JSON string), as the LLM generates them.
+            3. done: end of the answer.
+        If retrieval or the LLM fails midway, an error event (JSON string) ends the stream instead of done:
+        the response status is already sent, the error can only be reported as an event.
+        """
+        try:
+            async for event in RAGService._chat_stream(question, collections_name):
+                yield event
+        except Exception:
+            logger.exception("Chat stream failed")
+            yield {"event": "error", "data": json.dumps(CHAT_STREAM_ERROR, ensure_ascii=False)}
+
+    @staticmethod
+    async def _chat_stream(question: str, collections_name: List[str]) -> AsyncIterator[Dict]:
+        clients = RAGService.clients()
+        with timed("query", "embed"):
+            query_embedding = await clients.embed_model.aget_query_embedding(question)
+
+        cached = clients.answer_cache.get(collections_name, question, query_embedding)
+        if cached is not None:
+            yield {"event": "documents", "data": json.dumps(cached["document_related"], ensure_ascii=False)}
+            yield {"event": "token", "data": json.dumps(cached["answer"], ensure_ascii=False)}
+            yield {"event": "done", "data": ""}
+            return
+
+        document_related, context = await RAGService._chat_context(question, collections_name, query_embedding)
+        yield {"event": "documents", "data": json.dumps(document_related, ensure_ascii=False)}
+
+        # Time to the last token (the client sees the first ones earlier)
+        with timed("query", "llm_stream"):
+            stream = await clients.llm_client.chat.completions.create(
+                model=get_settings().llm_model,
+                messages=RAGService._build_messages(question, context),
+                stream=True,
+            )
+
+            tokens = []
+            async for chunk in stream:
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                token = chunk.choices[0].delta.content
+                tokens.append(token)
+                yield {"event": "token", "data": json.dumps(token, ensure_ascii=False)}
+
+        clients.answer_cache.set(
+            collections_name,
+            question,
+            query_embedding,
+            {
+                "document_related": document_related,
+                "answer": "".join(tokens),
+            },
+        )
+        yield {"event": "done", "data": ""}
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The backend imports its modules from app/rag-be (common, config, services), as when run from there
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
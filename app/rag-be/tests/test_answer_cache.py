@@ -0,0 +1,38 @@
+from common.cache import AnswerCache
+
+COLLECTIONS = ["blds_2015"]
+# Questions naming different articles embed almost the same
+EMBEDDING = [1.0, 0.0, 0.0]
+NEAR_EMBEDDING = [0.999, 0.01, 0.0]
+
+
+def test_same_question_hits():
+    cache = AnswerCache(similarity_threshold=0.95)
+    cache.set(COLLECTIONS, "Điều 137 quy định gì?", EMBEDDING, {"answer": "137"})
+
+    assert cache.get(COLLECTIONS, "điều 137 quy định những gì?", NEAR_EMBEDDING) == {"answer": "137"}
+
+
+def test_article_numbers_do_not_collide():
+    cache = AnswerCache(similarity_threshold=0.95)
+    cache.set(COLLECTIONS, "Điều 137 quy định gì?", EMBEDDING, {"answer": "137"})
+
+    assert cache.get(COLLECTIONS, "Điều 138 quy định gì?", NEAR_EMBEDDING) is None
+    assert cache.get(COLLECTIONS, "Điều 137 Chương II quy định gì?", NEAR_EMBEDDING) is None
+    assert cache.get(COLLECTIONS, "Quy định chung là gì?", NEAR_EMBEDDING) is None
+
+    cache.set(COLLECTIONS, "Điều 138 quy định gì?", NEAR_EMBEDDING, {"answer": "138"})
+    assert cache.get(COLLECTIONS, "Điều 138 quy định gì?", EMBEDDING) == {"answer": "138"}
+    assert cache.get(COLLECTIONS, "Điều 137 quy định gì?", EMBEDDING) == {"answer": "137"}
+
+
+def test_invalidate_drops_every_scope_of_the_collection():
+    cache = AnswerCache(similarity_threshold=0.95)
+    cache.set(COLLECTIONS, "Điều 137 quy định gì?", EMBEDDING, {"answer": "137"})
+    cache.set(COLLECTIONS + ["luat_lao_dong"], "Điều 138 quy định gì?", EMBEDDING, {"answer": "138"})
+
+    cache.invalidate("blds_2015")
+
+    assert cache.get(COLLECTIONS, "Điều 137 quy định gì?", EMBEDDING) is None
+    assert cache.get(COLLECTIONS + ["luat_lao_dong"], "Điều 138 quy định gì?", EMBEDDING) is None
+    assert cache.stats()["invalidations"] == 2
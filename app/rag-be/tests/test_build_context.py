@@ -0,0 +1,56 @@
+import re
+
+from common.chunk import count_tokens
+from common.retrieve import Paragraph, build_context
+
+
+def paragraph(paragraph_id: str, score):
+    return Paragraph(paragraph_id, "law.md", f"/{paragraph_id}", f"Content of {paragraph_id}", score)
+
+
+def context_order(context: str):
+    return re.findall(r"^Position: law\.md/(\S+)$", context, re.MULTILINE)
+
+
+def collections():
+    return {
+        # RRF scores
+        "hybrid": [paragraph("h1", 0.032), paragraph("h2", 0.031), paragraph("h3", 0.016)],
+        # Cosine scores
+        "dense": [paragraph("d1", 0.82), paragraph("d2", 0.74), paragraph("d3", 0.61), paragraph("d4", 0.55)],
+    }
+
+
+def test_round_robin_by_rank_without_rerank():
+    context = build_context(collections(), max_tokens=6000)
+
+    assert context_order(context) == ["h1", "d1", "h2", "d2", "h3", "d3", "d4"]
+
+
+def test_budget_keeps_the_best_ranks_of_every_collection():
+    # Room for two paragraphs
+    budget = count_tokens(build_context({"hybrid": [paragraph("h1", 0.032), paragraph("d1", 0.82)]}, 6000)) + 4
+    context = build_context(collections(), max_tokens=budget)
+
+    assert context_order(context) == ["h1", "d1"]
+
+
+def test_exact_matches_first_and_duplicates_dropped():
+    paragraphs = collections()
+    paragraphs["articles"] = [paragraph("a1", None)]
+    paragraphs["dense"].insert(0, paragraph("h1", 0.9))
+
+    context = build_context(paragraphs, max_tokens=6000)
+
+    assert context_order(context) == ["a1", "h1", "h2", "d1", "h3", "d2", "d3", "d4"]
+
+
+def test_by_score_after_rerank():
+    paragraphs = {
+        "hybrid": [paragraph("h1", 0.4), paragraph("h2", 0.1)],
+        "dense": [paragraph("d1", 0.9), paragraph("d2", 0.3)],
+    }
+
+    context = build_context(paragraphs, max_tokens=6000, reranked=True)
+
+    assert context_order(context) == ["d1", "h1", "d2", "h2"]
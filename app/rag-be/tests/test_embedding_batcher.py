@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+
+from common.qdrant import EmbeddingBatcher
+
+
+def test_concurrent_texts_share_one_call():
+    calls = []
+
+    async def embed_batch(texts):
+        calls.append(texts)
+        return [[float(len(text))] for text in texts]
+
+    async def main():
+        batcher = EmbeddingBatcher(embed_batch, max_wait=0.01)
+        return await asyncio.gather(batcher.embed("a"), batcher.embed("bb"), batcher.embed("a"))
+
+    assert asyncio.run(main()) == [[1.0], [2.0], [1.0]]
+    assert calls == [["a", "bb"]]
+
+
+def test_failed_call_fails_every_caller():
+    async def embed_batch(texts):
+        raise RuntimeError("gateway down")
+
+    async def main():
+        batcher = EmbeddingBatcher(embed_batch, max_wait=0.0)
+        return await asyncio.gather(batcher.embed("a"), batcher.embed("b"), return_exceptions=True)
+
+    assert [str(result) for result in asyncio.run(main())] == ["gateway down", "gateway down"]
+
+
+def test_cancelled_call_cancels_the_callers():
+    async def main():
+        call_started = asyncio.Event()
+
+        async def embed_batch(texts):
+            call_started.set()
+            await asyncio.sleep(60)
+
+        batcher = EmbeddingBatcher(embed_batch, max_wait=0.0)
+        callers = [asyncio.ensure_future(batcher.embed(text)) for text in ("a", "b")]
+        await call_started.wait()
+        for task in list(batcher._tasks):
+            task.cancel()
+
+        done, _ = await asyncio.wait(callers, timeout=1)
+        return done, callers
+
+    done, callers = asyncio.run(main())
+    assert len(done) == 2
+    for caller in callers:
+        with pytest.raises(asyncio.CancelledError):
+            caller.result()
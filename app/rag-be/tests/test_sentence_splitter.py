@@ -0,0 +1,39 @@
+from llama_index.core.schema import NodeRelationship, TextNode
+
+from common.sentence_splitter import CustomSentenceSplitter
+
+
+def splitter():
+    return CustomSentenceSplitter(chunk_size=64, chunk_overlap=0, separator="\n")
+
+
+def section(file_name: str, header_path: str, text: str = "1. Trường hợp khác do luật định."):
+    return TextNode(text=text, metadata={"file_name": file_name, "header_path": header_path})
+
+
+def test_identical_chunks_get_distinct_stable_ids():
+    sections = [
+        section("a.md", "/Điều 1"),
+        section("a.md", "/Điều 1"),
+        section("a.md", "/Điều 2"),
+        section("b.md", "/Điều 1"),
+    ]
+
+    ids = [node.node_id for node in splitter()(sections)]
+
+    assert len(set(ids)) == len(ids)
+    assert ids == [node.node_id for node in splitter()(sections)]
+
+
+def test_relationships_name_the_new_ids():
+    text = "\n".join(f"Khoản {i}. Người lao động được nghỉ việc riêng mà vẫn hưởng nguyên lương." for i in range(12))
+
+    nodes = splitter()([section("a.md", "/Điều 115", text)])
+    ids = [node.node_id for node in nodes]
+
+    assert len(nodes) > 1
+    for i, node in enumerate(nodes):
+        if i > 0:
+            assert node.relationships[NodeRelationship.PREVIOUS].node_id == ids[i - 1]
+        if i < len(nodes) - 1:
+            assert node.relationships[NodeRelationship.NEXT].node_id == ids[i + 1]
@@ -1,3 +1,4 @@
+import json
 import os
 
 import httpx
@@ -6,6 +7,10 @@ from streamlit.runtime.uploaded_file_manager import UploadedFile
 URL = os.getenv("RAG_BE_URL")
 
 
+class ChatStreamError(Exception):
+    """The answer stream failed midway: error event, or stream closed before done."""
+
+
 async def get_qdrant_collections():
     url = f"{URL}/vector_database/qdrant/get_collections"
     async with httpx.AsyncClient() as client:
@@ -34,12 +39,28 @@ async def index_documents(collection_name: str, description: str, uploaded_files
             url=url,
             data=data,
             files=files,
-            timeout=60*60.0,
+            timeout=10*60.0,
         )
 
     return response
 
 
+async def get_index_job(job_id: str):
+    url = f"{URL}/rag/indexer/jobs/{job_id}"
+    async with httpx.AsyncClient() as client:
+        response = await client.get(url)
+        response.raise_for_status()
+        return response.json()
+
+
+async def cancel_index_job(job_id: str):
+    url = f"{URL}/rag/indexer/jobs/{job_id}/cancel"
+    async with httpx.AsyncClient() as client:
+        response = await client.post(url)
+        response.raise_for_status()
+        return response.json()
+
+
 async def retriever(collection_ids: list, messages: list[dict], mode: bool = False):
     if not mode:
         # Retriever
@@ -63,3 +84,39 @@ async def retriever(collection_ids: list, messages: list[dict], mode: bool = Fal
             timeout=60*60.0,
         )
     return response.json()
+
+
+async def chat_stream(collection_ids: list, messages: list[dict]):
+    """
+    Stream /rag/chat/stream, yield (event, data) as Server-Sent Events arrive:
+        - ("documents", dict): documents related.
+        - ("token", str): next tokens of the answer.
+    Raise ChatStreamError on an error event, or if the stream ends before the done event.
+    """
+    url = f"{URL}/rag/chat/stream"
+
+    data = {
+        "question": messages[-1]['content'],
+        "collection_ids": collection_ids,
+    }
+
+    async with httpx.AsyncClient() as client:
+        async with client.stream("POST", url=url, json=data, timeout=60*60.0) as response:
+            response.raise_for_status()
+
+            event, lines = None, []
+            async for line in response.aiter_lines():
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    lines.append(line[len("data:"):].strip())
+                elif not line and event:
+                    # Blank line ends one event
+                    if event == "done":
+                        return
+                    if event == "error":
+                        raise ChatStreamError(json.loads("\n".join(lines)))
+                    yield event, json.loads("\n".join(lines))
+                    event, lines = None, []
+
+            raise ChatStreamError("The answer stream ended before the answer was complete.")
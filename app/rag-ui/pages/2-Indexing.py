@@ -1,7 +1,8 @@
 import asyncio
+import time
 
 import streamlit as st
-from api.rag import index_documents
+from api.rag import cancel_index_job, get_index_job, index_documents
 
 st.set_page_config(page_title="Document Indexer")
 
@@ -33,22 +34,58 @@ if st.button("🚀 Index Documents"):
     if not uploaded_files or not collection_name:
         st.warning("⚠️ Please provide a collection name and at least one file.")
     else:
-        with st.spinner("Indexing in progress..."):
+        with st.spinner("Uploading documents..."):
             res = asyncio.run(index_documents(collection_name, description, uploaded_files))
 
-            if res.status_code == 200:
-                json_data = res.json()
-                returned_collection = json_data.get("collection_name")
-
-                st.success("✅ Documents indexed successfully!")
-
-                if returned_collection:
-                    st.markdown(f"""
-                    ### 📌 Indexed Collection
-                    ```
-                    {returned_collection}
-                    ```
-                    """)
-                    st.info("💡 You can now query this collection.")
-            else:
-                st.error(f"❌ Failed: {res.status_code} - {res.text}")
+        if res.status_code == 200:
+            st.session_state.index_job_id = res.json()["job"]["id"]
+        else:
+            st.error(f"❌ Failed: {res.status_code} - {res.text}")
+
+
+# Poll the indexing job (survives reruns, e.g. the cancel button)
+job_id = st.session_state.get("index_job_id")
+
+if job_id:
+    if st.button("🛑 Cancel indexing"):
+        asyncio.run(cancel_index_job(job_id))
+
+    progress_bar = st.progress(0.0, text="Queued...")
+    status = st.empty()
+
+    while True:
+        job = asyncio.run(get_index_job(job_id))
+        progress = job["progress"]
+
+        total = progress["chunks_produced"]
+        done = progress["points_upserted"]
+        eta = progress["eta_seconds"]
+
+        progress_bar.progress(
+            done / total if total else 0.0,
+            text=f"{job['stage'].capitalize()}... {done}/{total} chunks",
+        )
+        status.caption(
+            f"Embedded: {progress['chunks_embedded']} · Upserted: {done}"
+            + (f" · ETA: {eta:.0f}s" if eta is not None else "")
+        )
+
+        if job["status"] in ("succeeded", "failed", "cancelled"):
+            break
+        time.sleep(1)
+
+    del st.session_state.index_job_id
+
+    if job["status"] == "succeeded":
+        st.success("✅ Documents indexed successfully!")
+        st.markdown(f"""
+        ### 📌 Indexed Collection
+        ```
+        {job["collection"]["id"]}
+        ```
+        """)
+        st.info("💡 You can now query this collection.")
+    elif job["status"] == "cancelled":
+        st.warning("⚠️ Indexing cancelled.")
+    else:
+        st.error(f"❌ Failed: {job['error']}")
@@ -3,7 +3,7 @@
 import asyncio
 
 import streamlit as st
-from api.rag import get_qdrant_collections, retriever
+from api.rag import ChatStreamError, chat_stream, get_qdrant_collections, retriever
 
 import streamlit_nested_layout
 
@@ -38,6 +38,38 @@ async def load_collections():
 
 collections = fetch_collections_sync()
 
+
+def show_documents(document_related: dict):
+    with st.expander(
+        "📚 Documents Related: "
+    ):
+        for collection_name, content in document_related.items():
+            with st.expander(f"📁 {collection_name}"):
+                st.code(content.strip(), language="markdown")
+
+
+async def stream_answer(collection_ids: list, messages: list[dict]) -> str:
+    answer = ""
+    placeholder = st.empty()
+    placeholder.caption("⏳ Retrieving collection...")
+
+    try:
+        async for event, data in chat_stream(collection_ids, messages):
+            if event == "documents":
+                placeholder.empty()
+                show_documents(data)
+                placeholder = st.empty()
+            elif event == "token":
+                answer += data
+                placeholder.markdown(answer + "▌")
+    except ChatStreamError as e:
+        # Keep the part of the answer already shown
+        answer = f"{answer}\n\n❌ Error: {e}" if answer else f"❌ Error: {e}"
+
+    placeholder.markdown(answer)
+    return answer
+
+
 if collections:
     collection_names = [c["collection_name"] for c in collections]
     descriptions = {
@@ -70,36 +102,39 @@ if collections:
             st.markdown(user_input)
 
         with st.chat_message("assistant"):
-            with st.spinner("Retrieving collection..."):
-                try:
-                    response = asyncio.run(
-                        retriever(
-                            selected_ids,
-                            st.session_state.chat_history,
-                            mode
+            if not mode:
+                with st.spinner("Retrieving collection..."):
+                    try:
+                        response = asyncio.run(
+                            retriever(
+                                selected_ids,
+                                st.session_state.chat_history,
+                                mode
+                            )
                         )
-                    )
-                    if not mode:
                         assistant_reply = "This is retrieval mode, don't have answer."
-                    else:
-                        assistant_reply = response['answer']
-
-                    # Expander
-                    document_related = response['document_related']
-                    with st.expander(
-                        "📚 Documents Related: "
-                    ):
-                        for collection_name, content in document_related.items():
-                            with st.expander(f"📁 {collection_name}"):
-                                st.code(content.strip(), language="markdown")
 
+                        # Expander
+                        show_documents(response['document_related'])
+
+                    except Exception as e:
+                        assistant_reply = f"❌ Error: {e}"
+
+                    st.markdown(assistant_reply)
+            else:
+                # Chat mode: documents first, then the answer as it is generated
+                assistant_reply = ""
+                try:
+                    assistant_reply = asyncio.run(
+                        stream_answer(selected_ids, st.session_state.chat_history)
+                    )
                 except Exception as e:
                     assistant_reply = f"❌ Error: {e}"
+                    st.markdown(assistant_reply)
 
-                st.markdown(assistant_reply)
-                st.session_state.chat_history.append(
-                    {"role": "assistant", "content": assistant_reply}
-                )
+            st.session_state.chat_history.append(
+                {"role": "assistant", "content": assistant_reply}
+            )
 
 else:
     st.sidebar.warning("Don't have any collection available.")
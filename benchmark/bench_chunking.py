@@ -0,0 +1,116 @@
+"""
+Speed of the small-chunk merge stage of the chunker on the PLVN dataset.
+
+"before" is the previous implementation: list.pop in the middle of the list, neighbours recounted on
+every iteration and tiktoken.get_encoding looked up on every count. "after" is common.chunk.merge_small_chunks:
+a single pass over token counts computed once with a cached encoder.
+Both must produce the same chunks.
+
+The stage is tokenizer-bound: both encode every header section at least once, which is most of the time of
+"after", so the speedup is bounded (~1.1-2x per file). Counting through tiktoken's encode_batch (a thread pool)
+was slower than one encode per text on these inputs and is not used.
+
+Usage:
+    python benchmark/bench_chunking.py --min-chunk-size 256 --repeat 3
+"""
+import argparse
+import time
+
+import tiktoken
+from fixtures import DATASET
+from llama_index.core.ingestion import IngestionPipeline
+from llama_index.core.node_parser import MarkdownNodeParser
+from llama_index.core.schema import MetadataMode
+
+from common.chunk import load_documents, merge_nodes, merge_small_chunks
+
+
+def count_tokens_before(text: str, encoding_name: str = "cl100k_base") -> int:
+    encoding = tiktoken.get_encoding(encoding_name)
+    return len(encoding.encode(text))
+
+
+def merge_small_chunks_before(nodes, min_size=100):
+    nodes = list(nodes)
+    i = 0
+
+    while i < len(nodes):
+        curr_node = nodes[i]
+        curr_size = count_tokens_before(curr_node.get_content(metadata_mode=MetadataMode.NONE))
+
+        if curr_size < min_size:
+            prev_node = nodes[i - 1] if i > 0 else None
+            next_node = nodes[i + 1] if i < len(nodes) - 1 else None
+            prev_mergeable = prev_node and prev_node.metadata["file_name"] == curr_node.metadata["file_name"]
+            next_mergeable = next_node and next_node.metadata["file_name"] == curr_node.metadata["file_name"]
+
+            if prev_mergeable and next_mergeable:
+                prev_size = count_tokens_before(prev_node.get_content(metadata_mode=MetadataMode.NONE))
+                next_size = count_tokens_before(next_node.get_content(metadata_mode=MetadataMode.NONE))
+                if prev_size <= next_size:
+                    nodes[i - 1] = merge_nodes(prev_node, curr_node)
+                    nodes.pop(i)
+                    continue
+                else:
+                    nodes[i] = merge_nodes(curr_node, next_node)
+                    nodes.pop(i + 1)
+                    continue
+            elif prev_mergeable:
+                nodes[i - 1] = merge_nodes(prev_node, curr_node)
+                nodes.pop(i)
+                continue
+            elif next_mergeable:
+                nodes[i] = merge_nodes(curr_node, next_node)
+                nodes.pop(i + 1)
+                continue
+
+        i += 1
+
+    return nodes
+
+
+def timed(merge, nodes, min_size: int, repeat: int):
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = merge(nodes, min_size=min_size)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--min-chunk-size", type=int, default=256)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    pipeline = IngestionPipeline(transformations=[MarkdownNodeParser()])
+    documents = list(load_documents(folder_path=str(DATASET)))
+
+    print(f"{'file':<28} {'headers':>8} {'chunks':>7} {'before (ms)':>12} {'after (ms)':>11} {'speedup':>8}")
+    total_before = total_after = 0.0
+    for document in documents + [None]:
+        if document is None:
+            # All files in one list, as the chunker merged them before loading documents one at a time
+            name, nodes = "(all files)", pipeline.run(documents=documents)
+        else:
+            name, nodes = document.metadata["file_name"], pipeline.run(documents=[document])
+
+        before, expected = timed(merge_small_chunks_before, nodes, args.min_chunk_size, args.repeat)
+        after, merged = timed(merge_small_chunks, nodes, args.min_chunk_size, args.repeat)
+
+        assert [n.get_content(metadata_mode=MetadataMode.NONE) for n in merged] == \
+               [n.get_content(metadata_mode=MetadataMode.NONE) for n in expected], f"{name}: chunks differ"
+
+        if document is not None:
+            total_before += before
+            total_after += after
+        print(f"{name[:28]:<28} {len(nodes):>8} {len(merged):>7} {before * 1000:>12.1f} {after * 1000:>11.1f} "
+              f"{before / after:>7.1f}x")
+
+    print(f"{'(sum per file)':<28} {'':>8} {'':>7} {total_before * 1000:>12.1f} {total_after * 1000:>11.1f} "
+          f"{total_before / total_after:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Per-request latency of RAGService.retrieve: clients built per request vs. shared client registry.
+
+    - before: every request creates (and closes) Qdrant, embedding, rerank and LLM clients.
+    - after: one ClientRegistry created at startup, reused by every request.
+
+Needs a running Qdrant (QDRANT_DB_URL). The LLM gateway is replaced by the local stub unless
+--real-gateway is given. A throwaway collection is created from the PLVN dataset and dropped at the end.
+
+Usage:
+    QDRANT_DB_URL=http://localhost:6333 python benchmark/bench_clients.py --requests 200
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from fixtures import QUESTION, index_nodes, load_nodes, report
+from stub_gateway import serve_in_thread
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--nodes", type=int, default=200, help="Paragraphs to index in the throwaway collection")
+    parser.add_argument("--stub-port", type=int, default=8100)
+    parser.add_argument("--real-gateway", action="store_true", help="Use LLM_GATEWAY_URL instead of the stub")
+    args = parser.parse_args()
+
+    if not args.real_gateway:
+        serve_in_thread(args.stub_port)
+        os.environ["LLM_GATEWAY_URL"] = f"http://127.0.0.1:{args.stub_port}/v1"
+        os.environ.setdefault("LLM_LAB_API_KEY", "stub")
+        os.environ.setdefault("EM_MODEL", "bge-m3")
+        os.environ.setdefault("LLM_MODEL", "stub")
+    # Every request pays the embedding call: with the caches, "after" would answer the repeated question from the
+    # embedding cache of the shared registry and measure the cache rather than the reuse of the clients
+    os.environ["EMBEDDING_CACHE_SIZE"] = "0"
+    os.environ["ANSWER_CACHE_SIZE"] = "0"
+    os.environ["RERANK_CACHE_SIZE"] = "0"
+
+    from services import RAGService
+
+    collection_id = f"bench_clients_{int(time.time())}"
+
+    RAGService.startup()
+    index_nodes(RAGService.clients(), collection_id, load_nodes(args.nodes))
+    await RAGService.shutdown()
+
+    try:
+        # Before: clients constructed per request
+        before = []
+        for _ in range(args.requests):
+            start = time.perf_counter()
+            RAGService.startup()
+            await RAGService.retrieve(QUESTION, [collection_id])
+            await RAGService.shutdown()
+            before.append(time.perf_counter() - start)
+
+        # After: shared registry
+        RAGService.startup()
+        after = []
+        for _ in range(args.requests):
+            start = time.perf_counter()
+            await RAGService.retrieve(QUESTION, [collection_id])
+            after.append(time.perf_counter() - start)
+
+        report("before", before)
+        report("after", after)
+    finally:
+        RAGService.clients().qdrant.client.delete_collection(collection_id)
+        await RAGService.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
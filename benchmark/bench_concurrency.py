@@ -0,0 +1,89 @@
+"""
+Throughput of one rag-be worker under concurrent clients, against local stand-ins.
+
+The backend runs in-process (one uvicorn worker) with an in-memory Qdrant and the stub LLM gateway,
+which answers every call after --latency-ms. With a non-blocking request path, throughput grows
+with the number of concurrent clients; with a blocking one it stays flat at ~1/latency.
+
+Usage:
+    python benchmark/bench_concurrency.py --latency-ms 100 --concurrency 1 2 4 8 16 32
+"""
+import argparse
+import asyncio
+import os
+import time
+
+import httpx
+from fixtures import QUESTION, index_nodes, load_nodes, start_backend, use_memory_qdrant
+from stub_gateway import serve_in_thread
+
+COLLECTION = {
+    "id": "bench_concurrency",
+    "collection_name": "bench_concurrency",
+    "description": "Benchmark collection",
+}
+
+
+async def run_level(url: str, path: str, concurrency: int, requests_per_client: int):
+    payload = {"question": QUESTION, "collection_ids": [COLLECTION["id"]]}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=300.0) as client:
+        async def worker():
+            errors = 0
+            for _ in range(requests_per_client):
+                response = await client.post(path, json=payload)
+                errors += response.status_code != 200
+            return errors
+
+        start = time.perf_counter()
+        errors = sum(await asyncio.gather(*(worker() for _ in range(concurrency))))
+        elapsed = time.perf_counter() - start
+
+    total = concurrency * requests_per_client
+    return total / elapsed, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency-ms", type=float, default=100.0, help="Stub gateway latency per call")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--requests-per-client", type=int, default=10)
+    parser.add_argument("--path", default="/rag/retriever", choices=["/rag/retriever", "/rag/chat"])
+    parser.add_argument("--stub-port", type=int, default=8100)
+    parser.add_argument("--port", type=int, default=8101)
+    args = parser.parse_args()
+
+    stub = serve_in_thread(args.stub_port)
+    os.environ["LLM_GATEWAY_URL"] = f"http://127.0.0.1:{args.stub_port}/v1"
+    os.environ.setdefault("LLM_LAB_API_KEY", "stub")
+    os.environ.setdefault("EM_MODEL", "bge-m3")
+    os.environ.setdefault("LLM_MODEL", "stub")
+    # Every request pays the embedding (and chat) call: the repeated question would otherwise be answered
+    # from the caches after the first request and the gateway latency would not be measured
+    os.environ["EMBEDDING_CACHE_SIZE"] = "0"
+    os.environ["ANSWER_CACHE_SIZE"] = "0"
+
+    from services import RAGService
+
+    # Index with a latency-free gateway, then slow it down for the measurement
+    RAGService.startup()
+    clients = RAGService.clients()
+    use_memory_qdrant(clients.qdrant)
+    index_nodes(clients, COLLECTION["id"], load_nodes(200))
+    clients.qdrant._add_to_metadata(COLLECTION)
+
+    stub.config.app.state.latency = args.latency_ms / 1000
+
+    start_backend(args.port)
+    url = f"http://127.0.0.1:{args.port}"
+
+    print(f"{args.path} (stub latency {args.latency_ms:.0f}ms per call)")
+    print(f"{'concurrency':>12} {'req/s':>10} {'errors':>8}")
+    for concurrency in args.concurrency:
+        throughput, errors = asyncio.run(run_level(url, args.path, concurrency, args.requests_per_client))
+        print(f"{concurrency:>12} {throughput:>10.1f} {errors:>8}")
+
+
+if __name__ == "__main__":
+    main()
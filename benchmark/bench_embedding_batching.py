@@ -0,0 +1,85 @@
+"""
+Query-embedding throughput and latency under concurrent requests, with and without micro-batching
+(EmbeddingBatcher, EMBEDDING_BATCH_WAIT_MS / EMBEDDING_BATCH_MAX_SIZE).
+
+Concurrent clients embed unique questions (no cache) through EmbedModel.aget_query_embedding against the stub
+gateway, set up like bge-m3 on llama-server: --parallel slots, a fixed latency per call plus a small latency per
+input of the batch. Without batching every question takes a slot, so under load questions queue for the slots;
+with batching the questions arriving within the window share one call.
+
+Usage:
+    python benchmark/bench_embedding_batching.py --concurrency 1 8 32 64 --waits-ms 0 2 5
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+from fixtures import QUESTION, percentile
+from stub_gateway import serve_in_thread
+
+from common.qdrant import EmbedModel
+
+
+async def run_level(embed_model: EmbedModel, concurrency: int, requests_per_client: int):
+    latencies = []
+
+    async def client(client_id: int):
+        for i in range(requests_per_client):
+            start = time.perf_counter()
+            await embed_model.aget_query_embedding(f"{QUESTION} ({client_id}, {i})")
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(client_id) for client_id in range(concurrency)))
+    return len(latencies) / (time.perf_counter() - start), latencies
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32, 64])
+    parser.add_argument("--waits-ms", type=float, nargs="+", default=[0, 2, 5], help="Batch windows, 0: no batching")
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--requests-per-client", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="Stub latency per embedding call")
+    parser.add_argument("--latency-per-input-ms", type=float, default=0.5, help="Stub latency per input")
+    parser.add_argument("--parallel", type=int, default=4, help="Stub slots, as llama-server --parallel")
+    parser.add_argument("--dimension", type=int, default=1024, help="Lower it to cut the client-side decoding cost")
+    parser.add_argument("--stub-port", type=int, default=8150)
+    args = parser.parse_args()
+
+    stub = serve_in_thread(args.stub_port, dimension=args.dimension)
+    stub.config.app.state.latency = args.latency_ms / 1000
+    stub.config.app.state.latency_per_input = args.latency_per_input_ms / 1000
+    stub.config.app.state.parallel = args.parallel
+    calls = stub.config.app.state.calls
+
+    limits = httpx.Limits(max_connections=200, max_keepalive_connections=200)
+    async with httpx.AsyncClient(limits=limits, timeout=300) as async_http_client:
+        print(
+            f"stub: {args.latency_ms:.0f}ms + {args.latency_per_input_ms}ms per input, {args.parallel} slots; "
+            f"{args.requests_per_client} questions per client"
+        )
+        print(f"{'wait ms':>8} {'clients':>8} {'q/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'calls':>7} {'batch':>7}")
+        for wait_ms in args.waits_ms:
+            embed_model = EmbedModel(
+                api_base=f"http://127.0.0.1:{args.stub_port}/v1",
+                model_name="bge-m3",
+                api_key="stub",
+                async_http_client=async_http_client,
+                batch_max_size=args.max_batch_size,
+                batch_wait=wait_ms / 1000,
+            )
+            for concurrency in args.concurrency:
+                before = calls["embeddings"]
+                throughput, latencies = await run_level(embed_model, concurrency, args.requests_per_client)
+                embedding_calls = calls["embeddings"] - before
+                print(
+                    f"{wait_ms:>8g} {concurrency:>8} {throughput:>9.1f} "
+                    f"{percentile(latencies, 50) * 1000:>9.1f} {percentile(latencies, 99) * 1000:>9.1f} "
+                    f"{embedding_calls:>7} {len(latencies) / embedding_calls:>7.1f}"
+                )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,228 @@
+"""
+Offline retrieval quality and latency on the PLVN question set (the questions of test/test.py).
+
+Everything runs in-process: the laws of the question set are chunked and indexed from dataset/preprocessed/PLVN
+into an in-memory Qdrant (one collection per law), embedded by the deterministic stub gateway, then every question
+goes through the request path of /rag/retriever stage by stage.
+
+Reports:
+    - index: chunking and embedding + upsert time per law.
+    - embed, search, rerank, total: per-question latency percentiles of each stage (p50/p95/p99).
+    - recall@k: share of the ground-truth articles ("Điều N") found in the first k articles retrieved, articles
+      ranked by the rank of their paragraph.
+    - MRR: mean reciprocal rank of the first ground-truth article.
+
+Compare settings by running it once per setting, e.g. --hybrid, --rerank, --min-chunk-size/--max-chunk-size.
+With the stub gateway the quality numbers reflect its bag-of-words embeddings; point --gateway-url at the real
+LLM gateway (EM_MODEL/RM_MODEL) to score the real models.
+
+Usage:
+    python benchmark/bench_retrieval.py --repeat 5
+    python benchmark/bench_retrieval.py --hybrid --rerank --output results/hybrid_rerank.json
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import time
+
+from fixtures import DATASET, percentile, report, use_memory_qdrant
+from qdrant_client.http.models import FieldCondition, Filter, MatchValue
+from stub_gateway import serve_in_thread
+
+# (law file, question, ground truth)
+QUESTIONS = [
+    ("45_2019_QH14_333670.md", "Người lao động bị sa thải có được trả lương hay không?", "Điều 34, 48, 125"),
+    ("45_2019_QH14_333670.md", "Người sử dụng lao động được sa thải người lao động nữ đang mang thai không?", "Điều 137"),
+    ("45_2019_QH14_333670.md", "Quy định về điều chuyển nhân sự được quy định như thế nào?", "Điều 21, Điều 29"),
+    ("45_2019_QH14_333670.md", "Làm việc 8h một ngày thì được nghỉ giữa giờ ít nhất bao nhiêu phút?", "Điều 105, 109, 18"),
+    (
+        "45_2019_QH14_333670.md",
+        "Người sử dụng lao động đào tạo nghề nghiệp và phát triển kỹ năng nghề cho người lao động như thế nào?",
+        "Điều 61, 62, 39",
+    ),
+    ("45_2019_QH14_333670.md", "Nguyên tắc cho thuê lại lao động là gì?", "Điều 53"),
+    ("45_2019_QH14_333670.md", "Thời hạn của thỏa ước lao động tập thể như thế nào?", "Điều 78, 83, 76"),
+    ("45_2019_QH14_333670.md", "Hợp đồng lao động được giao kết theo hình thức nào?", "Điều 13, 20"),
+    ("45_2019_QH14_333670.md", "Nội dung về đào tạo lao động có bắt buộc phải ghi vào hợp đồng lao động?", "Điều 21, 61"),
+    (
+        "145_2020_ND-CP_459400.md",
+        "Người lao động được thuê làm giám đốc doanh nghiệp Nhà nước được hưởng các chế độ về tiền lương, "
+        "thưởng như thế nào?",
+        "Điều 5, 2, 101",
+    ),
+]
+
+RECALL_AT = (1, 3, 5, 10)
+
+
+def ranked_articles(paragraphs):
+    from common.articles import paragraph_articles
+
+    articles = []
+    for paragraph in paragraphs:
+        articles.extend(paragraph_articles(paragraph.header_path or "", paragraph.content))
+    return list(dict.fromkeys(articles))
+
+
+def score(retrieved, expected):
+    recalls = {k: len(set(retrieved[:k]) & set(expected)) / len(expected) for k in RECALL_AT}
+    rank = next((i + 1 for i, article in enumerate(retrieved) if article in expected), None)
+    return recalls, 1 / rank if rank else 0.0
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of the question set, for the latency stats")
+    parser.add_argument("--top-k", type=int, default=5, help="Chunks searched per collection")
+    parser.add_argument("--similarity-cutoff", type=float, default=0.1)
+    parser.add_argument("--min-chunk-size", type=int, default=256)
+    parser.add_argument("--max-chunk-size", type=int, default=1024)
+    parser.add_argument("--hybrid", action="store_true", help="Dense + BM25 collections (HYBRID_SEARCH)")
+    parser.add_argument("--rerank", action="store_true", help="Rerank the paragraphs found (RERANK)")
+    parser.add_argument("--rerank-top-n", type=int, default=5)
+    parser.add_argument("--gateway-url", help="Real LLM gateway instead of the stub one")
+    parser.add_argument("--qdrant-url", help="Use a running Qdrant instead of the in-memory one")
+    parser.add_argument("--stub-port", type=int, default=8110)
+    parser.add_argument("--output", help="Write the settings, metrics and per-question results as JSON")
+    args = parser.parse_args()
+
+    if args.gateway_url:
+        os.environ["LLM_GATEWAY_URL"] = args.gateway_url
+    else:
+        serve_in_thread(args.stub_port)
+        os.environ["LLM_GATEWAY_URL"] = f"http://127.0.0.1:{args.stub_port}/v1"
+        os.environ.setdefault("LLM_LAB_API_KEY", "stub")
+        os.environ.setdefault("EM_MODEL", "bge-m3")
+        os.environ.setdefault("RM_MODEL", "bge-reranker")
+    if args.qdrant_url:
+        os.environ["QDRANT_DB_URL"] = args.qdrant_url
+    os.environ["HYBRID_SEARCH"] = str(args.hybrid).lower()
+    # Every run pays the embedding and rerank calls, as the first time a question is asked
+    os.environ["EMBEDDING_CACHE_SIZE"] = "0"
+    os.environ["RERANK_CACHE_SIZE"] = "0"
+
+    from common.articles import find_article_references
+    from common.chunk import chunker
+    from common.qdrant import METADATA_COLLECTION
+    from common.retrieve import rerank_paragraphs, retriever
+    from services import RAGService
+
+    RAGService.startup()
+    clients = RAGService.clients()
+    if not args.qdrant_url:
+        use_memory_qdrant(clients.qdrant)
+
+    suffix = int(time.time())
+    collections = {}
+    try:
+        # Index the laws of the question set
+        for file_name in dict.fromkeys(file_name for file_name, _, _ in QUESTIONS):
+            collection_id = f"bench_retrieval_{file_name.split('.')[0]}_{suffix}"
+            with open(DATASET / file_name, "rb") as f:
+                files = [(file_name, io.BytesIO(f.read()))]
+
+            start = time.perf_counter()
+            chunks = chunker(files=files, min_chunk_size=args.min_chunk_size, max_chunk_size=args.max_chunk_size)
+            chunked = time.perf_counter()
+            clients.qdrant.embed_index(
+                embed_model=clients.embed_model,
+                data_chunked=chunks,
+                collection={"id": collection_id, "collection_name": file_name, "description": ""},
+            )
+            indexed = time.perf_counter()
+            collections[file_name] = collection_id
+            print(
+                f"index {file_name}: {len(chunks)} chunks, chunking {chunked - start:.2f}s, "
+                f"embedding + upsert {indexed - chunked:.2f}s"
+            )
+
+        latencies = {"embed": [], "search": [], "rerank": [], "total": []}
+        results = []
+        for run in range(args.repeat):
+            for file_name, question, ground_truth in QUESTIONS:
+                collection_id = collections[file_name]
+
+                start = time.perf_counter()
+                query_embedding = await clients.embed_model.aget_query_embedding(question)
+                embedded = time.perf_counter()
+                paragraphs = {
+                    collection_id: await retriever(
+                        qdrant_service=clients.qdrant,
+                        collection_name=collection_id,
+                        question=question,
+                        query_embedding=query_embedding,
+                        similarity_top_k=args.top_k,
+                        similarity_cutoff=args.similarity_cutoff,
+                    )
+                }
+                searched = time.perf_counter()
+                if args.rerank:
+                    paragraphs = await rerank_paragraphs(
+                        clients.rerank_model, question, paragraphs, top_n=args.rerank_top_n,
+                    )
+                reranked = time.perf_counter()
+
+                latencies["embed"].append(embedded - start)
+                latencies["search"].append(searched - embedded)
+                if args.rerank:
+                    latencies["rerank"].append(reranked - searched)
+                latencies["total"].append(reranked - start)
+
+                if run == 0:
+                    expected, _ = find_article_references(ground_truth)
+                    retrieved = ranked_articles(paragraphs[collection_id])
+                    recalls, reciprocal_rank = score(retrieved, expected)
+                    results.append({
+                        "question": question,
+                        "expected": expected,
+                        "retrieved": retrieved,
+                        "recall": recalls,
+                        "reciprocal_rank": reciprocal_rank,
+                    })
+
+        print(f"\n{'question':<60} {'expected':<16} retrieved")
+        for result in results:
+            print(f"{result['question'][:58]:<60} {str(result['expected']):<16} {result['retrieved'][:10]}")
+
+        print("\nlatency")
+        for stage, values in latencies.items():
+            if values:
+                report(stage, values)
+
+        metrics = {f"recall@{k}": sum(r["recall"][k] for r in results) / len(results) for k in RECALL_AT}
+        metrics["mrr"] = sum(r["reciprocal_rank"] for r in results) / len(results)
+        print("\nquality " + " ".join(f"{name}={value:.3f}" for name, value in metrics.items()))
+
+        if args.output:
+            os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(
+                    {
+                        "settings": vars(args),
+                        "metrics": metrics,
+                        "latency_ms": {
+                            stage: {f"p{q}": percentile(values, q) * 1000 for q in (50, 95, 99)}
+                            for stage, values in latencies.items() if values
+                        },
+                        "questions": results,
+                    },
+                    f,
+                    ensure_ascii=False,
+                    indent=2,
+                )
+    finally:
+        for collection_id in collections.values():
+            for name in (collection_id, clients.qdrant.paragraph_collection_name(collection_id)):
+                if clients.qdrant.client.collection_exists(name):
+                    clients.qdrant.client.delete_collection(name)
+            clients.qdrant.client.delete(
+                METADATA_COLLECTION,
+                points_selector=Filter(must=[FieldCondition(key="id", match=MatchValue(value=collection_id))]),
+            )
+        await RAGService.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,128 @@
+"""
+Per-query cost of the vector search: llama-index retriever vs. QdrantService.asearch.
+
+    - before: VectorStoreIndex.as_retriever, which fetches the whole payload (serialized node blob,
+      relationships, all metadata) and rebuilds a TextNode per hit.
+    - after: QdrantService.asearch, which fetches only the payload fields read by the retriever.
+
+Reports, per query:
+    - search: end-to-end latency. Only meaningful with --qdrant-url: the in-memory Qdrant applies the payload
+      projection in Python, while a real server does it before sending the response.
+    - decode: client-side CPU to turn the REST response body into results (JSON + models, TextNode rebuild).
+    - payload: bytes of payload in the response.
+
+Usage:
+    python benchmark/bench_search.py --queries 200 --top-k 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from fixtures import QUESTION, index_nodes, load_nodes, report, use_memory_qdrant
+from llama_index.core import VectorStoreIndex
+from llama_index.core.schema import QueryBundle
+from llama_index.vector_stores.qdrant import QdrantVectorStore
+from qdrant_client.http.models import ScoredPoint
+from stub_gateway import serve_in_thread
+
+from common.qdrant import SEARCH_PAYLOAD_FIELDS, SearchHit
+
+
+def payload_bytes(payloads) -> int:
+    return sum(len(json.dumps(payload, ensure_ascii=False).encode()) for payload in payloads)
+
+
+def response_body(points) -> bytes:
+    return json.dumps({"result": {"points": [point.model_dump() for point in points]}}).encode()
+
+
+def time_decode(body: bytes, build, repeat: int):
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        points = [ScoredPoint(**point) for point in json.loads(body)["result"]["points"]]
+        build(points)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=20)
+    parser.add_argument("--nodes", type=int, default=500, help="Paragraphs to index in the throwaway collection")
+    parser.add_argument("--qdrant-url", help="Use a running Qdrant instead of the in-memory one")
+    parser.add_argument("--stub-port", type=int, default=8100)
+    args = parser.parse_args()
+
+    serve_in_thread(args.stub_port)
+    os.environ["LLM_GATEWAY_URL"] = f"http://127.0.0.1:{args.stub_port}/v1"
+    os.environ.setdefault("LLM_LAB_API_KEY", "stub")
+    os.environ.setdefault("EM_MODEL", "bge-m3")
+    if args.qdrant_url:
+        os.environ["QDRANT_DB_URL"] = args.qdrant_url
+
+    from services import RAGService
+
+    collection_id = f"bench_search_{int(time.time())}"
+
+    RAGService.startup()
+    clients = RAGService.clients()
+    if not args.qdrant_url:
+        use_memory_qdrant(clients.qdrant)
+    index_nodes(clients, collection_id, load_nodes(args.nodes))
+
+    query_embedding = await clients.embed_model.aget_query_embedding(QUESTION)
+    # The previous query path of rag-be, bound to the async client
+    vector_store = QdrantVectorStore(collection_id, aclient=clients.qdrant.aclient, batch_size=20, enable_hybrid=False)
+    store_index = VectorStoreIndex.from_vector_store(vector_store, embed_model=clients.embed_model.get_embed_model())
+    retriever = store_index.as_retriever(similarity_top_k=args.top_k)
+
+    try:
+        # Before: llama-index retriever
+        before = []
+        for _ in range(args.queries):
+            start = time.perf_counter()
+            nodes = await retriever.aretrieve(QueryBundle(query_str=QUESTION, embedding=query_embedding))
+            before.append(time.perf_counter() - start)
+        full = await clients.qdrant.aclient.query_points(
+            collection_id, query=query_embedding, limit=args.top_k, with_payload=True,
+        )
+        before_bytes = payload_bytes(point.payload for point in full.points)
+
+        # After: payload projection, no node rebuild
+        after = []
+        for _ in range(args.queries):
+            start = time.perf_counter()
+            hits = await clients.qdrant.asearch(collection_id, query_embedding, limit=args.top_k)
+            after.append(time.perf_counter() - start)
+        after_bytes = payload_bytes(hit.metadata for hit in hits)
+
+        assert [node.node_id for node in nodes] == [hit.node_id for hit in hits], "Results differ"
+
+        projected = await clients.qdrant.aclient.query_points(
+            collection_id, query=query_embedding, limit=args.top_k, with_payload=SEARCH_PAYLOAD_FIELDS,
+        )
+        decode_before = time_decode(
+            response_body(full.points), retriever._vector_store.parse_to_query_result, args.queries,
+        )
+        decode_after = time_decode(
+            response_body(projected.points), lambda points: [SearchHit.from_point(p) for p in points], args.queries,
+        )
+
+        print("search")
+        report("before", before)
+        report("after", after)
+        print("decode")
+        report("before", decode_before)
+        report("after", decode_after)
+        print(f"payload per query: before={before_bytes / 1024:.1f}KB after={after_bytes / 1024:.1f}KB")
+    finally:
+        await clients.qdrant.aclient.delete_collection(collection_id)
+        await RAGService.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
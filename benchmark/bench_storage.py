@@ -0,0 +1,155 @@
+"""
+Memory, latency and recall of the storage profiles (common/storage.py).
+
+For each profile, a throwaway collection is created with the profile (QdrantService._create_collection) and filled
+with the same vectors (stub embeddings of the PLVN paragraphs), then:
+    - memory: RAM/disk of the collection segments reported by the Qdrant telemetry, and the RAM estimate of the
+      vectors (float32, int8 or 1 bit per dimension, plus the float32 originals unless on disk).
+    - latency: per query, searched with the search-time options of the profile (hnsw_ef, rescoring).
+    - recall@k: overlap with the exact search (no HNSW, no quantization) on the same collection, ties with the
+      k-th exact result counting as hits.
+
+Only meaningful with --qdrant-url: the in-memory Qdrant searches by brute force and ignores HNSW, quantization and
+on-disk options.
+
+Usage:
+    python benchmark/bench_storage.py --qdrant-url http://localhost:6333 --queries 200 --top-k 10
+"""
+import argparse
+import random
+import time
+
+import httpx
+from fixtures import DATASET, report
+from qdrant_client import QdrantClient
+from qdrant_client.http.models import OptimizersConfigDiff, PointStruct, QuantizationSearchParams, SearchParams
+from stub_gateway import DIMENSION, embed_text
+
+from common.qdrant import QdrantService
+from common.storage import STORAGE_PROFILES, get_storage_profile
+
+
+def load_paragraphs(limit: int):
+    """
+    Unique paragraphs of the dataset: duplicates would tie in the exact search and blur the recall.
+    """
+    paragraphs = {}
+    for path in sorted(DATASET.glob("*.md")):
+        for paragraph in path.read_text(encoding="utf-8").split("\n\n"):
+            if paragraph.strip():
+                paragraphs.setdefault(paragraph.strip(), None)
+    return list(paragraphs)[:limit]
+
+
+def estimated_ram(profile, points: int, dimension: int) -> int:
+    original = 0 if profile.on_disk_vectors else points * dimension * 4
+    if profile.quantization == "scalar":
+        return original + points * dimension
+    if profile.quantization == "binary":
+        return original + points * dimension // 8
+    return original
+
+
+def segments_usage(qdrant_url: str, collection_name: str):
+    """
+    (RAM, disk) bytes of the segments of the collection from the Qdrant telemetry, None when not available.
+    """
+    try:
+        response = httpx.get(f"{qdrant_url}/telemetry", params={"details_level": 3}, timeout=30)
+        response.raise_for_status()
+        collections = response.json()["result"]["collections"]["collections"]
+        collection = next(c for c in collections if c["id"] == collection_name)
+        ram = disk = 0
+        for shard in collection["shards"]:
+            for segment in (shard.get("local") or {}).get("segments", []):
+                ram += segment["info"].get("ram_usage_bytes", 0)
+                disk += segment["info"].get("disk_usage_bytes", 0)
+        return ram, disk
+    except (httpx.HTTPError, KeyError, StopIteration):
+        return None
+
+
+def wait_indexed(client: QdrantClient, collection_name: str, points: int, timeout: float = 600):
+    start = time.time()
+    while time.time() - start < timeout:
+        info = client.get_collection(collection_name)
+        if info.status == "green" and (info.indexed_vectors_count or 0) >= points:
+            return
+        time.sleep(1)
+    print(f"[!] {collection_name} not fully indexed after {timeout}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profiles", nargs="+", default=list(STORAGE_PROFILES), choices=list(STORAGE_PROFILES))
+    parser.add_argument("--points", type=int, default=20000, help="Paragraphs to index (at most the whole dataset)")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--hnsw-ef", type=int, help="Override the search-time ef of every profile")
+    parser.add_argument("--qdrant-url", help="Use a running Qdrant instead of the in-memory one")
+    args = parser.parse_args()
+
+    qdrant = QdrantService(url=args.qdrant_url or "http://localhost:6333")
+    if not args.qdrant_url:
+        qdrant.client = QdrantClient(location=":memory:")
+
+    paragraphs = load_paragraphs(args.points)
+    vectors = [embed_text(paragraph) for paragraph in paragraphs]
+    random.seed(0)
+    queries = [embed_text(" ".join(p.split()[:12])) for p in random.choices(paragraphs, k=args.queries)]
+    print(f"{len(vectors)} points, {len(queries)} queries, top {args.top_k}")
+
+    exact = SearchParams(exact=True, quantization=QuantizationSearchParams(ignore=True))
+    for name in args.profiles:
+        profile = get_storage_profile(name, hnsw_ef=args.hnsw_ef)
+        collection_name = f"bench_storage_{name}_{int(time.time())}"
+        try:
+            qdrant._create_collection(collection_name, DIMENSION, hybrid=False, profile=profile)
+            if args.qdrant_url:
+                # Build the HNSW graph (and quantize) even for a small benchmark collection
+                qdrant.client.update_collection(
+                    collection_name, optimizers_config=OptimizersConfigDiff(indexing_threshold=1000),
+                )
+
+            for start in range(0, len(vectors), 256):
+                qdrant.client.upsert(
+                    collection_name,
+                    points=[
+                        PointStruct(id=i, vector=vectors[i])
+                        for i in range(start, min(start + 256, len(vectors)))
+                    ],
+                )
+            if args.qdrant_url:
+                wait_indexed(qdrant.client, collection_name, len(vectors))
+
+            latencies, recalls = [], []
+            for query in queries:
+                truth = qdrant.client.query_points(
+                    collection_name, query=query, limit=args.top_k, search_params=exact,
+                ).points
+
+                start = time.perf_counter()
+                found = qdrant.client.query_points(
+                    collection_name, query=query, limit=args.top_k, search_params=profile.search_params(),
+                ).points
+                latencies.append(time.perf_counter() - start)
+
+                # Points tied with the k-th exact result are as good as it
+                expected = {point.id for point in truth}
+                threshold = truth[-1].score - 1e-6 if truth else 0.0
+                hits = sum(1 for point in found if point.id in expected or point.score >= threshold)
+                recalls.append(min(hits, len(truth)) / (len(truth) or 1))
+
+            usage = segments_usage(args.qdrant_url, collection_name) if args.qdrant_url else None
+            print(
+                f"{name}: recall@{args.top_k}={sum(recalls) / len(recalls):.3f} "
+                f"vectors RAM (estimate)={estimated_ram(profile, len(vectors), DIMENSION) / 2 ** 20:.1f}MB "
+                + (f"segments RAM={usage[0] / 2 ** 20:.1f}MB disk={usage[1] / 2 ** 20:.1f}MB" if usage else "")
+            )
+            report(name, latencies)
+        finally:
+            qdrant.client.delete_collection(collection_name)
+
+
+if __name__ == "__main__":
+    main()
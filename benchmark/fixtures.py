@@ -0,0 +1,93 @@
+"""
+Shared helpers for the benchmark scripts: sample nodes from the PLVN dataset and an in-memory Qdrant.
+"""
+import hashlib
+import statistics
+import sys
+import threading
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+RAG_BE = ROOT / "app" / "rag-be"
+DATASET = ROOT / "dataset" / "preprocessed" / "PLVN"
+
+if str(RAG_BE) not in sys.path:
+    sys.path.insert(0, str(RAG_BE))
+
+import uvicorn  # noqa: E402
+from llama_index.core import StorageContext, VectorStoreIndex  # noqa: E402
+from llama_index.core.schema import TextNode  # noqa: E402
+from llama_index.vector_stores.qdrant import QdrantVectorStore  # noqa: E402
+from qdrant_client import AsyncQdrantClient, QdrantClient  # noqa: E402
+
+QUESTION = "Người lao động bị sa thải có được trả lương hay không?"
+
+
+def load_nodes(limit: int, file_name: str = "45_2019_QH14_333670.md"):
+    """
+    One TextNode per Markdown paragraph, with the metadata the retriever reads.
+    """
+    path = DATASET / file_name
+    paragraphs = [p.strip() for p in path.read_text(encoding="utf-8").split("\n\n") if p.strip()]
+    nodes = []
+    for paragraph in paragraphs[:limit]:
+        nodes.append(
+            TextNode(
+                text=paragraph,
+                metadata={
+                    "file_path": str(path),
+                    "header_path": "/",
+                    "paragraph_id": hashlib.sha256(paragraph.encode()).hexdigest(),
+                    "paragraph_full_content": paragraph,
+                },
+            )
+        )
+    return nodes
+
+
+def use_memory_qdrant(qdrant_service) -> None:
+    """
+    Point a QdrantService at one in-memory Qdrant shared by its sync and async clients.
+
+    Local mode keeps collections per client object, so the async client reuses the sync client's storage.
+    """
+    qdrant_service.client = QdrantClient(location=":memory:")
+    qdrant_service.aclient = AsyncQdrantClient(location=":memory:")
+    qdrant_service.aclient._client.collections = qdrant_service.client._client.collections
+
+
+def index_nodes(clients, collection_id: str, nodes) -> None:
+    vector_store = QdrantVectorStore(collection_id, client=clients.qdrant.client, batch_size=20)
+    VectorStoreIndex(
+        nodes,
+        storage_context=StorageContext.from_defaults(vector_store=vector_store),
+        embed_model=clients.embed_model.get_embed_model(),
+    )
+
+
+def start_backend(port: int) -> uvicorn.Server:
+    """
+    Serve app/rag-be/app.py (one uvicorn worker) in a daemon thread, return once it accepts connections.
+    """
+    from app import app
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def percentile(values, q: int) -> float:
+    return statistics.quantiles(values, n=100)[q - 1] if len(values) > 1 else values[0]
+
+
+def report(name: str, latencies) -> None:
+    print(
+        f"{name:<8} n={len(latencies):<5} "
+        f"mean={statistics.mean(latencies) * 1000:8.2f}ms "
+        f"p50={percentile(latencies, 50) * 1000:8.2f}ms "
+        f"p95={percentile(latencies, 95) * 1000:8.2f}ms "
+        f"p99={percentile(latencies, 99) * 1000:8.2f}ms"
+    )
@@ -0,0 +1,334 @@
+"""
+HTTP load test of the rag-be endpoints: latency histograms, throughput, error rates and the saturation point.
+
+Runs a sweep of load levels against the backend, each for --duration seconds, with a weighted request mix
+(--mix retriever=8 chat=1 collections=1):
+    - closed loop (--concurrency 1 2 4 ...): that many clients, each sending its next request when the previous
+      one is answered. Shows the throughput a number of users can get.
+    - open loop (--rate 5 10 20 ...): requests arrive at that rate (Poisson), whether or not the backend keeps up.
+      Latency counts from the scheduled arrival, so queueing is not hidden (no coordinated omission).
+
+Saturation report: the knee is the first level reaching 90% of the best throughput, past it more load only adds
+latency (and errors). In open loop, a level is saturated when the achieved throughput falls below 95% of the
+offered rate or more than 1% of the requests fail.
+
+Target:
+    - by default the backend runs in-process (one uvicorn worker) with an in-memory Qdrant and the stub LLM
+      gateway answering after --latency-ms, the load generator shares the process.
+    - --url: a running deployment (docker compose, uvicorn --workers N, ...), --collection-ids to query. Run once
+      per deployment shape with --label and --output, then compare the knees.
+
+Usage:
+    python benchmark/loadtest.py --latency-ms 100 --concurrency 1 2 4 8 16 32 64
+    python benchmark/loadtest.py --rate 10 20 40 80 --mix retriever=8 chat=1 collections=1 --histogram
+    python benchmark/loadtest.py --url http://localhost:8000 --collection-ids labor_law --concurrency 4 16 64 \\
+        --label "2 workers" --output results/loadtest_2_workers.json
+"""
+import argparse
+import asyncio
+import bisect
+import json
+import os
+import random
+import time
+from collections import Counter
+
+import httpx
+from bench_retrieval import QUESTIONS
+from fixtures import index_nodes, load_nodes, percentile, start_backend, use_memory_qdrant
+from stub_gateway import serve_in_thread
+
+ENDPOINTS = {
+    "retriever": "/rag/retriever",
+    "chat": "/rag/chat",
+    "chat_stream": "/rag/chat/stream",
+    "collections": "/vector_database/qdrant/get_collections",
+}
+
+# Upper bounds (ms) of the latency histogram buckets, the last one is open
+BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+KNEE_RATIO = 0.9
+SATURATED_RATE_RATIO = 0.95
+SATURATED_ERROR_RATE = 0.01
+
+COLLECTION = {
+    "id": "loadtest",
+    "collection_name": "loadtest",
+    "description": "Load test collection",
+}
+
+
+def parse_mix(items):
+    """
+    ["retriever=8", "chat=1"] -> (endpoint names, weights)
+    """
+    names, weights = [], []
+    for item in items:
+        name, _, weight = item.partition("=")
+        if name not in ENDPOINTS:
+            raise SystemExit(f"Unknown endpoint in --mix: {name}, expected one of {list(ENDPOINTS)}")
+        names.append(name)
+        weights.append(float(weight or 1))
+    return names, weights
+
+
+class Recorder:
+    """
+    Outcomes of the requests of one load level.
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.latencies_by_endpoint = {}
+        self.statuses = Counter()
+        self.errors = 0
+        self.dropped = 0
+
+    def record(self, endpoint: str, latency: float, status: str, ok: bool):
+        self.latencies.append(latency)
+        self.latencies_by_endpoint.setdefault(endpoint, []).append(latency)
+        self.statuses[status] += 1
+        self.errors += not ok
+
+    def summary(self, level: float, elapsed: float, offered_rate: float = None):
+        sent = len(self.latencies)
+        ok = sent - self.errors
+        result = {
+            "level": level,
+            "sent": sent,
+            "ok": ok,
+            "errors": self.errors,
+            "dropped": self.dropped,
+            "error_rate": (self.errors + self.dropped) / ((sent + self.dropped) or 1),
+            "throughput": ok / elapsed if elapsed else 0.0,
+            "latency_ms": latency_stats(self.latencies),
+            "latency_ms_by_endpoint": {
+                endpoint: latency_stats(values) for endpoint, values in self.latencies_by_endpoint.items()
+            },
+            "histogram": histogram(self.latencies),
+            "statuses": dict(self.statuses),
+        }
+        if offered_rate is not None:
+            result["offered_rate"] = offered_rate
+            result["saturated"] = (
+                result["throughput"] < SATURATED_RATE_RATIO * offered_rate
+                or result["error_rate"] > SATURATED_ERROR_RATE
+            )
+        return result
+
+
+def latency_stats(values):
+    if not values:
+        return {}
+    return {
+        "p50": percentile(values, 50) * 1000,
+        "p95": percentile(values, 95) * 1000,
+        "p99": percentile(values, 99) * 1000,
+        "max": max(values) * 1000,
+    }
+
+
+def histogram(values):
+    counts = [0] * (len(BUCKETS_MS) + 1)
+    for value in values:
+        counts[bisect.bisect_left(BUCKETS_MS, value * 1000)] += 1
+    labels = [f"<={bound}ms" for bound in BUCKETS_MS] + [f">{BUCKETS_MS[-1]}ms"]
+    return dict(zip(labels, counts))
+
+
+class LoadGenerator:
+    def __init__(self, client: httpx.AsyncClient, mix, collection_ids, cache_busting: bool, seed: int):
+        self.client = client
+        self.names, self.weights = mix
+        self.collection_ids = collection_ids
+        self.cache_busting = cache_busting
+        self.random = random.Random(seed)
+        self.sequence = 0
+
+    def next_request(self):
+        endpoint = self.random.choices(self.names, self.weights)[0]
+        if endpoint == "collections":
+            return endpoint, None
+
+        self.sequence += 1
+        question = self.random.choice(QUESTIONS)[1]
+        if self.cache_busting:
+            # A question never asked before: pays the embedding and rerank calls
+            question = f"{question} ({self.sequence})"
+        return endpoint, {"question": question, "collection_ids": self.collection_ids}
+
+    async def send(self, recorder: Recorder, endpoint: str, payload, started: float):
+        try:
+            if endpoint == "chat_stream":
+                async with self.client.stream("POST", ENDPOINTS[endpoint], json=payload) as response:
+                    async for _ in response.aiter_raw():
+                        pass
+            else:
+                response = await self.client.post(ENDPOINTS[endpoint], json=payload)
+            status, ok = str(response.status_code), response.status_code == 200
+        except httpx.HTTPError as e:
+            status, ok = type(e).__name__, False
+        recorder.record(endpoint, time.perf_counter() - started, status, ok)
+
+    async def closed_loop(self, concurrency: int, duration: float):
+        recorder = Recorder()
+        deadline = time.perf_counter() + duration
+
+        async def user():
+            while time.perf_counter() < deadline:
+                endpoint, payload = self.next_request()
+                await self.send(recorder, endpoint, payload, time.perf_counter())
+
+        start = time.perf_counter()
+        await asyncio.gather(*(user() for _ in range(concurrency)))
+        return recorder.summary(concurrency, time.perf_counter() - start)
+
+    async def open_loop(self, rate: float, duration: float, max_outstanding: int):
+        recorder = Recorder()
+        tasks = set()
+
+        start = time.perf_counter()
+        scheduled = start
+        while scheduled < start + duration:
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            if len(tasks) >= max_outstanding:
+                # The client would run out of connections/memory: count the arrival as failed
+                recorder.dropped += 1
+            else:
+                endpoint, payload = self.next_request()
+                task = asyncio.create_task(self.send(recorder, endpoint, payload, scheduled))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            scheduled += self.random.expovariate(rate)
+
+        await asyncio.gather(*tasks)
+        return recorder.summary(rate, time.perf_counter() - start, offered_rate=rate)
+
+
+def saturation_report(results):
+    best = max(results, key=lambda r: r["throughput"])
+    knee = next(r for r in results if r["throughput"] >= KNEE_RATIO * best["throughput"])
+    report = {
+        "max_throughput": best["throughput"],
+        "max_throughput_level": best["level"],
+        "knee_level": knee["level"],
+        "knee_throughput": knee["throughput"],
+        "knee_p99_ms": knee["latency_ms"].get("p99"),
+        "baseline_p99_ms": results[0]["latency_ms"].get("p99"),
+    }
+    if "offered_rate" in results[0]:
+        saturated = [r for r in results if r["saturated"]]
+        report["first_saturated_rate"] = saturated[0]["level"] if saturated else None
+    return report
+
+
+def print_level(result, mode: str, show_histogram: bool):
+    latency = result["latency_ms"]
+    print(
+        f"{result['level']:>8g} {result['throughput']:>9.1f} {result['sent']:>7} {result['error_rate']:>7.1%} "
+        f"{latency.get('p50', 0):>9.1f} {latency.get('p95', 0):>9.1f} {latency.get('p99', 0):>9.1f}"
+        + ("  saturated" if mode == "rate" and result["saturated"] else "")
+    )
+    if show_histogram:
+        total = result["sent"] or 1
+        for label, count in result["histogram"].items():
+            if count:
+                print(f"{'':>10}{label:>10} {count:>7} {'#' * max(1, round(40 * count / total))}")
+
+
+async def run(args, url: str, collection_ids):
+    mode, levels = ("rate", args.rate) if args.rate else ("concurrency", args.concurrency)
+    connections = args.max_outstanding if mode == "rate" else max(levels)
+    limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=args.timeout) as client:
+        generator = LoadGenerator(client, parse_mix(args.mix), collection_ids, args.cache_busting, args.seed)
+
+        # Warm up the connections and the lazy parts of the backend
+        await generator.closed_loop(1, 1.0)
+
+        print(f"{args.label or url}: {mode} sweep, {args.duration:.0f}s per level, mix {' '.join(args.mix)}")
+        print(f"{mode:>8} {'req/s':>9} {'sent':>7} {'errors':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+        results = []
+        for level in levels:
+            if mode == "rate":
+                result = await generator.open_loop(level, args.duration, args.max_outstanding)
+            else:
+                result = await generator.closed_loop(int(level), args.duration)
+            results.append(result)
+            print_level(result, mode, args.histogram)
+
+    report = saturation_report(results)
+    print(
+        f"\nsaturation: max {report['max_throughput']:.1f} req/s at {mode} {report['max_throughput_level']:g}, "
+        f"knee at {mode} {report['knee_level']:g} ({report['knee_throughput']:.1f} req/s, "
+        f"p99 {report['knee_p99_ms'] or 0:.1f}ms vs {report['baseline_p99_ms'] or 0:.1f}ms at the lowest level)"
+    )
+    if mode == "rate":
+        print(f"first saturated rate: {report['first_saturated_rate']}")
+
+    return {"mode": mode, "results": results, "saturation": report}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    load = parser.add_mutually_exclusive_group()
+    load.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32], help="Closed loop")
+    load.add_argument("--rate", type=float, nargs="+", help="Open loop, requests per second")
+    parser.add_argument("--mix", nargs="+", default=["retriever=1"], help="endpoint=weight, endpoints: "
+                        + ", ".join(ENDPOINTS))
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds per load level")
+    parser.add_argument("--max-outstanding", type=int, default=1000, help="Open loop: in-flight request cap")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--cache-busting", action="store_true", help="Make every question unique")
+    parser.add_argument("--histogram", action="store_true", help="Print the latency histogram of every level")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--url", help="Running backend, instead of the in-process one")
+    parser.add_argument("--collection-ids", nargs="+", help="Collections to query on --url")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="In-process: stub gateway latency per call")
+    parser.add_argument("--nodes", type=int, default=200, help="In-process: chunks in the test collection")
+    parser.add_argument("--stub-port", type=int, default=8120)
+    parser.add_argument("--port", type=int, default=8121)
+    parser.add_argument("--label", help="Name of the deployment shape, in the report and the output")
+    parser.add_argument("--output", help="Write the settings, results and saturation report as JSON")
+    args = parser.parse_args()
+
+    if args.url:
+        if not args.collection_ids and any(not item.startswith("collections") for item in args.mix):
+            parser.error("--collection-ids is required with --url")
+        url, collection_ids = args.url.rstrip("/"), args.collection_ids
+    else:
+        stub = serve_in_thread(args.stub_port)
+        os.environ["LLM_GATEWAY_URL"] = f"http://127.0.0.1:{args.stub_port}/v1"
+        os.environ.setdefault("LLM_LAB_API_KEY", "stub")
+        os.environ.setdefault("EM_MODEL", "bge-m3")
+        os.environ.setdefault("RM_MODEL", "bge-reranker")
+        os.environ.setdefault("LLM_MODEL", "stub")
+
+        from services import RAGService
+
+        # Index with a latency-free gateway, then slow it down for the measurement
+        RAGService.startup()
+        clients = RAGService.clients()
+        use_memory_qdrant(clients.qdrant)
+        index_nodes(clients, COLLECTION["id"], load_nodes(args.nodes))
+        clients.qdrant._add_to_metadata(COLLECTION)
+        stub.config.app.state.latency = args.latency_ms / 1000
+
+        start_backend(args.port)
+        url, collection_ids = f"http://127.0.0.1:{args.port}", [COLLECTION["id"]]
+
+    output = asyncio.run(run(args, url, collection_ids))
+
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"settings": vars(args), **output}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
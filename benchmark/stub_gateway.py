@@ -0,0 +1,166 @@
+"""
+Local stand-in for the LLM gateway (llama-swap), OpenAI-compatible.
+
+Endpoints:
+    - POST /v1/embeddings: deterministic hashed bag-of-words vectors.
+    - POST /v1/rerank: token-overlap scores (TEI format).
+    - POST /v1/chat/completions: canned answer, streamed word by word when "stream" is set.
+
+Every endpoint sleeps `app.state.latency` seconds to emulate model time without blocking the event loop.
+Embeddings also sleep `app.state.latency_per_input` seconds per input, and with `app.state.parallel` set, at most
+that many embedding calls run at once (llama-server slots), the others wait.
+
+Usage:
+    python benchmark/stub_gateway.py --port 8100 --latency-ms 50
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import re
+import threading
+import time
+from typing import List, Union
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+DIMENSION = 1024
+ANSWER = "Stub answer."
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN.findall(text.lower())
+
+
+def embed_text(text: str, dimension: int = DIMENSION) -> List[float]:
+    """
+    Hash every token into a bucket, then L2-normalize. Same text -> same vector.
+    """
+    vector = [0.0] * dimension
+    for token in tokenize(text):
+        digest = hashlib.md5(token.encode()).digest()
+        bucket = int.from_bytes(digest[:4], "little") % dimension
+        vector[bucket] += 1.0 if digest[4] % 2 else -1.0
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+def create_app(latency: float = 0.0, dimension: int = DIMENSION) -> FastAPI:
+    app = FastAPI()
+    app.state.latency = latency
+    app.state.latency_per_input = 0.0
+    app.state.parallel = 0
+    app.state.calls = {"embeddings": 0, "embedded_inputs": 0, "rerank": 0, "chat": 0}
+    slots = {}
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        inputs: Union[str, List[str]] = body["input"]
+        if isinstance(inputs, str):
+            inputs = [inputs]
+
+        app.state.calls["embeddings"] += 1
+        app.state.calls["embedded_inputs"] += len(inputs)
+        delay = app.state.latency + app.state.latency_per_input * len(inputs)
+        if app.state.parallel:
+            semaphore = slots.setdefault(app.state.parallel, asyncio.Semaphore(app.state.parallel))
+            async with semaphore:
+                await asyncio.sleep(delay)
+        else:
+            await asyncio.sleep(delay)
+
+        return {
+            "object": "list",
+            "model": body.get("model", "stub"),
+            "data": [
+                {"object": "embedding", "index": i, "embedding": embed_text(text, dimension)}
+                for i, text in enumerate(inputs)
+            ],
+            "usage": {"prompt_tokens": 0, "total_tokens": 0},
+        }
+
+    @app.post("/v1/rerank")
+    async def rerank(request: Request):
+        body = await request.json()
+        query = set(tokenize(body["query"]))
+
+        app.state.calls["rerank"] += 1
+        await asyncio.sleep(app.state.latency)
+
+        results = []
+        for i, text in enumerate(body["texts"]):
+            tokens = set(tokenize(text))
+            score = len(query & tokens) / (len(query) or 1)
+            results.append({"index": i, "score": score})
+        return sorted(results, key=lambda r: -r["score"])
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+
+        app.state.calls["chat"] += 1
+        await asyncio.sleep(app.state.latency)
+
+        if body.get("stream"):
+            return StreamingResponse(stream_chunks(body.get("model", "stub")), media_type="text/event-stream")
+
+        return {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "stub"),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": ANSWER},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }
+
+    async def stream_chunks(model: str):
+        for word in ANSWER.split(" "):
+            chunk = {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}],
+            }
+            yield f"data: {json.dumps(chunk)}\n\n"
+            await asyncio.sleep(app.state.latency / 10)
+        yield "data: [DONE]\n\n"
+
+    return app
+
+
+def serve_in_thread(port: int, latency: float = 0.0, dimension: int = DIMENSION) -> uvicorn.Server:
+    """
+    Start the stub gateway in a daemon thread, return once it accepts connections.
+    """
+    app = create_app(latency=latency, dimension=dimension)
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--dimension", type=int, default=DIMENSION)
+    args = parser.parse_args()
+
+    uvicorn.run(
+        create_app(latency=args.latency_ms / 1000, dimension=args.dimension),
+        host="0.0.0.0",
+        port=args.port,
+    )
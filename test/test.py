@@ -42,27 +42,33 @@ ground_truths = [
 
 results = []
 
-for question, gt in zip(questions_data, ground_truths):
-    url = "http://localhost:8001/rag/retriever"
-    headers = {
-        "accept": "application/json",
-        "Content-Type": "application/json"
-    }
+# One batch request per policy, for all its questions
+url = "http://localhost:8001/rag/retriever/batch"
+headers = {
+    "accept": "application/json",
+    "Content-Type": "application/json"
+}
+policy_ids = list(dict.fromkeys(question['policy_id'] for question in questions_data))
+predicts = {}
+for policy_id in policy_ids:
+    indices = [i for i, question in enumerate(questions_data) if question['policy_id'] == policy_id]
     data = {
-        "question": question['question'],
-        "collection_ids": [question['policy_id']]
+        "questions": [questions_data[i]['question'] for i in indices],
+        "collection_ids": [policy_id]
     }
 
     response = requests.post(url, headers=headers, json=data)
     response.raise_for_status()
     json_data = response.json()
 
-    predict = json_data.get("document_related", {}).get(question['policy_id'], "")
+    for i, result in zip(indices, json_data["results"]):
+        predicts[i] = result.get("document_related", {}).get(policy_id, "")
 
+for i, (question, gt) in enumerate(zip(questions_data, ground_truths)):
     results.append({
         "policy_id": question['policy_id'],
         "question": question['question'],
-        "predict": predict,
+        "predict": predicts[i],
         "ground_truth": gt
     })
 